@@ -12,28 +12,208 @@
 
 #------------------------------------------------------
 
+import base64
+import csv
+import io
+import json
+
 from CompanyDB import CompanyDB
+from CompanyMetrics import Instrumented
 
 
 class CompanyAPI:
 
-    def __init__(self, companyDB):
+    # The content type of each export format, and the columns exported.
+    exportContentTypes = { "ndjson" : "application/x-ndjson",
+                           "csv"    : "text/csv; charset=utf-8" }
+    exportColumns = ("id", "companyName", "description", "tagline", "companyEmail", "businessNumber", "restricted")
+
+    def __init__(self, companyDB, maxBatchSize = 5000, cache = None, metrics = None, logSampleRate = 0.0, logPayload = False,
+                 maxUpsertSize = 100000, maxUpsertBytes = 64 * 1024 * 1024):
         # Initialise the class with an instance of the CompanyDB class.
+        # maxBatchSize      limits how many values a single batch request may look up.
+        # cache             is an optional CompanyCache instance to hold GetCompanyById / GetCompanyList
+        #                   responses, or None to always read the database.
+        # metrics           is an optional CompanyMetrics instance to record each request in.
+        # logSampleRate     is the fraction [0.0 - 1.0] of requests logged to the "CompanyAPI" logger.
+        # logPayload        includes the response in the logged requests, at DEBUG level.
+        # maxUpsertSize     limits how many companies a single UpsertCompanies request may write.
+        # maxUpsertBytes    limits the size of an UpsertCompanies request body, checked by the Web API
+        #                   before the body is decoded.
 
         self.companyDB = companyDB
-
-
+        self.maxBatchSize = maxBatchSize
+        self.maxUpsertSize = maxUpsertSize
+        self.maxUpsertBytes = maxUpsertBytes
+        self.cache = cache
+        self.metrics = metrics
+        self.logSampleRate = logSampleRate
+        self.logPayload = logPayload
+
+
+    @Instrumented("AddNewCompanies")
+    def AddNewCompanies(self, rows, batchSize = 10000, fresh = False, Reject = None):
+        # Write an iterable of companies to the database using the bulk load.
+        # Rows are dictionaries as for AddNewCompany, and are converted as they are read
+        # so the whole feed is never held in memory.
+        # fresh is True when loading a table just recreated, and Reject is called with each company
+        # conflicting with another, see CompanyDB.BulkLoad.
+        # Returns the number of companies written.
+        try:
+            return self.companyDB.BulkLoad((self.ConvertRestricted(row) for row in rows), batchSize, fresh = fresh, Reject = Reject)
+        finally:
+            self.InvalidateCache()
+
+
+    @Instrumented("AddNewCompany")
     def AddNewCompany(self, row):
         # Write the company to the database.
 
         # Row is a dictionary of key / value pairs in any order:
         #     id, companyName, description, tagline, companyEmail, businessNumber, restricted
 
+        # Returns the error text if the company conflicts with another (the same id or business number),
+        # or "" if it was written.
+
+        row = self.ConvertRestricted(row)
+        # print("CompanyAPI.AddNewCompany: row [%s]" % row)
+
+        error = self.companyDB.AddNewCompany(row)
+        self.InvalidateCache()
+        return error
+
+
+    def Cached(self, key, function, *args):
+        # Return the cached response for key, or call the function to build the response and cache it.
+        # The data version is read before the function is called, so a response built while the
+        # data changes is treated as out of date.
+        if self.cache is None:
+            return function(*args)
+
+        version = self.companyDB.DataVersion()
+        respDict = self.cache.Get(key, version)
+        if respDict is None:
+            respDict = function(*args)
+            self.cache.Put(key, respDict, version)
+        return respDict
+
+
+    def CacheStats(self):
+        # The response cache counters, or an empty dictionary if there is no cache.
+        return {} if self.cache is None else self.cache.Stats()
+
+
+    @staticmethod
+    def ConvertRestricted(row):
         # Convert string for 'restricted' back to an integer boolean.
         row["restricted"] = "0" if row["restricted"].lower() == "no" else "1"
-        # print("CompanyAPI.AddNewCompany: row [%s]" % row)
+        return row
+
+
+    def DecodeCompanies(self, body, format = "json"):
+        # Decode a request body of companies for UpsertCompanies, as a JSON array or as NDJSON (one
+        # JSON object per line, blank lines ignored).
+        # Returns the list of companies and the error text, "" if the body was decoded.
+        # print("CompanyAPI.DecodeCompanies: bytes [%d] format [%s]" % (len(body), format) )
+        if format not in ("json", "ndjson"):
+            return [], "Upsert Companies format [%s] must be [json or ndjson]" % format
+
+        try:
+            text = body.decode("utf-8") if isinstance(body, bytes) else body
+        except UnicodeDecodeError as e:
+            return [], "Upsert Companies request body is not valid UTF-8: %s" % e
+
+        companies = []
+        if format == "ndjson":
+            for number, line in enumerate(text.splitlines(), 1):
+                if line.strip() == "":
+                    continue
+                try:
+                    companies.append(json.loads(line))
+                except ValueError as e:
+                    return [], "Upsert Companies request body line [%d] is not valid JSON: %s" % (number, e)
+        else:
+            try:
+                companies = json.loads(text)
+            except ValueError as e:
+                return [], "Upsert Companies request body is not valid JSON: %s" % e
+            if isinstance(companies, list) == False:
+                return [], "Upsert Companies request body must be a JSON array of companies"
+        return companies, ""
+
+
+    def DecodeCursor(self, cursor):
+        # Decode a cursor from EncodeCursor into its (restricted, after) values.
+        # Returns None if the cursor is not valid.
+        try:
+            padding = "=" * (-len(cursor) % 4)
+            restricted, after = base64.urlsafe_b64decode(cursor + padding).decode("ascii").split(":")
+        except ValueError:
+            return None
+
+        if (restricted != "" and restricted not in ("0", "1")) or (after.isascii() and after.isdigit()) == False:
+            return None
+        return (None if restricted == "" else restricted, after)
+
+
+    def EncodeCursor(self, restricted, after):
+        # Encode the position after the last company returned in a list as an opaque cursor.
+        # The restricted filter is carried in the cursor so it can be checked on the next request.
+        position = "%s:%s" % ("" if restricted is None else restricted, after)
+        return base64.urlsafe_b64encode(position.encode("ascii")).decode("ascii").rstrip("=")
+
+
+    @Instrumented("ExportCompanies")
+    def ExportCompanies(self, format = "ndjson", restricted = None, chunkSize = 65536):
+        # Export every company, matching the restricted flag if supplied, as NDJSON or CSV.
+        # On success "data" is a generator of encoded chunks of about chunkSize bytes, read from
+        # the database as they are generated, so memory use does not depend on the number of
+        # companies. "contentType" gives the type of the exported data.
+        # print("CompanyAPI.ExportCompanies: format [%s] restricted [%s]" % (format, restricted) )
+
+        # Make sure we only have valid values.
+        error = ""
+        if format not in self.exportContentTypes:
+            error = "Export Companies input parameter 'format' [%s] must be [%s]" % (format, " or ".join(sorted(self.exportContentTypes)))
+        elif (restricted is None) == False:
+            if ( (restricted.isascii() and restricted.isdigit()) == False) or ( (int(restricted) < 0) or (int(restricted) > 1) ) == True:
+                error = "Export Companies input parameter 'restricted' [%s] must be [0 or 1]" % restricted
+        if error != "":
+            respDict = { "result" : "error", "error" : error}
+            return respDict
+
+        respDict = { "result" : "ok", "contentType" : self.exportContentTypes[format],
+                     "data" : self.ExportChunks(format, restricted, chunkSize)}
+        return respDict
 
-        self.companyDB.AddNewCompany(row)
+
+    def ExportChunks(self, format, restricted, chunkSize):
+        # Generate the encoded export of the companies in chunks of about chunkSize bytes.
+        buffer = io.StringIO()
+        writer = None
+        if format == "csv":
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(self.exportColumns)
+
+        rows = self.companyDB.IterCompanies(restricted)
+        try:
+            for row in rows:
+                rowDict = self.FormatTupleAsDict(row)
+                if writer is None:
+                    buffer.write(json.dumps(rowDict))
+                    buffer.write("\n")
+                else:
+                    writer.writerow([rowDict[column] for column in self.exportColumns])
+
+                if buffer.tell() >= chunkSize:
+                    yield buffer.getvalue().encode("utf-8")
+                    buffer.seek(0)
+                    buffer.truncate()
+        finally:
+            rows.close()
+
+        if buffer.tell() > 0:
+            yield buffer.getvalue().encode("utf-8")
 
 
     def FormatTupleAsDict(self, row):
@@ -53,17 +233,160 @@ class CompanyAPI:
         return rowDict
 
 
+    def Generation(self):
+        # The generation of the companies from CompanyDB.Generation, for validating cached responses.
+        return self.companyDB.Generation()
+
+
+    @Instrumented("GetCompaniesByBusinessNumbers")
+    def GetCompaniesByBusinessNumbers(self, businessNumbers):
+        # Get the companies for a list of business numbers in a single request.
+        # Returns the companies found in "data", in request order, and the business
+        # numbers with no matching company in "missing".
+        # print("CompanyAPI.GetCompaniesByBusinessNumbers: businessNumbers [%s]" % businessNumbers)
+
+        # Make sure the batch is within limits and every business number is valid.
+        businessNumbers = [str(businessNumber) for businessNumber in businessNumbers]
+        error = ""
+        if len(businessNumbers) == 0:
+            error = "Get Companies By Business Numbers requires at least one business number"
+        elif len(businessNumbers) > self.maxBatchSize:
+            error = "Get Companies By Business Numbers is limited to [%d] business numbers, [%d] supplied" % (self.maxBatchSize, len(businessNumbers))
+        else:
+            for businessNumber in businessNumbers:
+                if self.ValidBusinessNumber(businessNumber) == False:
+                    error = "Business number [%s] is not valid" % businessNumber
+                    break
+        if error != "":
+            respDict = { "result" : "error", "error" : error}
+            return respDict
+
+        # Look up the distinct normalised business numbers together.
+        normalised = {}
+        for businessNumber in businessNumbers:
+            normalised.setdefault(self.companyDB.NormaliseBusinessNumber(businessNumber), businessNumber)
+        rows = self.companyDB.GetCompaniesByBusinessNumbers(normalised.keys())
+
+        rowList = []
+        missing = []
+        for digits, businessNumber in normalised.items():
+            if digits in rows:
+                rowList.append(self.FormatTupleAsDict(rows[digits]))
+            else:
+                missing.append(businessNumber)
+
+        respDict = { "result" : "ok", "data" : rowList, "missing" : missing}
+        return respDict
+
+
+    @Instrumented("GetCompaniesByIds")
+    def GetCompaniesByIds(self, ids):
+        # Get the companies for a list of ids in a single request.
+        # Returns the companies found in "data", in request order, and the ids with
+        # no matching company in "missing".
+        # print("CompanyAPI.GetCompaniesByIds: ids [%s]" % ids)
+
+        # Make sure the batch is within limits and we have digits and nothing more.
+        ids = [str(id) for id in ids]
+        error = ""
+        if len(ids) == 0:
+            error = "Get Companies By Ids requires at least one company ID"
+        elif len(ids) > self.maxBatchSize:
+            error = "Get Companies By Ids is limited to [%d] company IDs, [%d] supplied" % (self.maxBatchSize, len(ids))
+        else:
+            for id in ids:
+                if (id.isascii() and id.isdigit()) == False:
+                    error = "Company ID [%s] is not valid" % id
+                    break
+        if error != "":
+            respDict = { "result" : "error", "error" : error}
+            return respDict
+
+        # Look up the distinct ids together.
+        requested = {}
+        for id in ids:
+            requested.setdefault(int(id), id)
+        rows = self.companyDB.GetCompaniesByIds(requested.keys())
+
+        rowList = []
+        missing = []
+        for key, id in requested.items():
+            if key in rows:
+                rowList.append(self.FormatTupleAsDict(rows[key]))
+            else:
+                missing.append(id)
+
+        respDict = { "result" : "ok", "data" : rowList, "missing" : missing}
+        return respDict
+
+
+    @Instrumented("GetCompanyByBusinessNumber")
+    def GetCompanyByBusinessNumber(self, businessNumber):
+        # Get a specific company by an exact match on its business number.
+        # print("CompanyAPI.GetCompanyByBusinessNumber: businessNumber [%s]" % businessNumber)
+
+        # Make sure we have digits and nothing more.
+        if self.ValidBusinessNumber(businessNumber) == False:
+            error = "Business number [%s] is not valid" % businessNumber
+            respDict = { "result" : "error", "error" : error}
+            return respDict
+
+        # Get the company details.
+        row = self.companyDB.GetCompanyByBusinessNumber(self.companyDB.NormaliseBusinessNumber(businessNumber))
+
+        # Check for no result.
+        if len(row) == 0:
+            error = "No company found with business number [%s]" % businessNumber
+            respDict = { "result" : "error", "error" : error}
+            return respDict
+
+        else:
+            # Must have a result.
+            rowDict = self.FormatTupleAsDict(row)
+            respDict = { "result" : "ok", "data" : rowDict}
+            return respDict
+
+
+    @Instrumented("GetCompanyById")
     def GetCompanyById(self, id):
+        # Get a specific company by id and return its details, from the cache if enabled.
+        return self.Cached(("GetCompanyById", id), self.ReadCompanyById, id)
+
+
+    @Instrumented("GetCompanyList")
+    def GetCompanyList(self, offset, count = 100, restricted = None, cursor = None):
+        # Get a list of companies, from the cache if enabled - see ReadCompanyList.
+        return self.Cached(("GetCompanyList", offset, count, restricted, cursor), self.ReadCompanyList, offset, count, restricted, cursor)
+
+
+    @Instrumented("IngestCompanies")
+    def IngestCompanies(self, rows, source, identity, Checkpoint):
+        # Write a batch of companies read by a streaming load, with the load's checkpoint, in one transaction.
+        # Rows are dictionaries as for AddNewCompany - see CompanyDB.IngestRows - with 'restricted' already
+        # converted when parsed (see CompanyIngest.ParseChunk), so the writer only binds and inserts them.
+        # Returns the number of companies written.
+        try:
+            return self.companyDB.IngestRows(rows, source, identity, Checkpoint)
+        finally:
+            self.InvalidateCache()
+
+
+    def InvalidateCache(self):
+        # Empty the cache after a write through the API.
+        if self.cache is not None:
+            self.cache.Invalidate()
+
+
+    def ReadCompanyById(self, id):
         # Get a specific company by id and return its details.
-        # print("CompanyAPI.GetCompanyById: id [%s]" % id)
+        # print("CompanyAPI.ReadCompanyById: id [%s]" % id)
 
         jsonStr = ""
 
         # Make sure we have digits and nothing more.
-        if id.isdigit() == False:
+        if (id.isascii() and id.isdigit()) == False:
             error = "Company ID [%s] is not valid" % id
             respDict = { "result" : "error", "error" : error}
-            print("CompanyAPI.GetCompanyById: response [%s]" % respDict)
             return respDict
 
         # Get the company details.
@@ -74,48 +397,58 @@ class CompanyAPI:
         if len(row) == 0:
             error = "No company found with ID [%s]" % id
             respDict = { "result" : "error", "error" : error}
-            print("CompanyAPI.GetCompanyById: response [%s]" % respDict)
             return respDict
 
         else:
             # Must have a result.
             rowDict = self.FormatTupleAsDict(row)
             respDict = { "result" : "ok", "data" : rowDict}
-            print("CompanyAPI.GetCompanyById: response [%s]" % respDict)
             return respDict
 
 
-    def GetCompanyList(self, offset, count = 100, restricted = None):
+    def ReadCompanyList(self, offset, count = 100, restricted = None, cursor = None):
         # Get a list of companies:
         #     matching the restricted flag if supplied,
         #     starting at offset in the SQL query result,
+        #     or if cursor is supplied, starting after the last company of the previous page,
         #     to a maximum of count companies.
+        # A successful response includes the cursor for the following page in "next",
+        # which is None on the last page, and the number of companies matching the
+        # restricted flag in "total" with the number of pages of count companies in "pages".
         # restrict = "All" if restricted is None else str(restricted)
-        # print("CompanyAPI.GetCompanyList: offset [%s] count [%s] restrict [%s]" % (offset, count, restrict) )
+        # print("CompanyAPI.ReadCompanyList: offset [%s] count [%s] restrict [%s] cursor [%s]" % (offset, count, restrict, cursor) )
 
         # Make sure we only have valid values.
         error = ""
-        if offset.isdigit() == False:
+        after = None
+        if (offset.isascii() and offset.isdigit()) == False:
             error = "Get Company List input parameter 'offset' [%s] is not valid" % offset
-        elif (count.isdigit() and (int(count) > 0)) == False:
+        elif (count.isascii() and count.isdigit() and (int(count) > 0)) == False:
             error = "Get Company List input parameter 'count' [%s] must be greater than zero" % count
         elif (restricted is None) == False:
-            if ( (restricted.isdigit()) == False) or ( (int(restricted) < 0) or (int(restricted) > 1) ) == True:
+            if ( (restricted.isascii() and restricted.isdigit()) == False) or ( (int(restricted) < 0) or (int(restricted) > 1) ) == True:
                 error = "Get Company List input parameter 'restricted' [%s] must be [0 or 1]" % restricted
+        if error == "" and cursor is not None:
+            position = self.DecodeCursor(cursor)
+            if position is None:
+                error = "Get Company List input parameter 'cursor' [%s] is not valid" % cursor
+            elif position[0] != restricted:
+                error = "Get Company List input parameter 'cursor' [%s] does not match the 'restricted' parameter" % cursor
+            else:
+                after = position[1]
         if error != "":
             respDict = { "result" : "error", "error" : error}
-            print("CompanyAPI.GetCompanyList: response [%s]" % respDict)
             return respDict
 
-        # Get the company list.
-        rows = self.companyDB.GetCompanyList(offset, count, restricted)
+        # Get the company list, with one extra company to tell if there is a following page.
+        rows = self.companyDB.GetCompanyList(offset, str(int(count) + 1), restricted, after)
 
         # Check for no result.
         if len(rows) == 0:
             restrict = "" if restricted is None else " Restricted" if restricted == "1" else " Not restricted"
-            error = "No companies matching search criteria -%s with offset [%s] in the result set" % (restrict, offset)
+            position = "offset [%s]" % offset if cursor is None else "cursor [%s]" % cursor
+            error = "No companies matching search criteria -%s with %s in the result set" % (restrict, position)
             respDict = { "result" : "error", "error" : error}
-            print("CompanyAPI.GetCompanyList: response [%s]" % respDict)
             return respDict
 
         else:
@@ -124,9 +457,243 @@ class CompanyAPI:
 
             # Loop through the returned rows.
             for id, row in rows.items():
+                if len(rowList) == int(count):
+                    break
                 rowDict = self.FormatTupleAsDict(row)
                 rowList.append(rowDict)
 
-            respDict = { "result" : "ok", "data" : rowList}
-            print("CompanyAPI.GetCompanyList: response [%s]" % respDict)
+            nextCursor = None
+            if len(rows) > int(count):
+                nextCursor = self.EncodeCursor(restricted, rowList[-1]["id"])
+
+            # The totals are kept by the database, so are not counted for each page.
+            stats = self.companyDB.Statistics()
+            total = stats["total"] if restricted is None else stats["restricted"] if restricted == "1" else stats["unrestricted"]
+            pages = (total + int(count) - 1) // int(count)
+
+            respDict = { "result" : "ok", "data" : rowList, "next" : nextCursor, "total" : total, "pages" : pages}
+            return respDict
+
+
+    @Instrumented("RebuildCompanies")
+    def RebuildCompanies(self, rows, batchSize = 10000, minFraction = 0.0, Reject = None):
+        # Replace all the companies in the database, swapping the new table in only once it is complete.
+        # Rows are dictionaries as for AddNewCompany, Reject is called with each company conflicting
+        # with another (see CompanyDB.BulkLoad).
+        # Returns the number of companies in the new table.
+        try:
+            return self.companyDB.RebuildTable((self.ConvertRestricted(row) for row in rows), batchSize, minFraction, Reject)
+        finally:
+            self.InvalidateCache()
+
+
+    @Instrumented("RollbackCompanies")
+    def RollbackCompanies(self):
+        # Swap back the companies replaced by the last RebuildCompanies.
+        # Returns False if there is nothing to roll back to.
+        try:
+            return self.companyDB.RollbackTable()
+        finally:
+            self.InvalidateCache()
+
+
+    def ReadSearchCompanies(self, query, offset = "0", count = "20", restricted = None):
+        # Search the companies by name, description and tagline:
+        #     matching the restricted flag if supplied,
+        #     best match first,
+        #     starting at offset in the ranked result,
+        #     to a maximum of count companies.
+        # A successful response includes the offset of the following page in "next",
+        # which is None on the last page. No matching companies is not an error.
+        # print("CompanyAPI.ReadSearchCompanies: query [%s] offset [%s] count [%s] restricted [%s]" % (query, offset, count, restricted) )
+
+        # Make sure we only have valid values.
+        error = self.ValidSearchParameters("Search Companies", query, offset, count, restricted)
+        if error != "":
+            respDict = { "result" : "error", "error" : error}
+            return respDict
+
+        # Get the matching companies, with one extra company to tell if there is a following page.
+        # The count is capped so the extra company still fits in an SQLite integer.
+        rows = self.companyDB.SearchCompanies(query, offset, min(int(count), CompanyDB.maxInteger - 1) + 1, restricted)
+
+        rowList = [self.FormatTupleAsDict(row) for row in rows[:int(count)]]
+        nextOffset = None
+        if len(rows) > int(count):
+            nextOffset = str(int(offset) + int(count))
+
+        respDict = { "result" : "ok", "data" : rowList, "next" : nextOffset}
+        return respDict
+
+
+    def ReadTypeaheadCompanies(self, prefix, count = "10", restricted = None):
+        # Suggest companies whose name starts a word with the last word of prefix, and holds
+        # any earlier words, matching the restricted flag if supplied, best match first.
+        # Only the id, name and restricted status of each company are returned.
+        # print("CompanyAPI.ReadTypeaheadCompanies: prefix [%s] count [%s] restricted [%s]" % (prefix, count, restricted) )
+
+        # Make sure we only have valid values.
+        error = self.ValidSearchParameters("Typeahead Companies", prefix, "0", count, restricted, "prefix")
+        if error != "":
+            respDict = { "result" : "error", "error" : error}
+            return respDict
+
+        rowList = []
+        for id, companyName, restricted in self.companyDB.TypeaheadCompanies(prefix, min(int(count), CompanyDB.maxInteger), restricted):
+            rowList.append({ "id" : id, "companyName" : companyName, "restricted" : "No" if restricted == 0 else "Yes"})
+
+        respDict = { "result" : "ok", "data" : rowList}
+        return respDict
+
+
+    @Instrumented("SearchCompanies")
+    def SearchCompanies(self, query, offset = "0", count = "20", restricted = None):
+        # Search the companies, from the cache if enabled - see ReadSearchCompanies.
+        return self.Cached(("SearchCompanies", query, offset, count, restricted), self.ReadSearchCompanies, query, offset, count, restricted)
+
+
+    @Instrumented("SyncCompanies")
+    def SyncCompanies(self, rows, deleteMissing = False, batchSize = 10000, Reject = None):
+        # Bring the database up to date with an iterable of companies, only writing the changes.
+        # Rows are dictionaries as for AddNewCompany, Reject is called with each company conflicting
+        # with another (see CompanyDB.SyncRows).
+        # Returns the counts of companies inserted, updated, unchanged, deleted and rejected.
+        try:
+            return self.companyDB.SyncRows((self.ConvertRestricted(row) for row in rows), deleteMissing, batchSize, Reject)
+        finally:
+            self.InvalidateCache()
+
+
+    @Instrumented("TypeaheadCompanies")
+    def TypeaheadCompanies(self, prefix, count = "10", restricted = None):
+        # Suggest companies as a name is typed, from the cache if enabled - see ReadTypeaheadCompanies.
+        return self.Cached(("TypeaheadCompanies", prefix, count, restricted), self.ReadTypeaheadCompanies, prefix, count, restricted)
+
+
+    @Instrumented("UpsertCompanies")
+    def UpsertCompanies(self, companies):
+        # Insert or update a batch of companies in a single transaction, as pushed by another system.
+        # Each company is a dictionary of the columns of ExportCompanies (the id as a number or text,
+        # restricted as Yes or No), so an export can be pushed back unchanged.
+        # The whole batch is checked first, and is written only if every company is valid, so it is
+        # written whole or not at all.
+        # "data" gives the result of each company in request order, with its "index" in the batch,
+        # "id" and "result": inserted, updated or unchanged, or if nothing was written, error
+        # (with the "error") for the companies at fault and skipped for the rest.
+        # A successful response counts the results in "counts".
+        # print("CompanyAPI.UpsertCompanies: companies [%d]" % len(companies))
+
+        # Make sure the batch is within limits.
+        error = ""
+        if isinstance(companies, list) == False:
+            error = "Upsert Companies requires a list of companies"
+        elif len(companies) == 0:
+            error = "Upsert Companies requires at least one company"
+        elif len(companies) > self.maxUpsertSize:
+            error = "Upsert Companies is limited to [%d] companies, [%d] supplied" % (self.maxUpsertSize, len(companies))
+        if error != "":
+            respDict = { "result" : "error", "error" : error}
+            return respDict
+
+        # Check every company, noting the first company with each id.
+        results = []
+        rows = []
+        seen = {}
+        for index, company in enumerate(companies):
+            error = self.ValidCompany(company)
+            id = company.get("id") if isinstance(company, dict) else None
+            if error == "":
+                id = int(id)
+                if id in seen:
+                    error = "Company ID [%s] is also at index [%d]" % (id, seen[id])
+                else:
+                    seen[id] = index
+            results.append({ "index" : index, "id" : id, "result" : "ok" if error == "" else "error"})
+            if error != "":
+                results[-1]["error"] = error
+            else:
+                rows.append(self.ConvertRestricted(dict((key, company[key]) for key in self.exportColumns)))
+
+        invalid = len(companies) - len(rows)
+        if invalid > 0:
+            for result in results:
+                if result["result"] == "ok":
+                    result["result"] = "skipped"
+            error = "Upsert Companies found [%d] of [%d] companies not valid, none were written" % (invalid, len(companies))
+            respDict = { "result" : "error", "error" : error, "data" : results}
+            return respDict
+
+        # Write the batch.
+        for row in rows:
+            row["id"] = int(row["id"])
+        try:
+            statuses = self.companyDB.UpsertRows(rows)
+        finally:
+            self.InvalidateCache()
+
+        counts = { "inserted" : 0, "updated" : 0, "unchanged" : 0 }
+        conflicts = 0
+        for result, (status, error) in zip(results, statuses):
+            if status == "conflict":
+                result["result"] = "error"
+                result["error"] = "Company ID [%s] conflicts with another company: %s" % (result["id"], error)
+                conflicts += 1
+            else:
+                result["result"] = status
+                counts[status] = counts.get(status, 0) + 1
+
+        if conflicts > 0:
+            error = "Upsert Companies found [%d] of [%d] companies in conflict, none were written" % (conflicts, len(companies))
+            respDict = { "result" : "error", "error" : error, "data" : results}
             return respDict
+
+        respDict = { "result" : "ok", "data" : results, "counts" : counts}
+        return respDict
+
+
+    def ValidBusinessNumber(self, businessNumber):
+        # Business numbers are only composed of digits, optionally grouped with dashes
+        # or spaces as they appear in the company feed (e.g. 88-3175292).
+        digits = businessNumber.replace("-", "").replace(" ", "")
+        return digits.isascii() and digits.isdigit()
+
+
+    def ValidCompany(self, company):
+        # Check a company for UpsertCompanies, returning the error text or "" if it is valid.
+        if isinstance(company, dict) == False:
+            return "Company must be a JSON object"
+        for key in self.exportColumns:
+            if key not in company:
+                return "Company is missing [%s]" % key
+
+        # The id must be a whole number within SQLite's integer range, given as a number or digits.
+        id = company["id"]
+        if isinstance(id, str):
+            valid = id.isascii() and id.isdigit()
+        else:
+            valid = isinstance(id, int) and isinstance(id, bool) == False and id >= 0
+        if valid == False or int(id) >= 2 ** 63:
+            return "Company ID [%s] is not valid" % id
+        for key in self.exportColumns[1:]:
+            if isinstance(company[key], str) == False:
+                return "Company [%s] [%s] must be text" % (key, company[key])
+        if self.ValidBusinessNumber(company["businessNumber"]) == False:
+            return "Business number [%s] is not valid" % company["businessNumber"]
+        if company["restricted"].lower() not in ("yes", "no"):
+            return "Company 'restricted' [%s] must be [Yes or No]" % company["restricted"]
+        return ""
+
+
+    def ValidSearchParameters(self, operation, text, offset, count, restricted, textName = "query"):
+        # Check the parameters of a search, returning the error text or "" if they are valid.
+        error = ""
+        if CompanyDB.MatchExpression(text) is None:
+            error = "%s input parameter '%s' [%s] has no words to search for" % (operation, textName, text)
+        elif (offset.isascii() and offset.isdigit()) == False:
+            error = "%s input parameter 'offset' [%s] is not valid" % (operation, offset)
+        elif (count.isascii() and count.isdigit() and (int(count) > 0)) == False:
+            error = "%s input parameter 'count' [%s] must be greater than zero" % (operation, count)
+        elif (restricted is None) == False:
+            if ( (restricted.isascii() and restricted.isdigit()) == False) or ( (int(restricted) < 0) or (int(restricted) > 1) ) == True:
+                error = "%s input parameter 'restricted' [%s] must be [0 or 1]" % (operation, restricted)
+        return error
@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# CompanyAsyncAPI.py
+
+# Python class serving the company Web API as an asyncio ASGI application.
+
+# The routes are those of companyWebAPI.py:
+#     /                   the home page,
+#     /GetCompanyById     a company by id,
+#     /GetCompanyList     a list of companies,
+#     /metrics            the request metrics, if a CompanyMetrics instance is given,
+# with the query parameters passed as text to the CompanyAPI functions, as hug does.
+
+# The event loop only parses requests and writes responses. Each CompanyAPI call
+# runs on a bounded pool of worker threads, so a slow client or a large list page
+# holds up nothing but its own connection:
+# - at most workers calls run at once, and up to maxQueue more wait for a worker,
+# - a request arriving with the workers and queue full is answered at once with
+#   503 Service Unavailable and a Retry-After header, rather than queued without limit,
+# - a call not finished within timeout seconds is answered with 504 Gateway Timeout.
+#   Its worker carries on until the call returns, and is counted as busy until then.
+
+# Shutdown stops new requests being taken (answering them with 503), waits for the
+# requests in progress to finish, then stops the workers. It is run on an ASGI
+# lifespan shutdown, or by Serve on SIGINT / SIGTERM.
+
+# The application can be run by any ASGI server (e.g. uvicorn companyAsyncWebAPI:app),
+# or by Serve, a minimal HTTP/1.1 server with keep-alive built on asyncio streams,
+# needing no packages beyond the standard library.
+
+#------------------------------------------------------
+
+import asyncio
+import json
+import signal
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl
+
+
+class CompanyAsyncAPI:
+
+    # The route functions, with their required query parameters, and optional query parameters
+    # with the defaults of the companyWebAPI.py routes.
+    routes = { "/GetCompanyById" : ("GetCompanyById", ("id", ), ()),
+               "/GetCompanyList" : ("GetCompanyList", (), (("offset", "0"), ("count", "100"), ("restricted", None), ("cursor", None))) }
+
+    def __init__(self, companyAPI, workers = 8, maxQueue = 64, timeout = 10.0, metrics = None):
+        # Initialise the application with an instance of the CompanyAPI class.
+        # workers   is the number of threads running CompanyAPI calls, best matched to the CompanyDB poolSize.
+        # maxQueue  is the number of calls that may wait for a worker before requests are refused with 503.
+        # timeout   is the seconds a call may take before the request is answered with 504.
+        # metrics   is an optional CompanyMetrics instance to record each request in, as the "http" layer.
+        self.companyAPI = companyAPI
+        self.workers = workers
+        self.maxQueue = maxQueue
+        self.timeout = timeout
+        self.metrics = metrics
+
+        self.executor = None
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.active = 0
+        self.idle = None
+        self.stopping = False
+
+
+    async def __call__(self, scope, receive, send):
+        # The ASGI entry point.
+        if scope["type"] == "lifespan":
+            await self.Lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.HandleRequest(scope, receive, send)
+
+
+    def CallFinished(self):
+        # Release a worker slot when a call finishes, on whichever thread it finished.
+        with self.lock:
+            self.pending -= 1
+
+
+    async def HandleRequest(self, scope, receive, send):
+        # Answer a single HTTP request.
+        startTime = time.perf_counter()
+        self.Start()
+        self.active += 1
+        try:
+            status, headers, body = await self.Respond(scope)
+        finally:
+            self.active -= 1
+            if self.active == 0 and self.idle is not None:
+                self.idle.set()
+
+        headers = [(b"content-length", str(len(body)).encode("ascii"))] + headers
+        await send({ "type" : "http.response.start", "status" : status, "headers" : headers })
+        await send({ "type" : "http.response.body", "body" : body })
+
+        if self.metrics is not None:
+            path = scope["path"]
+            endpoint = path if path in ("/", "/metrics") or path in self.routes else "unmatched"
+            self.metrics.Record("http", endpoint, time.perf_counter() - startTime, status >= 400)
+
+
+    def JsonResponse(self, status, value, headers = None):
+        # A response of the value as JSON, in the same form as hug's JSON output.
+        body = json.dumps(value).encode("utf-8")
+        return (status, [(b"content-type", b"application/json; charset=utf-8")] + (headers or []), body)
+
+
+    async def Lifespan(self, receive, send):
+        # Start the workers on an ASGI lifespan startup, and shut down gracefully on its shutdown.
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.Start()
+                await send({ "type" : "lifespan.startup.complete" })
+            elif message["type"] == "lifespan.shutdown":
+                await self.Shutdown(self.timeout)
+                await send({ "type" : "lifespan.shutdown.complete" })
+                return
+
+
+    async def Respond(self, scope):
+        # Route a request, returning its (status, headers, body).
+        path = scope["path"]
+        if scope["method"] not in ("GET", "HEAD"):
+            return self.JsonResponse(405, { "errors" : { "method" : "Method [%s] not allowed" % scope["method"] } })
+        if self.stopping:
+            return self.JsonResponse(503, { "result" : "error", "error" : "Server is shutting down" })
+
+        if path == "/":
+            return self.JsonResponse(200, "Home page")
+
+        if path == "/metrics" and self.metrics is not None:
+            body = self.metrics.Prometheus(self.companyAPI.CacheStats()).encode("utf-8")
+            return (200, [(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")], body)
+
+        route = self.routes.get(path)
+        if route is None:
+            return self.JsonResponse(404, { "errors" : { "404" : "The API call you tried to make was not defined" } })
+
+        # Gather the parameters as hug would, the last value of a repeated parameter winning.
+        name, required, optional = route
+        params = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        errors = {}
+        for param in required:
+            if param not in params:
+                errors[param] = "Required parameter '%s' not supplied" % param
+        if len(errors) > 0:
+            return self.JsonResponse(400, { "errors" : errors })
+        kwargs = dict((param, params[param]) for param in required)
+        for param, default in optional:
+            kwargs[param] = params.get(param, default)
+
+        # Refuse the request rather than queue it if every worker is busy and the queue is full.
+        with self.lock:
+            if self.pending >= self.workers + self.maxQueue:
+                busy = True
+            else:
+                busy = False
+                self.pending += 1
+        if busy:
+            return self.JsonResponse(503, { "result" : "error", "error" : "Server is busy, please retry" }, [(b"retry-after", b"1")])
+
+        function = getattr(self.companyAPI, name)
+        try:
+            future = self.executor.submit(function, **kwargs)
+        except BaseException:
+            self.CallFinished()
+            raise
+        future.add_done_callback(lambda future: self.CallFinished())
+
+        try:
+            respDict = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            return self.JsonResponse(504, { "result" : "error", "error" : "Request timed out after [%g] seconds" % self.timeout })
+        except Exception as e:
+            return self.JsonResponse(500, { "result" : "error", "error" : "%s failed [%s: %s]" % (name, type(e).__name__, e) })
+
+        return self.JsonResponse(200, respDict)
+
+
+    async def Serve(self, host = "127.0.0.1", port = 8001, headerTimeout = 10.0, backlog = 1024):
+        # Serve the application over HTTP/1.1 until SIGINT / SIGTERM, then shut down gracefully.
+        # headerTimeout     is the seconds a client may take to send a request's headers before it is disconnected.
+        self.Start()
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        connections = set()
+
+        async def Connection(reader, writer):
+            task = asyncio.current_task()
+            connections.add(task)
+            try:
+                await self.ServeConnection(reader, writer, headerTimeout)
+            finally:
+                connections.discard(task)
+                writer.close()
+
+        server = await asyncio.start_server(Connection, host, port, backlog = backlog)
+        print("CompanyAsyncAPI: serving on [%s:%d] workers [%d] queue [%d] timeout [%g]" % (host, port, self.workers, self.maxQueue, self.timeout) )
+        async with server:
+            await stop.wait()
+            print("CompanyAsyncAPI: shutting down")
+            server.close()
+            await self.Shutdown(self.timeout)
+            # Connections waiting for their next request are closed.
+            for task in list(connections):
+                task.cancel()
+            await asyncio.gather(*connections, return_exceptions = True)
+
+
+    async def ServeConnection(self, reader, writer, headerTimeout):
+        # Serve the requests of one HTTP/1.1 connection, keeping it open between requests
+        # unless the client asks otherwise.
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), headerTimeout)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                return
+
+            lines = head.decode("latin-1").split("\r\n")
+            try:
+                method, target, version = lines[0].split(" ")
+            except ValueError:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\ncontent-length: 0\r\nconnection: close\r\n\r\n")
+                return
+            headers = []
+            for line in lines[1:]:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    headers.append((key.strip().lower().encode("latin-1"), value.strip().encode("latin-1")))
+            headerDict = dict(headers)
+
+            # Any request body is read and ignored, as the routes take only query parameters.
+            # A body not sized by a valid Content-Length (e.g. chunked) is refused, as where it ends,
+            # and so where the next request starts, would not be known.
+            length = headerDict.get(b"content-length", b"0") or b"0"
+            if b"transfer-encoding" in headerDict or length.isdigit() == False:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\ncontent-length: 0\r\nconnection: close\r\n\r\n")
+                return
+            if int(length) > 0:
+                try:
+                    await reader.readexactly(int(length))
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+
+            connection = headerDict.get(b"connection", b"").lower()
+            keepAlive = connection != b"close" if version == "HTTP/1.1" else connection == b"keep-alive"
+
+            path, _, query = target.partition("?")
+            scope = { "type" : "http", "asgi" : { "version" : "3.0" }, "http_version" : version[5:],
+                      "method" : method, "scheme" : "http", "path" : path, "raw_path" : path.encode("latin-1"),
+                      "query_string" : query.encode("latin-1"), "headers" : headers,
+                      "server" : writer.get_extra_info("sockname"), "client" : writer.get_extra_info("peername") }
+
+            async def receive():
+                return { "type" : "http.request", "body" : b"", "more_body" : False }
+
+            async def send(message):
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    out = ["HTTP/1.1 %d %s" % (status, HTTPStatus(status).phrase)]
+                    out += ["%s: %s" % (key.decode("latin-1"), value.decode("latin-1")) for key, value in message["headers"]]
+                    out.append("connection: %s" % ("keep-alive" if keepAlive else "close"))
+                    writer.write(("\r\n".join(out) + "\r\n\r\n").encode("latin-1"))
+                elif message["type"] == "http.response.body" and method != "HEAD":
+                    writer.write(message.get("body", b""))
+
+            await self.HandleRequest(scope, receive, send)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                return
+            if keepAlive == False:
+                return
+
+
+    async def Shutdown(self, timeout = 10.0):
+        # Stop taking new requests, wait up to timeout seconds for those in progress, then stop the workers
+        # once any calls still running (having timed out) have returned.
+        self.stopping = True
+        if self.active > 0:
+            self.idle = asyncio.Event()
+            try:
+                await asyncio.wait_for(self.idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self.executor is not None:
+            executor, self.executor = self.executor, None
+            await asyncio.to_thread(executor.shutdown, True, cancel_futures = True)
+
+
+    def Start(self):
+        # Start the worker threads, if not already started.
+        if self.executor is None and self.stopping == False:
+            self.executor = ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "CompanyAPI")
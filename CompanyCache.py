@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# CompanyCache.py
+
+# Python class defining an in-process LRU cache of CompanyAPI responses.
+
+# The cache holds the formatted response dictionaries, so a hit costs neither
+# the SQL query nor the FormatTupleAsDict conversion.
+
+# Entries are bounded by:
+# - maxEntries      the number of responses held,
+# - maxBytes        the estimated size of the responses held (their JSON length),
+# - ttl             the seconds a response is held before it must be rebuilt,
+# with the least recently used entries evicted first.
+
+# Each Get / Put is given the data version of the database it was read from.
+# A change in version means the data may have changed, and the whole cache is
+# invalidated rather than trying to work out which responses are affected.
+
+# Cached responses are shared between callers and must not be modified.
+
+#------------------------------------------------------
+
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class CompanyCache:
+
+    def __init__(self, maxEntries = 10000, maxBytes = 64 * 1024 * 1024, ttl = 60.0):
+        # Initialise the cache limits, with an empty cache.
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.version = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+
+    def CheckVersion(self, version):
+        # Invalidate the cache if the data version has changed since it was filled.
+        # Must be called holding the lock.
+        if version != self.version:
+            if len(self.entries) > 0:
+                self.invalidations += 1
+            self.entries.clear()
+            self.bytes = 0
+            self.version = version
+
+
+    def Get(self, key, version):
+        # Return the cached response for key, or None if there is no current entry.
+        with self.lock:
+            self.CheckVersion(version)
+
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            respDict, size, expires = entry
+            if time.monotonic() >= expires:
+                self.Remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return respDict
+
+
+    def Invalidate(self):
+        # Empty the cache, as the data it was filled from has changed.
+        with self.lock:
+            if len(self.entries) > 0:
+                self.invalidations += 1
+            self.entries.clear()
+            self.bytes = 0
+
+
+    def Put(self, key, respDict, version):
+        # Cache the response for key, evicting the least recently used entries to stay within limits.
+        size = len(json.dumps(respDict))
+        if size > self.maxBytes:
+            return
+
+        with self.lock:
+            self.CheckVersion(version)
+
+            if key in self.entries:
+                self.Remove(key)
+            self.entries[key] = (respDict, size, time.monotonic() + self.ttl)
+            self.bytes += size
+
+            while len(self.entries) > self.maxEntries or self.bytes > self.maxBytes:
+                oldest = next(iter(self.entries))
+                self.Remove(oldest)
+                self.evictions += 1
+
+
+    def Remove(self, key):
+        # Remove an entry from the cache.
+        # Must be called holding the lock.
+        respDict, size, expires = self.entries.pop(key)
+        self.bytes -= size
+
+
+    def Stats(self):
+        # The cache counters and current size.
+        with self.lock:
+            return { "entries"       : len(self.entries),
+                     "bytes"         : self.bytes,
+                     "hits"          : self.hits,
+                     "misses"        : self.misses,
+                     "evictions"     : self.evictions,
+                     "expirations"   : self.expirations,
+                     "invalidations" : self.invalidations }
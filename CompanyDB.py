@@ -20,29 +20,164 @@
 # companyEmail (Text)
 # businessNumber (Text)
 # restricted (Integer)        [0|1] representing [False|True]
+# businessNumberDigits (Text) businessNumber with all non-digits removed, uniquely indexed for exact match searches.
+# contentHash (Integer)       64 bit hash of the company details, used by SyncRows to find changed companies.
+
+# <table>ChangeLog
+# ----------------
+# changeID (Integer Primary Key)
+# id (Integer)                The company whose restricted status changed.
+# oldRestricted (Integer)     [0|1] before the change, NULL for a new company.
+# newRestricted (Integer)     [0|1] after the change, NULL for a deleted company.
+# changedAt (Text)            UTC timestamp of the change.
+
+# <table>Meta
+# -----------
+# epoch (Text)                Random token set when the meta data is created, identifying this database.
+# generation (Integer)        Incremented by every transaction that changes the companies.
+# modifiedAt (Real)           Unix time of the last change.
+
+# <table>Ingest
+# -------------
+# The checkpoint of each streaming load (see CompanyIngest.py), written in the same
+# transaction as each batch of companies, so an interrupted load resumes where it stopped.
+# source (Text Primary Key)   Absolute path of the file loaded.
+# identity (Text)             Size and modification time of the file, so a changed file is loaded afresh.
+# offset (Integer)            Byte offset in the (decompressed) file of the first row not yet loaded.
+# rowsRead (Integer)          Rows read before offset.
+# loaded (Integer)            Companies written.
+# rejected (Integer)          Rows rejected.
+# rejectBytes (Integer)       Size of the rejects file, which is cut back to it on resuming.
+# complete (Integer)          [0|1] the whole file has been loaded.
+# updatedAt (Real)            Unix time of the checkpoint.
+
+# <table>Search
+# -------------
+# FTS5 full text index of each company, with its rowid set to the company id.
+# companyName (Text)
+# description (Text)
+# tagline (Text)
+# It belongs to the company table, kept in step by the table's triggers, and is
+# swapped with it by RebuildTable / RollbackTable.
+
+# <table>Stats
+# ------------
+# A single row of statistics about the company table, kept in step by the table's
+# triggers so the companies need not be counted. It belongs to the table as <table>Search does.
+# total (Integer)             Number of companies.
+# restricted (Integer)        Number of restricted companies.
+# unrestricted (Integer)      Number of unrestricted companies.
+# minId (Integer)             Lowest company id, NULL if there are no companies.
+# maxId (Integer)             Highest company id, NULL if there are no companies.
+
+# Connections:
+
+# Each CompanyDB instance owns its connections to the database, which is put in
+# WAL mode so reads carry on while a write is committed:
+# - a single writer connection, with writes serialised across threads by a lock,
+# - a pool of up to poolSize read only connections, each lent to one thread at a
+#   time for the duration of a query,
+# - a read only watcher connection, used only to read PRAGMA data_version.
+# The database must therefore be a file rather than ":memory:".
+# The writer and watcher are opened on first use, so an instance used only to read
+# never opens the database for writing.
+
+# A server process may instead open the database readOnly, with a memory map
+# (mmapSize) so processes share the OS page cache, and as immutable when serving a
+# snapshot from PublishSnapshot that is replaced rather than changed.
+
+# Rebuilds:
+
+# RebuildTable loads the companies into a shadow table (<table>Build<n>), builds its
+# indexes and checks its row count, then swaps it in by renaming within a single
+# transaction, so readers see either the old or the new table, never a partial one.
+# The replaced table is kept as <table>Previous, which RollbackTable swaps back.
+# Index names are prefixed with the name of the table they were built on, which
+# keeps them unique across the generations, so a swapped in table's indexes are
+# found by their columns rather than their names (see CreateIndex).
+
+# Profiling:
+
+# Given a CompanyProfiler, every connection is traced, and Profile reports the time,
+# rows and query plan of each statement shape. Values are bound as parameters rather
+# than written into the SQL, so each query has one statement text whatever its values,
+# reused from apsw's statement cache rather than prepared again.
 
 #------------------------------------------------------
 
 import apsw
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+import urllib.request
 
 from builtins import int
+from contextlib import contextmanager, nullcontext
+from itertools import islice
 
 
 class CompanyDB:
 
-    def __init__(self, database = "company.db3", table = "Company"):
-        # Initialise the class with the database / table names.
-        global connection
-        global cursor
+    # PRAGMA settings applied to the writer for the duration of a bulk load into a freshly created
+    # table, and restored afterwards.
+    # The WAL is not synced - a failed load is simply rerun on a table recreated afresh. Loads into
+    # a table already serving, by SyncRows or RebuildTable, keep the normal durability.
+    # The journal mode is left as WAL, as it cannot be changed while readers are connected.
+    loadPragmas = { "synchronous"  : "OFF",
+                    "cache_size"   : "-262144" }
+
+    # The suffixes naming the company table and the tables belonging to it, which are
+    # swapped and dropped together.
+    tableSuffixes = ("", "Search", "Stats")
 
+    # The largest integer SQLite holds, beyond which a value bound as a parameter overflows.
+    maxInteger = 2 ** 63 - 1
+
+    def __init__(self, database = "company.db3", table = "Company", poolSize = 8, busyTimeout = 5000,
+                 readOnly = False, mmapSize = 0, immutable = False, profiler = None):
+        # Initialise the class with the database / table names.
+        # poolSize      is the maximum number of read connections, and so concurrent reads.
+        # busyTimeout   is the milliseconds a connection waits on a locked database before failing.
+        # readOnly      opens every connection, including the writer, read only, so any write fails.
+        # mmapSize      is the bytes of the database file each connection reads through a memory map
+        #               (PRAGMA mmap_size), sharing the OS page cache between processes rather than
+        #               copying pages into each connection's cache. 0 reads without a memory map.
+        # immutable     declares the database file will not change while open (a published snapshot),
+        #               so SQLite takes no locks and never checks for changes. Implies readOnly.
+        # profiler      is an optional CompanyProfiler instance, attached to every connection opened, to
+        #               profile the SQL statements run.
         self.database = database
         self.table = table
+        self.poolSize = poolSize
+        self.busyTimeout = busyTimeout
+        self.readOnly = readOnly or immutable
+        self.mmapSize = mmapSize
+        self.immutable = immutable
+        self.profiler = profiler
         self.totalcount = 0
         self.minkey = 0
         self.maxkey = 0
 
-        connection=apsw.Connection(self.database)
-        cursor=connection.cursor()
+        # The writer is opened on first use - see Writer.
+        self.writeLock = threading.RLock()
+        self.writer = None
+
+        # Read connections are opened on demand, up to poolSize.
+        self.readers = queue.LifoQueue()
+        self.readerSlots = threading.BoundedSemaphore(poolSize)
+        self.local = threading.local()
+
+        # The watcher sees a new data_version whenever any other connection commits,
+        # without waiting on the writer during a long load. It is opened on first use.
+        self.watchLock = threading.Lock()
+        self.watcher = None
+
+        # The last generation read, with the data version it was read at.
+        self.generation = None
 
 
     def AddNewCompany(self, row):
@@ -52,34 +187,417 @@ class CompanyDB:
         # Row is a dictionary of key / value pairs in any order:
         #     id, companyName, description, tagline, companyEmail, businessNumber, restricted
 
-        sql = "INSERT INTO %s (id, companyName, description, tagline, companyEmail, businessNumber, restricted) " % self.table
-        sql += "VALUES (?, ?, ?, ?, ?, ?, ?);"
+        # A company conflicting with one in the table (the same id or business number) is not written.
+        # Returns the error text, or "" if the company was written.
+        sql = self.InsertStatement()
         # print("Executing SQL statement [%s]" % sql)
-        cursor.execute(sql, (row["id"], row["companyName"], row["description"], row["tagline"],
-                             row["companyEmail"], row["businessNumber"], row["restricted"]) )
+        try:
+            with self.Writer() as connection, connection:
+                connection.execute(sql, self.RowValues(row))
+                self.BumpGeneration(connection)
+        except apsw.ConstraintError as e:
+            return str(e)
+        return ""
+
+
+    def BorrowReader(self):
+        # Take a read connection from the pool, opening a new one if none are idle, waiting
+        # if all poolSize connections are in use. It must be given back by ReturnReader.
+        self.readerSlots.acquire()
+        try:
+            return self.readers.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.OpenConnection(apsw.SQLITE_OPEN_READONLY)
+        except BaseException:
+            self.readerSlots.release()
+            raise
+
+
+    def BumpGeneration(self, connection):
+        # Record a change to the companies in the meta data.
+        # Called by the writer within the transaction making the change.
+        sql = "UPDATE %sMeta SET generation = generation + 1, modifiedAt = ?;" % self.table
+        connection.execute(sql, (time.time(), ))
+
+
+    def BulkLoad(self, rows, batchSize = 10000, table = None, fresh = False, Reject = None):
+        # Write an iterable of companies to the table (by default self.table) in batched transactions.
+        # Each batch is written by a single executemany within one transaction, rather
+        # than one autocommit transaction per row as AddNewCompany does.
+        # The indexes a new table was created without (see RecreateTable) are then built, once.
+        # fresh         is True if the table has just been created (see RecreateTable) and holds nothing
+        #               worth keeping, so is loaded with the load PRAGMA settings.
+        # Reject        is called with the row and error of each company not written as it conflicts
+        #               with one already in the table (see WriteRows).
+        # Rows are dictionaries as for AddNewCompany.
+        # Returns the number of rows written.
+        sql = self.InsertStatement(table)
+        rows = iter(rows)
+        total = 0
+
+        with self.Writer() as connection, self.LoadPragmas() if fresh else nullcontext():
+            while True:
+                batch = list(islice(rows, batchSize))
+                if len(batch) == 0:
+                    break
+
+                with connection:
+                    rejected = self.WriteRows(connection, sql, batch)
+                    if table is None:
+                        self.BumpGeneration(connection)
+                total += len(batch) - len(rejected)
+                if Reject is not None:
+                    for row, error in rejected:
+                        Reject(row, error)
+                # print("CompanyDB.BulkLoad: rows written [%d]" % total)
+
+            self.CreateIndexes(table)
+
+        return total
 
 
     def Close(self):
-        # Close the database cleanly.
-        connection.close(True)
+        # Close the database cleanly, including any idle read connections.
+        with self.writeLock:
+            while True:
+                try:
+                    self.readers.get_nowait().close(True)
+                except queue.Empty:
+                    break
+            with self.watchLock:
+                if self.watcher is not None:
+                    self.watcher.close(True)
+                    self.watcher = None
+            if self.writer is not None:
+                self.writer.close(True)
+                self.writer = None
+
 
+    @staticmethod
+    def ContentHash(values):
+        # A signed 64 bit hash of the company details, so an unchanged company can be recognised
+        # without comparing every column. Values are hashed as text, so "1" and 1 hash the same.
+        content = "\x1f".join("" if value is None else str(value) for value in values)
+        return int.from_bytes(hashlib.blake2b(content.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
 
-    def CountRows(self):
-        # Some basic statistics about the companies in the table.
+
+    def CountRows(self, table = None):
+        # Some basic statistics about the companies in the table (by default self.table), from Statistics.
+        # Returns the total count.
         # Clear in case NULL values result.
         self.totalcount = 0
         self.minkey = 0
         self.maxkey = 0
 
-        sql = 'SELECT count(*), min(id), max(id) FROM %s;' % self.table
-        # print("Executing SQL statement [%s]" % sql)
-        for x in cursor.execute(sql):
-            self.totalcount = int(x[0])
-            if (self.totalcount):
-                self.minkey = int(x[1])
-                self.maxkey = int(x[2])
+        stats = self.Statistics(table)
+        self.totalcount = stats["total"]
+        if (self.totalcount):
+            self.minkey = stats["minId"]
+            self.maxkey = stats["maxId"]
 
         # print('Rows: total [%d] keys: min [%d] max [%d]' % (self.totalcount, self.minkey, self.maxkey) )
+        return self.totalcount
+
+
+    def CreateIndex(self, connection, table, name, columns, unique = False):
+        # Create an index on the columns of the table, unless the table already has one on them.
+        # A table swapped in by RebuildTable keeps the index names of the table it was built as, so
+        # an index is found by its table and columns rather than by its name.
+        # The index is named <table>_<name>, numbered if that name is taken by another table's index
+        # (e.g. <table>Previous holding the indexes the table had before a rebuild).
+        for x in list(connection.execute("SELECT name, \"unique\" FROM pragma_index_list(?);", (table, ))):
+            indexColumns = [y[0] for y in connection.execute("SELECT name FROM pragma_index_info(?) ORDER BY seqno;", (x[0], ))]
+            if indexColumns == list(columns) and ( x[1] or unique == False ):
+                return
+
+        indexName = "%s_%s" % (table, name)
+        number = 1
+        while list(connection.execute("SELECT 1 FROM sqlite_master WHERE name = ?;", (indexName, ))):
+            number += 1
+            indexName = "%s_%s%d" % (table, name, number)
+
+        sql = 'CREATE %sINDEX %s ON %s (%s);' % ("UNIQUE " if unique else "", indexName, table, ", ".join(columns))
+        # print("Executing SQL statement [%s]" % sql)
+        connection.execute(sql)
+
+
+    def CreateIndexes(self, table = None):
+        # Create the indexes on the company table (by default self.table), if not already existing,
+        # with the search index and statistics, each filled from the table in one statement.
+        # A table being loaded is left without them (see RecreateTable) and they are built once the
+        # rows are written, rather than kept up to date a row at a time by their triggers.
+        if table is None:
+            table = self.table
+
+        with self.Writer() as connection:
+            # Company lists filtered by restricted seek by id within the restricted value.
+            self.CreateIndex(connection, table, "restricted_id", ("restricted", "id"))
+
+            self.CreateSearchIndex(table)
+            self.CreateStatistics(table)
+
+
+    def CreateSearchIndex(self, table = None):
+        # Create the full text search index of the company table (by default self.table), filling it
+        # from the table, and the triggers keeping it in step, if not already existing.
+        # The index is filled in one statement after a bulk load rather than row by row, which is
+        # why CreateTable leaves it to CreateIndexes.
+        if table is None:
+            table = self.table
+        search = "%sSearch" % table
+
+        with self.Writer() as connection, connection:
+            if self.TableExists(search):
+                return
+
+            # Prefix indexes of 2 and 3 characters serve the typeahead without scanning the terms.
+            sql = 'CREATE VIRTUAL TABLE %s USING fts5' % search
+            sql += "(companyName, description, tagline, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3');"
+            # print("Executing SQL statement [%s]" % sql)
+            connection.execute(sql)
+
+            sql = 'INSERT INTO %s (rowid, companyName, description, tagline) ' % search
+            sql += 'SELECT id, companyName, description, tagline FROM %s;' % table
+            connection.execute(sql)
+
+            # Renaming the tables also renames them within the triggers, so the triggers follow a swap.
+            sql = 'CREATE TRIGGER %s_search_insert AFTER INSERT ON %s BEGIN' % (table, table)
+            sql += ' INSERT INTO %s (rowid, companyName, description, tagline)' % search
+            sql += ' VALUES (new.id, new.companyName, new.description, new.tagline);'
+            sql += ' END;'
+            connection.execute(sql)
+
+            sql = 'CREATE TRIGGER %s_search_delete AFTER DELETE ON %s BEGIN' % (table, table)
+            sql += ' DELETE FROM %s WHERE rowid = old.id;' % search
+            sql += ' END;'
+            connection.execute(sql)
+
+            sql = 'CREATE TRIGGER %s_search_update AFTER UPDATE OF id, companyName, description, tagline ON %s BEGIN' % (table, table)
+            sql += ' DELETE FROM %s WHERE rowid = old.id;' % search
+            sql += ' INSERT INTO %s (rowid, companyName, description, tagline)' % search
+            sql += ' VALUES (new.id, new.companyName, new.description, new.tagline);'
+            sql += ' END;'
+            connection.execute(sql)
+
+
+    def CreateStatistics(self, table = None):
+        # Create the statistics of the company table (by default self.table), filled from the table,
+        # and the triggers keeping them in step, if not already existing.
+        # A deleted or renumbered lowest / highest id is found again through the id index rather
+        # than by a scan.
+        if table is None:
+            table = self.table
+        stats = "%sStats" % table
+
+        with self.Writer() as connection, connection:
+            if self.TableExists(stats):
+                return
+
+            sql = 'CREATE TABLE %s ' % stats
+            sql += '(total INTEGER NOT NULL'
+            sql += ', restricted INTEGER NOT NULL'
+            sql += ', unrestricted INTEGER NOT NULL'
+            sql += ', minId INTEGER'
+            sql += ', maxId INTEGER'
+            sql += ');'
+            # print("Executing SQL statement [%s]" % sql)
+            connection.execute(sql)
+
+            sql = 'INSERT INTO %s (total, restricted, unrestricted, minId, maxId) ' % stats
+            sql += 'SELECT count(*), total(restricted = 1), total(restricted <> 1), min(id), max(id) FROM %s;' % table
+            connection.execute(sql)
+
+            sql = 'CREATE TRIGGER %s_stats_insert AFTER INSERT ON %s BEGIN' % (table, table)
+            sql += ' UPDATE %s SET total = total + 1' % stats
+            sql += ', restricted = restricted + (new.restricted = 1), unrestricted = unrestricted + (new.restricted <> 1)'
+            sql += ', minId = min(coalesce(minId, new.id), new.id), maxId = max(coalesce(maxId, new.id), new.id);'
+            sql += ' END;'
+            connection.execute(sql)
+
+            sql = 'CREATE TRIGGER %s_stats_delete AFTER DELETE ON %s BEGIN' % (table, table)
+            sql += ' UPDATE %s SET total = total - 1' % stats
+            sql += ', restricted = restricted - (old.restricted = 1), unrestricted = unrestricted - (old.restricted <> 1)'
+            sql += ', minId = CASE WHEN old.id = minId THEN (SELECT min(id) FROM %s) ELSE minId END' % table
+            sql += ', maxId = CASE WHEN old.id = maxId THEN (SELECT max(id) FROM %s) ELSE maxId END;' % table
+            sql += ' END;'
+            connection.execute(sql)
+
+            sql = 'CREATE TRIGGER %s_stats_update AFTER UPDATE OF id, restricted ON %s BEGIN' % (table, table)
+            sql += ' UPDATE %s SET' % stats
+            sql += ' restricted = restricted + (new.restricted = 1) - (old.restricted = 1)'
+            sql += ', unrestricted = unrestricted + (new.restricted <> 1) - (old.restricted <> 1)'
+            sql += ', minId = CASE WHEN old.id <> new.id THEN (SELECT min(id) FROM %s) ELSE minId END' % table
+            sql += ', maxId = CASE WHEN old.id <> new.id THEN (SELECT max(id) FROM %s) ELSE maxId END;' % table
+            sql += ' END;'
+            connection.execute(sql)
+
+
+    def CreateTable(self, table = None, indexes = True):
+        # Create the company table (by default self.table) with its unique business number index and,
+        # unless told otherwise, its other indexes (see CreateIndexes), if not already existing, along
+        # with the restricted status change log.
+        if table is None:
+            table = self.table
+
+        with self.Writer() as connection:
+            sql = 'CREATE TABLE IF NOT EXISTS %s ' % table
+            sql += '(pkID INTEGER PRIMARY KEY'
+            sql += ', id INTEGER UNIQUE NOT NULL'
+            sql += ', companyName TEXT NOT NULL'
+            sql += ', description TEXT'
+            sql += ', tagline TEXT'
+            sql += ', companyEmail TEXT'
+            sql += ', businessNumber TEXT'
+            sql += ', restricted INTEGER DEFAULT 0'
+            sql += ', businessNumberDigits TEXT'
+            sql += ', contentHash INTEGER'
+            sql += ');'
+            # print("Executing SQL statement [%s]" % sql)
+            connection.execute(sql)
+
+            # Exact match searches by business number use the normalised digits. The index is created
+            # with the table, as it is a constraint - a company clashing with another is not loaded.
+            self.CreateIndex(connection, table, "businessNumberDigits", ("businessNumberDigits", ), unique = True)
+
+            if indexes:
+                self.CreateIndexes(table)
+
+            # The change log belongs to the company data rather than a particular table, so is
+            # named for self.table and kept when the table is recreated.
+            sql = 'CREATE TABLE IF NOT EXISTS %sChangeLog ' % self.table
+            sql += '(changeID INTEGER PRIMARY KEY'
+            sql += ', id INTEGER NOT NULL'
+            sql += ', oldRestricted INTEGER'
+            sql += ', newRestricted INTEGER'
+            sql += ", changedAt TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))"
+            sql += ');'
+            # print("Executing SQL statement [%s]" % sql)
+            connection.execute(sql)
+
+            # As is the meta data, a single row.
+            sql = 'CREATE TABLE IF NOT EXISTS %sMeta ' % self.table
+            sql += '(epoch TEXT NOT NULL'
+            sql += ', generation INTEGER NOT NULL'
+            sql += ', modifiedAt REAL NOT NULL'
+            sql += ');'
+            # print("Executing SQL statement [%s]" % sql)
+            connection.execute(sql)
+
+            sql = 'INSERT INTO %sMeta (epoch, generation, modifiedAt) ' % self.table
+            sql += 'SELECT ?, 0, ? WHERE NOT EXISTS (SELECT 1 FROM %sMeta);' % self.table
+            connection.execute(sql, (os.urandom(4).hex(), time.time()))
+
+            # And the streaming load checkpoints, which must outlive a recreated table.
+            sql = 'CREATE TABLE IF NOT EXISTS %sIngest ' % self.table
+            sql += '(source TEXT PRIMARY KEY'
+            sql += ', identity TEXT NOT NULL'
+            sql += ', offset INTEGER NOT NULL'
+            sql += ', rowsRead INTEGER NOT NULL'
+            sql += ', loaded INTEGER NOT NULL'
+            sql += ', rejected INTEGER NOT NULL'
+            sql += ', rejectBytes INTEGER NOT NULL'
+            sql += ', complete INTEGER NOT NULL'
+            sql += ', updatedAt REAL NOT NULL'
+            sql += ');'
+            # print("Executing SQL statement [%s]" % sql)
+            connection.execute(sql)
+
+
+    def DataVersion(self):
+        # A value that changes whenever the database has been changed, by this or any other process.
+        # Used to tell when anything built from the data (e.g. cached responses) is out of date.
+        with self.watchLock:
+            if self.watcher is None:
+                self.watcher = self.OpenConnection(apsw.SQLITE_OPEN_READONLY)
+            for x in self.watcher.execute("PRAGMA data_version;"):
+                return x[0]
+
+
+    def Generation(self):
+        # The generation of the companies as (epoch, generation, modifiedAt) - see <table>Meta - or None
+        # if the database has no meta data.
+        # The meta data is only read when the data version shows the database has changed, so an
+        # unchanged database is not queried.
+        version = self.DataVersion()
+        if self.generation is not None and self.generation[0] == version:
+            return self.generation[1]
+
+        value = None
+        with self.Reader() as connection:
+            try:
+                for x in connection.execute("SELECT epoch, generation, modifiedAt FROM %sMeta;" % self.table):
+                    value = x
+            except apsw.SQLError:
+                # No meta data table.
+                pass
+
+        self.generation = (version, value)
+        return value
+
+
+    def GetCompaniesByBusinessNumbers(self, businessNumbers):
+        # Get the companies matching a list of business numbers in a single query.
+        # The business numbers must already be normalised to digits only.
+        # Returns a dictionary of rows keyed by the normalised business number.
+        # print("CompanyDB.GetCompaniesByBusinessNumbers: businessNumbers [%s]" % businessNumbers)
+
+        # The list is bound as a single JSON array parameter, so the statement text
+        # stays the same however many business numbers are requested.
+        sql = "SELECT id, companyName, description, tagline, companyEmail, businessNumber, restricted, businessNumberDigits"
+        sql += " FROM %s" % self.table
+        sql += " WHERE businessNumberDigits IN (SELECT value FROM json_each(?));"
+        # print("Executing SQL statement [%s]" % sql)
+
+        rows = {}
+        with self.Reader() as connection:
+            for x in connection.execute(sql, (json.dumps(list(businessNumbers)), )):
+                rows[x[7]] = x
+
+        # Return the result.
+        return rows
+
+
+    def GetCompaniesByIds(self, ids):
+        # Get the companies matching a list of ids in a single query.
+        # The ids must already be checked as digits.
+        # Returns a dictionary of rows keyed by the integer id.
+        # print("CompanyDB.GetCompaniesByIds: ids [%s]" % ids)
+
+        # The list is bound as a single JSON array parameter, so the statement text
+        # stays the same however many ids are requested.
+        sql = "SELECT id, companyName, description, tagline, companyEmail, businessNumber, restricted"
+        sql += " FROM %s" % self.table
+        sql += " WHERE id IN (SELECT value FROM json_each(?));"
+        # print("Executing SQL statement [%s]" % sql)
+
+        rows = {}
+        with self.Reader() as connection:
+            for x in connection.execute(sql, (json.dumps([int(id) for id in ids]), )):
+                rows[x[0]] = x
+
+        # Return the result.
+        return rows
+
+
+    def GetCompanyByBusinessNumber(self, businessNumber):
+        # Get a specific company by its business number and return its details.
+        # The business number must already be normalised to digits only.
+        # print("CompanyDB.GetCompanyByBusinessNumber: businessNumber [%s]" % businessNumber)
+
+        sql = "SELECT id, companyName, description, tagline, companyEmail, businessNumber, restricted"
+        sql += " FROM %s" % self.table
+        sql += " WHERE businessNumberDigits = ?;"
+        # print("Executing SQL statement [%s]" % sql)
+
+        row = []
+        with self.Reader() as connection:
+            for x in connection.execute(sql, (businessNumber, )):
+                row = x
+
+        # Return the result.
+        return row
 
 
     def GetCompanyById(self, id):
@@ -88,71 +606,709 @@ class CompanyDB:
 
         # Guard against injected SQL - make sure we have digits and nothing more.
         row = []
-        if id.isdigit() != True:
+        if (id.isascii() and id.isdigit()) != True:
+            return row
+
+        # The id is bound as a parameter, so the statement text is the same for every id.
+        if int(id) > self.maxInteger:
             return row
 
         sql = "SELECT id, companyName, description, tagline, companyEmail, businessNumber, restricted"
         sql += " FROM %s" % self.table
-        sql += " WHERE id = %s;" % str(id)
+        sql += " WHERE id = ?;"
         # print("Executing SQL statement [%s]" % sql)
 
-        for x in cursor.execute(sql):
-            if x[0] != "":
-                row = x
+        with self.Reader() as connection:
+            for x in connection.execute(sql, (int(id), )):
+                if x[0] != "":
+                    row = x
         # print("CompanyDB.GetCompanyById: row [%s]" % row)
 
         # Return the result.
         return row
 
 
-    def GetCompanyList(self, offset, count = 100, restricted = None):
+    def GetCompanyList(self, offset, count = 100, restricted = None, after = None):
         # Get a list of companies:
         #     matching the restricted flag if supplied,
         #     starting at offset in the SQL query result,
+        #     or if after is supplied, starting at the first company with an id greater than after,
         #     to a maximum of count companies.
+        # Seeking from after uses the id / (restricted, id) indexes, so the cost of a page does not
+        # grow with its depth in the list as an OFFSET does.
         # restrict = "All" if restricted is None else str(restricted)
-        # print("CompanyDB.GetCompanyList: offset [%s] count [%s] restrict [%s]" % (offset, count, restrict) )
+        # print("CompanyDB.GetCompanyList: offset [%s] count [%s] restrict [%s] after [%s]" % (offset, count, restrict, after) )
 
         # Guard against injected SQL - make sure we have digits and nothing more.
         rows = {}
-        okay = offset.isdigit() and count.isdigit() and ( restricted is None or restricted.isdigit() )
+        okay = offset.isascii() and offset.isdigit() and count.isascii() and count.isdigit()
+        okay = okay and ( restricted is None or ( restricted.isascii() and restricted.isdigit() ) )
+        okay = okay and ( after is None or ( after.isascii() and after.isdigit() ) )
         if okay == False:
             return rows
 
+        # The values are bound as parameters, so there are only a few statement texts (with or
+        # without each condition), which stay in the statement cache.
+        conditions = []
+        bindings = []
+        if restricted is not None:
+            conditions.append("restricted = ?")
+            bindings.append(int(restricted))
+        if after is not None:
+            conditions.append("id > ?")
+            bindings.append(min(int(after), self.maxInteger))
+
         sql = "SELECT id, companyName, description, tagline, companyEmail, businessNumber, restricted"
         sql += " FROM %s" % self.table
-        if restricted is not None:
-            sql += " WHERE restricted = %s" % restricted
+        if len(conditions) > 0:
+            sql += " WHERE %s" % " AND ".join(conditions)
         sql += " ORDER BY id"
-        sql += " LIMIT %s" % str(count)
-        sql += " OFFSET %s;" % str(offset)
+        sql += " LIMIT ?"
+        bindings.append(min(int(count), self.maxInteger))
+        if after is None:
+            sql += " OFFSET ?"
+            bindings.append(min(int(offset), self.maxInteger))
+        sql += ";"
         # print("Executing SQL statement [%s]" % sql)
 
-        for x in cursor.execute(sql):
-            if x[0] != "":
-                key = x[0]
-                rows[key] = x
+        with self.Reader() as connection:
+            for x in connection.execute(sql, bindings):
+                if x[0] != "":
+                    key = x[0]
+                    rows[key] = x
         # print("CompanyDB.GetCompanyList: rows [%s]" % rows)
 
         # Return the result.
         return rows
 
 
+    def IngestCheckpoint(self, source):
+        # The checkpoint of the streaming load of source as a dictionary of the <table>Ingest columns,
+        # or None if it has no checkpoint.
+        sql = "SELECT source, identity, offset, rowsRead, loaded, rejected, rejectBytes, complete, updatedAt"
+        sql += " FROM %sIngest WHERE source = ?;" % self.table
+        keys = ("source", "identity", "offset", "rowsRead", "loaded", "rejected", "rejectBytes", "complete", "updatedAt")
+        with self.Writer() as connection:
+            try:
+                for x in connection.execute(sql, (source, )):
+                    return dict(zip(keys, x))
+            except apsw.SQLError:
+                # No checkpoint table.
+                pass
+        return None
+
+
+    def IngestRows(self, rows, source, identity, Checkpoint):
+        # Write a batch of companies, and the checkpoint of the streaming load of source they were
+        # read from, in one transaction, so a load resumed from the checkpoint neither misses nor
+        # repeats a company.
+        # A company conflicting with one in the table (the same id or business number) is not written.
+        # Checkpoint is called within the transaction with a list of the (row, error) of those companies,
+        # and returns the checkpoint to record as a dictionary of the <table>Ingest columns from offset.
+        # Rows are dictionaries as for AddNewCompany.
+        # Returns the number of companies written.
+        sql = self.InsertStatement()
+
+        with self.Writer() as connection, connection:
+            rejected = self.WriteRows(connection, sql, rows)
+            self.WriteIngestCheckpoint(connection, source, identity, Checkpoint(rejected))
+            self.BumpGeneration(connection)
+
+        return len(rows) - len(rejected)
+
+
+    def InsertStatement(self, table = None):
+        # The SQL statement to insert a company into the table (by default self.table), with the
+        # values bound in RowValues order.
+        sql = "INSERT INTO %s (id, companyName, description, tagline, companyEmail, businessNumber, restricted, businessNumberDigits, contentHash) " % (self.table if table is None else table)
+        sql += "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"
+        return sql
+
+
+    def IterCompanies(self, restricted = None):
+        # Generate every company, in id order, matching the restricted flag if supplied.
+        # Rows are read one at a time from the cursor, so memory use does not depend on the
+        # number of companies. A read connection is held until the generator is exhausted
+        # or closed, and is not tied to a thread, so the generator may be resumed by any thread.
+        # print("CompanyDB.IterCompanies: restricted [%s]" % restricted)
+        sql = "SELECT id, companyName, description, tagline, companyEmail, businessNumber, restricted"
+        sql += " FROM %s" % self.table
+        if restricted is not None:
+            sql += " WHERE restricted = ?"
+        sql += " ORDER BY id;"
+        # print("Executing SQL statement [%s]" % sql)
+
+        bindings = () if restricted is None else (int(restricted), )
+        connection = self.BorrowReader()
+        try:
+            for x in connection.execute(sql, bindings):
+                yield x
+        finally:
+            self.ReturnReader(connection)
+
+
+    @contextmanager
+    def LoadPragmas(self):
+        # Apply the bulk load PRAGMA settings to the writer, restoring the previous values on exit.
+        with self.Writer() as connection:
+            previous = {}
+            for pragma in self.loadPragmas:
+                for x in connection.execute("PRAGMA %s;" % pragma):
+                    previous[pragma] = x[0]
+
+            try:
+                for pragma, value in self.loadPragmas.items():
+                    connection.execute("PRAGMA %s = %s;" % (pragma, value))
+                yield
+            finally:
+                for pragma, value in previous.items():
+                    connection.execute("PRAGMA %s = %s;" % (pragma, value))
+
+
+    @staticmethod
+    def MatchExpression(text, prefix = False):
+        # Build an FTS5 MATCH expression finding every word of the text, so the text can hold
+        # anything a user types without being taken as FTS5 query syntax.
+        # If prefix is set the last word also matches the start of a longer word, for typeahead.
+        # Returns None if the text has no words.
+        words = re.findall(r"\w+", text)
+        if len(words) == 0:
+            return None
+        terms = ['"%s"' % word for word in words]
+        if prefix:
+            terms[-1] += "*"
+        return " ".join(terms)
+
+
+    @staticmethod
+    def NormaliseBusinessNumber(businessNumber):
+        # Reduce a business number to its digits, so 88-3175292 is held as 883175292.
+        # An empty result is returned as None so it is not caught by the unique index.
+        digits = "".join(c for c in str(businessNumber) if c.isascii() and c.isdigit())
+        return digits if digits != "" else None
+
+
+    def OpenConnection(self, flags = None):
+        # Open a new connection to the database.
+        # A read only or immutable database is opened by URI, so the database is never created
+        # and the immutable parameter can be given.
+        if self.readOnly:
+            uri = "file:%s?mode=ro" % urllib.request.pathname2url(os.path.abspath(self.database))
+            if self.immutable:
+                uri += "&immutable=1"
+            connection = apsw.Connection(uri, flags = apsw.SQLITE_OPEN_READONLY | apsw.SQLITE_OPEN_URI)
+        elif flags is None:
+            connection = apsw.Connection(self.database)
+        else:
+            connection = apsw.Connection(self.database, flags = flags)
+        connection.setbusytimeout(self.busyTimeout)
+        if self.profiler is not None:
+            self.profiler.Attach(connection)
+        if self.mmapSize > 0:
+            connection.execute("PRAGMA mmap_size = %d;" % int(self.mmapSize))
+        return connection
+
+
+    def Optimize(self, analyze = False):
+        # Refresh the statistics the query planner chooses indexes by, so the first queries after
+        # a load are planned as well as later ones.
+        # analyze       runs a full ANALYZE of the database, otherwise PRAGMA optimize analyzes only the
+        #               tables whose statistics are missing or out of date, which is usually quicker.
+        # The statistics are written to the database, so it must not be opened readOnly.
+        sql = "ANALYZE;" if analyze else "PRAGMA optimize = 0x10002;"
+        # print("Executing SQL statement [%s]" % sql)
+        with self.Writer() as connection:
+            connection.execute(sql)
+
+
+    def Pretouch(self):
+        # Read every page of the table and of each of its indexes once, so the first requests find
+        # them in the OS page cache (shared through a memory map, if mmapSize is set) rather than
+        # waiting on the disk, and so the reader has prepared its first statements.
+        # Returns the number of indexes read.
+        sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?;"
+        with self.Reader() as connection:
+            indexes = [x[0] for x in connection.execute(sql, (self.table, ))]
+
+            # A count reads every page of the b-tree it counts.
+            list(connection.execute("SELECT count(*) FROM %s NOT INDEXED;" % self.table))
+            for index in indexes:
+                list(connection.execute("SELECT count(*) FROM %s INDEXED BY %s;" % (self.table, index)))
+
+        # The statistics row read for every list page.
+        self.Statistics()
+        return len(indexes)
+
+
+    def Profile(self):
+        # The statement profile of the profiler given on instantiation (see CompanyProfiler.Report),
+        # with the query plan of each statement shape, or an empty list if there is no profiler.
+        if self.profiler is None:
+            return []
+        with self.Reader() as connection:
+            self.profiler.Explain(connection)
+        return self.profiler.Report()
+
+
+    def PublishSnapshot(self, path):
+        # Publish a compacted copy of the database to path, for immutable read only serving.
+        # The copy is written beside path and renamed over it, so a server watching path sees
+        # either the old or the new snapshot, never a partial one. The copy is in rollback
+        # journal mode, needing no -wal / -shm files.
+        # Returns the size of the snapshot in bytes.
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with self.Reader() as connection:
+                connection.execute("VACUUM INTO ?;", (temporary, ))
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return os.path.getsize(path)
+
+
+    @contextmanager
+    def Reader(self):
+        # Lend a read connection from the pool to the calling thread for the duration of a query.
+        # A thread already holding a read connection carries on using it, and a thread that
+        # finds all poolSize connections in use waits for one to be returned.
+        connection = getattr(self.local, "reader", None)
+        if connection is not None:
+            yield connection
+            return
+
+        connection = self.BorrowReader()
+        self.local.reader = connection
+        try:
+            yield connection
+        finally:
+            self.local.reader = None
+            self.ReturnReader(connection)
+
+
+    def RebuildTable(self, rows, batchSize = 10000, minFraction = 0.0, Reject = None):
+        # Replace the table with an iterable of companies, without readers ever seeing a partial
+        # or empty table.
+        # The companies are loaded into a shadow table, its indexes built, and its row count checked
+        # against the number loaded and, if minFraction is set, against that fraction of the current
+        # table's count (guarding against a truncated feed). It is then swapped in within one
+        # transaction, keeping the replaced table for RollbackTable.
+        # Writes through this instance wait until the rebuild is complete. A write by another process
+        # (or instance) during the load would be lost by the swap, so the generation is recorded before
+        # the load and checked again within the swap, the rebuild being abandoned if it has changed.
+        # A company conflicting with another is not loaded, and passed to Reject as for BulkLoad.
+        # Rows are dictionaries as for AddNewCompany.
+        # Returns the number of companies in the new table.
+        shadow = "%sBuild%d" % (self.table, time.time_ns() // 1000)
+        previous = "%sPrevious" % self.table
+        # print("CompanyDB.RebuildTable: shadow [%s]" % shadow)
+
+        generationSQL = "SELECT generation FROM %sMeta;" % self.table
+
+        with self.Writer() as connection:
+            self.CreateTable(shadow, indexes = False)
+            try:
+                generation = list(connection.execute(generationSQL))
+                loaded = self.BulkLoad(rows, batchSize, shadow, Reject = Reject)
+
+                count = self.CountRows(shadow)
+                if count != loaded:
+                    raise ValueError("Rebuild of [%s] loaded [%d] rows but the table holds [%d]" % (self.table, loaded, count))
+
+                current = self.CountRows() if self.TableExists(self.table) else 0
+                if count < current * minFraction:
+                    raise ValueError("Rebuild of [%s] has [%d] rows, less than [%s] of the current [%d] rows" % (self.table, count, minFraction, current))
+
+                # Swap the shadow table, and the tables belonging to it, in.
+                with connection:
+                    if list(connection.execute(generationSQL)) != generation:
+                        raise ValueError("Rebuild of [%s] abandoned as the table was changed during the rebuild" % self.table)
+                    for suffix in self.tableSuffixes:
+                        connection.execute("DROP TABLE IF EXISTS %s%s;" % (previous, suffix))
+                        if self.TableExists(self.table + suffix):
+                            connection.execute("ALTER TABLE %s%s RENAME TO %s%s;" % (self.table, suffix, previous, suffix))
+                        connection.execute("ALTER TABLE %s%s RENAME TO %s%s;" % (shadow, suffix, self.table, suffix))
+                    self.BumpGeneration(connection)
+
+            except BaseException:
+                for suffix in self.tableSuffixes:
+                    connection.execute("DROP TABLE IF EXISTS %s%s;" % (shadow, suffix))
+                raise
+
+        self.CountRows()
+        return count
+
+
     def RecreateTable(self):
-        # Drop the table if it already exists.
-        sql = 'DROP TABLE IF EXISTS %s' % self.table
-        cursor.execute(sql)
+        with self.Writer() as connection:
+            # Drop the table if it already exists, along with any previous generation kept by
+            # RebuildTable, whose index names would otherwise clash with the new table's.
+            # The tables belonging to them are dropped with them.
+            for table in (self.table, "%sPrevious" % self.table):
+                for suffix in self.tableSuffixes:
+                    sql = 'DROP TABLE IF EXISTS %s%s' % (table, suffix)
+                    connection.execute(sql)
     
-        # Create the table is not already existing.
-        sql = 'CREATE TABLE IF NOT EXISTS %s ' % self.table
-        sql += '(pkID INTEGER PRIMARY KEY'
-        sql += ', id INTEGER UNIQUE NOT NULL'
-        sql += ', companyName TEXT NOT NULL'
-        sql += ', description TEXT'
-        sql += ', tagline TEXT'
-        sql += ', companyEmail TEXT'
-        sql += ', businessNumber TEXT'
-        sql += ', restricted INTEGER DEFAULT 0'
-        sql += ');'
+            # Create the table afresh, without the indexes other than the unique ones, which the
+            # load that follows builds once its rows are written.
+            self.CreateTable(indexes = False)
+            self.BumpGeneration(connection)
+
+
+    def ReturnReader(self, connection):
+        # Give a read connection from BorrowReader back to the pool.
+        self.readers.put(connection)
+        self.readerSlots.release()
+
+
+    def RollbackTable(self):
+        # Swap the table kept by the last RebuildTable back in, with the tables belonging to it, in one transaction.
+        # The replaced table is kept in turn, so a rollback can itself be rolled back.
+        # Returns False if there is no previous table.
+        previous = "%sPrevious" % self.table
+        swap = "%sSwap" % self.table
+
+        with self.Writer() as connection:
+            if self.TableExists(previous) == False:
+                return False
+
+            with connection:
+                for suffix in self.tableSuffixes:
+                    if self.TableExists(self.table + suffix) and self.TableExists(previous + suffix):
+                        connection.execute("ALTER TABLE %s%s RENAME TO %s%s;" % (self.table, suffix, swap, suffix))
+                        connection.execute("ALTER TABLE %s%s RENAME TO %s%s;" % (previous, suffix, self.table, suffix))
+                        connection.execute("ALTER TABLE %s%s RENAME TO %s%s;" % (swap, suffix, previous, suffix))
+                self.BumpGeneration(connection)
+
+        self.CountRows()
+        return True
+
+
+    def RowValues(self, row):
+        # Convert the company dictionary to a tuple of values to bind to InsertStatement.
+        values = (row["id"], row["companyName"], row["description"], row["tagline"],
+                  row["companyEmail"], row["businessNumber"], row["restricted"])
+        return values + (self.NormaliseBusinessNumber(row["businessNumber"]), self.ContentHash(values))
+
+
+    def SearchCompanies(self, query, offset, count = 20, restricted = None):
+        # Get the companies whose name, description or tagline hold every word of the query:
+        #     matching the restricted flag if supplied,
+        #     best match first, a match in the name counting for more than in the tagline or description,
+        #     starting at offset in the ranked result,
+        #     to a maximum of count companies.
+        # Returns a list of rows, empty if the query has no words.
+        # print("CompanyDB.SearchCompanies: query [%s] offset [%s] count [%s] restricted [%s]" % (query, offset, count, restricted) )
+        match = self.MatchExpression(query)
+        if match is None:
+            return []
+
+        search = "%sSearch" % self.table
+        sql = "SELECT c.id, c.companyName, c.description, c.tagline, c.companyEmail, c.businessNumber, c.restricted"
+        sql += " FROM %s JOIN %s AS c ON c.id = %s.rowid" % (search, self.table, search)
+        sql += " WHERE %s MATCH ?" % search
+        bindings = [match]
+        if restricted is not None:
+            sql += " AND c.restricted = ?"
+            bindings.append(int(restricted))
+        sql += " ORDER BY bm25(%s, 10.0, 1.0, 2.0), c.id" % search
+        sql += " LIMIT ? OFFSET ?;"
+        bindings += [min(int(count), self.maxInteger), min(int(offset), self.maxInteger)]
         # print("Executing SQL statement [%s]" % sql)
-        cursor.execute(sql)
+
+        with self.Reader() as connection:
+            rows = list(connection.execute(sql, bindings))
+
+        # Return the result.
+        return rows
+
+
+    def StartIngest(self, source, identity, offset, recreate = True):
+        # Start a streaming load of source from offset, recreating the table first if recreate is set.
+        # The table is recreated in the same transaction as the first checkpoint is written, so a load
+        # interrupted at any point never resumes into a table it did not start.
+        with self.Writer() as connection, connection:
+            if recreate:
+                self.RecreateTable()
+            else:
+                self.CreateTable()
+            checkpoint = { "offset" : offset, "rowsRead" : 0, "loaded" : 0, "rejected" : 0, "rejectBytes" : 0, "complete" : 0 }
+            self.WriteIngestCheckpoint(connection, source, identity, checkpoint)
+
+
+    def Statistics(self, table = None):
+        # The statistics of the companies in the table (by default self.table) as a dictionary of
+        # total, restricted, unrestricted, minId and maxId - see <table>Stats.
+        # A table without the statistics, created before they were kept, is counted instead.
+        if table is None:
+            table = self.table
+
+        sql = 'SELECT total, restricted, unrestricted, minId, maxId FROM %sStats;' % table
+        # print("Executing SQL statement [%s]" % sql)
+        with self.Reader() as connection:
+            try:
+                rows = list(connection.execute(sql))
+            except apsw.SQLError:
+                sql = 'SELECT count(*), total(restricted = 1), total(restricted <> 1), min(id), max(id) FROM %s;' % table
+                rows = list(connection.execute(sql))
+
+        keys = ("total", "restricted", "unrestricted", "minId", "maxId")
+        return dict((key, None if value is None else int(value)) for key, value in zip(keys, rows[0]))
+
+
+    def SyncBatch(self, connection, sql, batch, restrictedIds, counts, Reject):
+        # Write a batch of new or changed companies for SyncRows, with their changes of restricted
+        # status, in one transaction.
+        # Batch is a list of (row, kind), kind being "inserted" or "updated".
+        # A company conflicting with another (the same business number) is not written, nor counted
+        # but as rejected, and is passed to Reject.
+        logSQL = "INSERT INTO %sChangeLog (id, oldRestricted, newRestricted) VALUES (?, ?, ?);" % self.table
+
+        with connection:
+            rejected = self.WriteRows(connection, sql, [row for row, kind in batch])
+            rejectedIds = set(int(row["id"]) for row, error in rejected)
+
+            changes = []
+            for row, kind in batch:
+                id = int(row["id"])
+                if id in rejectedIds:
+                    continue
+                counts[kind] += 1
+                restricted = int(row["restricted"])
+                oldRestricted = None if kind == "inserted" else (1 if id in restrictedIds else 0)
+                if oldRestricted != restricted:
+                    changes.append((id, oldRestricted, restricted))
+
+            connection.executemany(logSQL, changes)
+            self.BumpGeneration(connection)
+
+        counts["rejected"] += len(rejected)
+        if Reject is not None:
+            for row, error in rejected:
+                Reject(row, error)
+
+
+    def SyncRows(self, rows, deleteMissing = False, batchSize = 10000, Reject = None):
+        # Bring the table up to date with an iterable of companies, rather than reloading it.
+        # Each company's contentHash is compared with the table, and only new or changed companies
+        # are written (as upserts), in transactions of batchSize companies.
+        # Companies in the table but not in rows are deleted if deleteMissing is set.
+        # Changes to restricted status, including new and deleted companies, are recorded in the change log.
+        # A company conflicting with another (the same business number) is not written, and is passed
+        # to Reject with the error as for BulkLoad.
+        # Rows are dictionaries as for AddNewCompany.
+        # Returns the counts of companies inserted, updated, unchanged, deleted and rejected.
+        # print("CompanyDB.SyncRows: deleteMissing [%s] batchSize [%d]" % (deleteMissing, batchSize) )
+        self.CreateTable()
+
+        sql = self.UpsertStatement()
+        logSQL = "INSERT INTO %sChangeLog (id, oldRestricted, newRestricted) VALUES (?, ?, ?);" % self.table
+        deleteSQL = "DELETE FROM %s WHERE id = ?;" % self.table
+
+        counts = { "inserted" : 0, "updated" : 0, "unchanged" : 0, "deleted" : 0, "rejected" : 0 }
+
+        with self.Writer() as connection:
+            # The current hash of every company, and which are restricted.
+            existing = {}
+            restrictedIds = set()
+            for x in connection.execute("SELECT id, contentHash, restricted FROM %s;" % self.table):
+                existing[x[0]] = x[1]
+                if x[2] == 1:
+                    restrictedIds.add(x[0])
+
+            seen = set()
+            batch = []
+            for row in rows:
+                id = int(row["id"])
+                seen.add(id)
+
+                if id not in existing:
+                    batch.append((row, "inserted"))
+                elif existing[id] != self.RowValues(row)[8]:
+                    batch.append((row, "updated"))
+                else:
+                    counts["unchanged"] += 1
+                    continue
+
+                if len(batch) >= batchSize:
+                    self.SyncBatch(connection, sql, batch, restrictedIds, counts, Reject)
+                    batch = []
+
+            if len(batch) > 0:
+                self.SyncBatch(connection, sql, batch, restrictedIds, counts, Reject)
+
+            if deleteMissing:
+                missing = [id for id in existing if id not in seen]
+                for start in range(0, len(missing), batchSize):
+                    ids = missing[start:start + batchSize]
+                    with connection:
+                        connection.executemany(deleteSQL, ((id, ) for id in ids))
+                        connection.executemany(logSQL, ((id, 1 if id in restrictedIds else 0, None) for id in ids))
+                        self.BumpGeneration(connection)
+                counts["deleted"] = len(missing)
+
+        return counts
+
+
+    def TableExists(self, table):
+        # Check whether the table exists in the database.
+        with self.Writer() as connection:
+            for x in connection.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?;", (table, )):
+                return x[0] > 0
+
+
+    def TypeaheadCompanies(self, prefix, count = 10, restricted = None):
+        # Get the companies whose name holds every word of prefix, the last word only needing to
+        # start a word of the name, matching the restricted flag if supplied, best match first,
+        # to a maximum of count companies.
+        # Returns a list of (id, companyName, restricted) rows, empty if the prefix has no words.
+        # print("CompanyDB.TypeaheadCompanies: prefix [%s] count [%s] restricted [%s]" % (prefix, count, restricted) )
+        match = self.MatchExpression(prefix, prefix = True)
+        if match is None:
+            return []
+
+        search = "%sSearch" % self.table
+        sql = "SELECT c.id, c.companyName, c.restricted"
+        sql += " FROM %s JOIN %s AS c ON c.id = %s.rowid" % (search, self.table, search)
+        sql += " WHERE %s MATCH ?" % search
+        bindings = ["{companyName} : (%s)" % match]
+        if restricted is not None:
+            sql += " AND c.restricted = ?"
+            bindings.append(int(restricted))
+        sql += " ORDER BY rank, c.id"
+        sql += " LIMIT ?;"
+        bindings.append(min(int(count), self.maxInteger))
+        # print("Executing SQL statement [%s]" % sql)
+
+        with self.Reader() as connection:
+            rows = list(connection.execute(sql, bindings))
+
+        # Return the result.
+        return rows
+
+
+    def UpsertRows(self, rows):
+        # Insert or update a batch of companies, as pushed to the Web API, in one transaction.
+        # As SyncRows, only new or changed companies are written, and changes to restricted status
+        # are recorded in the change log.
+        # The batch is written whole or not at all: if any company conflicts with another (the same
+        # business number as a different company) the transaction is rolled back.
+        # Rows are dictionaries as for AddNewCompany, each with a different id.
+        # Returns a list of (status, error) in row order, the status being "inserted", "updated" or
+        # "unchanged", or if the batch was rolled back "conflict" (with the error) or "skipped".
+        # print("CompanyDB.UpsertRows: rows [%d]" % len(rows))
+        sql = self.UpsertStatement()
+        logSQL = "INSERT INTO %sChangeLog (id, oldRestricted, newRestricted) VALUES (?, ?, ?);" % self.table
+        existingSQL = "SELECT id, contentHash, restricted FROM %s WHERE id IN (SELECT value FROM json_each(?));" % self.table
+
+        values = [self.RowValues(row) for row in rows]
+        statuses = []
+        conflicts = False
+
+        with self.Writer() as connection:
+            try:
+                with connection:
+                    # The current hash and restricted status of the companies in the batch, read
+                    # within the transaction so they cannot change before the batch is written.
+                    existing = {}
+                    for x in connection.execute(existingSQL, (json.dumps([int(value[0]) for value in values]), )):
+                        existing[x[0]] = (x[1], x[2])
+
+                    batch = []
+                    changes = []
+                    for value in values:
+                        id = int(value[0])
+                        restricted = int(value[6])
+                        if id not in existing:
+                            statuses.append(("inserted", None))
+                            changes.append((id, None, restricted))
+                        elif existing[id][0] != value[8]:
+                            statuses.append(("updated", None))
+                            if existing[id][1] != restricted:
+                                changes.append((id, existing[id][1], restricted))
+                        else:
+                            statuses.append(("unchanged", None))
+                            continue
+                        batch.append(value)
+
+                    try:
+                        with connection:
+                            connection.executemany(sql, batch)
+                    except apsw.ConstraintError:
+                        # Write the companies one at a time to find those in conflict, then roll back.
+                        statuses = []
+                        for value in values:
+                            try:
+                                with connection:
+                                    connection.execute(sql, value)
+                                statuses.append(("skipped", None))
+                            except apsw.ConstraintError as e:
+                                statuses.append(("conflict", str(e)))
+                        conflicts = True
+                        raise
+
+                    connection.executemany(logSQL, changes)
+                    if len(batch) > 0:
+                        self.BumpGeneration(connection)
+            except apsw.ConstraintError:
+                if conflicts == False:
+                    raise
+
+        return statuses
+
+
+    def UpsertStatement(self):
+        # The SQL statement to insert a company, or update the company with the same id, with the
+        # values bound in RowValues order.
+        sql = self.InsertStatement().rstrip(";")
+        sql += " ON CONFLICT(id) DO UPDATE SET companyName = excluded.companyName, description = excluded.description"
+        sql += ", tagline = excluded.tagline, companyEmail = excluded.companyEmail, businessNumber = excluded.businessNumber"
+        sql += ", restricted = excluded.restricted, businessNumberDigits = excluded.businessNumberDigits"
+        sql += ", contentHash = excluded.contentHash;"
+        return sql
+
+
+    def WriteIngestCheckpoint(self, connection, source, identity, checkpoint):
+        # Record the checkpoint of the streaming load of source, within the writer's transaction.
+        sql = "INSERT OR REPLACE INTO %sIngest" % self.table
+        sql += " (source, identity, offset, rowsRead, loaded, rejected, rejectBytes, complete, updatedAt)"
+        sql += " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"
+        connection.execute(sql, (source, identity, checkpoint["offset"], checkpoint["rowsRead"], checkpoint["loaded"],
+                                 checkpoint["rejected"], checkpoint["rejectBytes"], checkpoint["complete"], time.time()))
+
+
+    def WriteRows(self, connection, sql, rows):
+        # Write a batch of companies by one executemany, within the writer's transaction, leaving out
+        # any company conflicting with one in the table (the same id or business number).
+        # If the batch conflicts it is written again one company at a time, each in its own savepoint,
+        # to find those in conflict.
+        # Rows are dictionaries as for AddNewCompany.
+        # Returns a list of the (row, error) of the companies not written.
+        values = [self.RowValues(row) for row in rows]
+        rejected = []
+        try:
+            with connection:
+                connection.executemany(sql, values)
+        except apsw.ConstraintError:
+            for row, value in zip(rows, values):
+                try:
+                    with connection:
+                        connection.execute(sql, value)
+                except apsw.ConstraintError as e:
+                    rejected.append((row, str(e)))
+        return rejected
+
+
+    @contextmanager
+    def Writer(self):
+        # Hold the single writer connection, serialising writes across threads.
+        # The writer is opened by the first write, creating the database if need be, and sets
+        # WAL mode, which persists in the file.
+        with self.writeLock:
+            if self.writer is None:
+                self.writer = self.OpenConnection()
+                if self.readOnly == False:
+                    self.writer.execute("PRAGMA journal_mode = WAL;")
+                    self.writer.execute("PRAGMA synchronous = NORMAL;")
+            yield self.writer
@@ -0,0 +1,364 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# CompanyIngest.py
+
+# Python class loading a company CSV file of any size into the database as a
+# stream, so a very large or compressed feed can be loaded with bounded memory,
+# and an interrupted load resumed rather than started again.
+
+# The file may be plain, or compressed with gzip, bzip2 or xz (recognised by its
+# first bytes rather than its name), and is read a line at a time, in batches of
+# batchSize companies.
+
+# Each row is checked before it is loaded:
+# - it has the 7 fields of the heading row,
+# - the id is digits only,
+# - Restricted is Yes or No,
+# and a row failing a check, or conflicting with a company already loaded (the same
+# id or business number), is written to the rejects file with the reason, rather
+# than stopping the load. The rejects file is a CSV file of:
+#   row, offset, reason, followed by the fields of the rejected row
+# where row is the number of the row in the file (the heading is row 0), and offset
+# its byte offset in the decompressed file.
+
+# Each batch is written in one transaction along with a checkpoint in the
+# <table>Ingest table of the byte offset reached, the counts so far, and the size of
+# the rejects file. A load of the same, unchanged, file that has not completed is
+# resumed from its checkpoint: the file is read from the offset, and the rejects file
+# cut back to its size at the checkpoint, so no company or reject is missed or repeated.
+# A compressed file is decompressed up to the offset, but nothing before it is loaded.
+
+# Progress is reported every progressInterval seconds, with the rows per second and
+# the estimated time remaining.
+
+# Parsing:
+
+# The file is split into chunks of about chunkBytes, each ending at the end of a row,
+# which are parsed, checked and converted to company dictionaries by ParseChunk. With
+# workers above 1 the chunks are parsed by a pool of worker processes, while this
+# process, the single writer, loads the parsed rows in file order as they come back.
+# As the chunks do not depend on the number of workers, the companies, rejects and
+# checkpoints are the same whatever the number of workers.
+# The workers share the cores with the writer, so there are never more of them than
+# cores available.
+
+#------------------------------------------------------
+
+import bz2
+import csv
+import gzip
+import io
+import lzma
+import os
+import sys
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from CompanyAPI import CompanyAPI
+
+
+class CompanyIngest:
+
+    # The decompressors of the file formats recognised by their first bytes.
+    compressions = ((b"\x1f\x8b", "gzip", gzip.GzipFile),
+                    (b"BZh", "bzip2", bz2.BZ2File),
+                    (b"\xfd7zXZ\x00", "xz", lzma.LZMAFile))
+
+    # The heading row of the CSV file, and the company dictionary key of each field.
+    heading = ("id", "fake-company-name", "description", "tagline", "company-email", "business number", "Restricted")
+    keys = ("id", "companyName", "description", "tagline", "companyEmail", "businessNumber", "restricted")
+
+    def __init__(self, companyDB, companyAPI, batchSize = 10000, progressInterval = 5.0, output = sys.stdout,
+                 workers = 1, chunkBytes = 1024 * 1024):
+        # Initialise the class with instances of the CompanyDB class, to create the table and read
+        # the checkpoints, and the CompanyAPI class, to load the companies.
+        # batchSize         is the number of companies written per transaction and checkpoint.
+        # progressInterval  is the seconds between progress reports, 0 for none.
+        # output            is the file the progress is reported to.
+        # workers           is the number of processes parsing the file, 1 to parse it in this process.
+        #                   It is limited to the cores this process may run on, as workers without cores
+        #                   of their own only slow the load, so a single core host parses in this process.
+        # chunkBytes        is the size of the chunks the file is split into for parsing.
+        self.companyDB = companyDB
+        self.companyAPI = companyAPI
+        self.batchSize = batchSize
+        self.progressInterval = progressInterval
+        self.output = output
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+        self.workers = max(1, min(workers, cores))
+        self.chunkBytes = chunkBytes
+        self.maxChunkBytes = 64 * chunkBytes
+
+        self.offset = 0
+
+
+    def Checkpoint(self, source, identity):
+        # The checkpoint to resume the load of source from, or None if the load must start afresh
+        # as the file has not been loaded before, has changed, or was loaded completely.
+        checkpoint = self.companyDB.IngestCheckpoint(source)
+        if checkpoint is None or checkpoint["identity"] != identity or checkpoint["complete"] == 1:
+            return None
+        return checkpoint
+
+
+    def Chunks(self, stream):
+        # Generate the rest of the stream from self.offset as (start, data) chunks of about chunkBytes,
+        # each ending at the end of a row, so each can be parsed on its own.
+        # A row ends at a line end with an even number of quotes before it in the chunk, as quotes in
+        # a quoted field come in pairs. A chunk with an unclosed quote is cut at its last line end
+        # once it reaches maxChunkBytes, rather than reading the rest of the file into it.
+        start = self.offset
+        buffer = b""
+        while True:
+            data = stream.read(self.chunkBytes)
+            buffer += data
+            if len(data) == 0:
+                if len(buffer) > 0:
+                    yield (start, buffer)
+                return
+
+            end = buffer.rfind(b"\n")
+            quotes = buffer.count(b'"', 0, end)
+            while end >= 0 and quotes % 2 == 1:
+                previous = buffer.rfind(b"\n", 0, end)
+                quotes -= buffer.count(b'"', max(previous, 0), end)
+                end = previous
+            if end < 0 and len(buffer) >= self.maxChunkBytes:
+                end = buffer.rfind(b"\n")
+            if end < 0:
+                continue
+
+            yield (start, buffer[:end + 1])
+            start += end + 1
+            buffer = buffer[end + 1:]
+
+
+    def Identity(self, fileName):
+        # The size and modification time of the file, which a resumed load must match.
+        stat = os.stat(fileName)
+        return "%d:%d" % (stat.st_size, stat.st_mtime_ns)
+
+
+    def Ingest(self, fileName, rejectsFile = None, resume = True, recreate = True):
+        # Load the CSV file, resuming an interrupted load of it unless resume is False.
+        # rejectsFile   is the file the rejected rows are written to, by default <fileName>.rejects.csv.
+        # recreate      recreates the table when starting afresh, otherwise the companies are added to it.
+        # Returns the final checkpoint as a dictionary of the counts, with resumedRows the rows read before
+        # the load was resumed (0 if it was not).
+        source = os.path.abspath(fileName)
+        identity = self.Identity(fileName)
+        if rejectsFile is None:
+            rejectsFile = fileName + ".rejects.csv"
+
+        checkpoint = self.Checkpoint(source, identity) if resume else None
+        resumed = checkpoint is not None
+        resumedRows = checkpoint["rowsRead"] if resumed else 0
+
+        with open(fileName, "rb") as raw, self.OpenStream(raw) as stream:
+            # The heading row is read whether or not the load is resumed, and must be as expected.
+            line = stream.readline()
+            fields = next(csv.reader([line.decode("utf-8-sig")]), [])
+            if tuple(field.strip() for field in fields) != self.heading:
+                raise ValueError("File [%s] heading %s is not the company heading %s" % (fileName, fields, list(self.heading)))
+
+            if resumed:
+                stream.seek(checkpoint["offset"])
+                self.offset = checkpoint["offset"]
+                with open(rejectsFile, "ab") as rejects:
+                    rejects.truncate(checkpoint["rejectBytes"])
+            else:
+                self.offset = len(line)
+                checkpoint = { "offset" : self.offset, "rowsRead" : 0, "loaded" : 0, "rejected" : 0, "rejectBytes" : 0, "complete" : 0 }
+                self.companyDB.StartIngest(source, identity, self.offset, recreate)
+                with open(rejectsFile, "w", newline='') as rejects:
+                    csv.writer(rejects).writerow(("row", "offset", "reason") + self.heading)
+
+            with open(rejectsFile, "a", newline='') as rejects:
+                checkpoint = self.Load(stream, raw, rejects, source, identity, checkpoint)
+
+        # A recreated table is loaded without the indexes other than the unique ones, which are
+        # built once every row is written - see CompanyDB.RecreateTable.
+        self.companyDB.CreateIndexes()
+
+        checkpoint["resumedRows"] = resumedRows
+        checkpoint["rejectsFile"] = rejectsFile
+        return checkpoint
+
+
+    def Lines(self, stream):
+        # Generate the lines of the binary stream as text, keeping the offset of the end of the
+        # last line read, which follows the last row the CSV reader returned.
+        # A line that is not valid UTF-8 is decoded with replacement characters, and rejected by Validate.
+        for line in stream:
+            self.offset += len(line)
+            yield line.decode("utf-8", "replace")
+
+
+    def Load(self, stream, raw, rejects, source, identity, checkpoint):
+        # Load the rows of the stream in batches, each written with its checkpoint, from the given checkpoint.
+        # Returns the final checkpoint.
+        rejectWriter = csv.writer(rejects)
+        totalBytes = os.fstat(raw.fileno()).st_size
+        startTime = time.time()
+        startRows = checkpoint["rowsRead"]
+        startBytes = raw.tell()
+        nextReport = startTime + self.progressInterval
+
+        def Reject(row, offset, reason, fields):
+            rejectWriter.writerow([row, offset, reason] + list(fields))
+            checkpoint["rejected"] += 1
+
+        def Checkpoint(rejected):
+            # Called in the batch's transaction with the companies that could not be written.
+            for row, error in rejected:
+                Reject(row["row"], row["offset"], error, row["fields"])
+            rejects.flush()
+            os.fsync(rejects.fileno())
+            checkpoint["loaded"] += len(batch) - len(rejected)
+            checkpoint["offset"] = batchOffset
+            checkpoint["rowsRead"] = batchRows
+            checkpoint["rejectBytes"] = rejects.tell()
+            checkpoint["complete"] = 1 if complete else 0
+            return checkpoint
+
+        records = self.ParsedRows(stream)
+        batch = []
+        rowEnd = self.offset
+        complete = False
+        while complete == False:
+            try:
+                rowOffset, rowEnd, fields, error, row = next(records)
+            except StopIteration:
+                complete = True
+
+            if complete == False:
+                checkpoint["rowsRead"] += 1
+                if error != "":
+                    Reject(checkpoint["rowsRead"], rowOffset, error, fields)
+                else:
+                    row["row"] = checkpoint["rowsRead"]
+                    batch.append(row)
+
+            if len(batch) >= self.batchSize or complete:
+                # The checkpoint is moved on only as the batch is committed.
+                batchOffset = rowEnd
+                batchRows = checkpoint["rowsRead"]
+                self.companyAPI.IngestCompanies(batch, source, identity, Checkpoint)
+                batch = []
+
+            if self.progressInterval > 0 and (time.time() >= nextReport or complete):
+                nextReport = time.time() + self.progressInterval
+                self.Progress(checkpoint, raw.tell(), startBytes, totalBytes, checkpoint["rowsRead"] - startRows, time.time() - startTime)
+
+        return checkpoint
+
+
+    def OpenStream(self, raw):
+        # Open the binary stream of the file's contents, decompressing it if it is compressed.
+        magic = raw.read(6)
+        raw.seek(0)
+        for prefix, name, Decompressor in self.compressions:
+            if magic.startswith(prefix):
+                return Decompressor(fileobj=raw) if Decompressor is gzip.GzipFile else Decompressor(raw)
+        return raw
+
+
+    @staticmethod
+    def ParseChunk(start, data):
+        # Parse a chunk of rows from Chunks, which begins at byte offset start of the stream.
+        # Run in the worker processes, so must not need the database.
+        # Returns a list of the rows as (offset, end, fields, error, row), where error is the reason
+        # the row is rejected or "", and row is the company dictionary of a valid row, converted
+        # here, in the worker, ready for the writer to insert.
+        parser = CompanyIngest(None, None)
+        parser.offset = start
+        rows = []
+        reader = csv.reader(parser.Lines(io.BytesIO(data)))
+        while True:
+            offset = parser.offset
+            try:
+                fields = next(reader)
+            except StopIteration:
+                return rows
+            except csv.Error as e:
+                rows.append((offset, parser.offset, [], "Not valid CSV: %s" % e, None))
+                continue
+
+            # A blank line is not a row.
+            if len(fields) == 0:
+                continue
+
+            error = parser.Validate(fields)
+            row = None
+            if error == "":
+                row = dict(zip(parser.keys, fields))
+                row.update({ "offset" : offset, "fields" : fields })
+                CompanyAPI.ConvertRestricted(row)
+            rows.append((offset, parser.offset, fields, error, row))
+
+
+    def ParsedRows(self, stream):
+        # Generate the parsed rows of the stream, in file order, from ParseChunk.
+        # With one worker the chunks are parsed in this process. Otherwise they are parsed by a pool of
+        # worker processes, with up to two chunks per worker in hand, so memory use stays bounded however
+        # large the file. The rows come out in the same order either way, so the load is the same
+        # whatever the number of workers.
+        chunks = self.Chunks(stream)
+        if self.workers <= 1:
+            for start, data in chunks:
+                for row in self.ParseChunk(start, data):
+                    yield row
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=self.WatchParent, initargs=(os.getpid(), )) as executor:
+            pending = deque()
+            for start, data in chunks:
+                pending.append(executor.submit(self.ParseChunk, start, data))
+                if len(pending) >= self.workers * 2:
+                    for row in pending.popleft().result():
+                        yield row
+            while len(pending) > 0:
+                for row in pending.popleft().result():
+                    yield row
+
+
+    def Progress(self, checkpoint, bytesRead, startBytes, totalBytes, rows, elapsed):
+        # Report the progress of the load, estimating the time remaining from the bytes of the file
+        # (as stored, so compressed if it is compressed) read since startBytes, where this run started.
+        rate = rows / elapsed if elapsed > 0 else 0
+        fraction = bytesRead / totalBytes if totalBytes > 0 else 1.0
+        done = bytesRead - startBytes
+        remaining = elapsed * (totalBytes - bytesRead) / done if done > 0 else 0
+        print("Ingest: rows [%d] loaded [%d] rejected [%d] read [%.1f%%] [%.0f] rows/sec, [%.0f] seconds remaining" %
+              (checkpoint["rowsRead"], checkpoint["loaded"], checkpoint["rejected"], fraction * 100, rate, remaining), file=self.output)
+        self.output.flush()
+
+
+    def Validate(self, fields):
+        # Check a row's fields, returning the reason it is rejected or "" if it is valid.
+        if len(fields) != len(self.heading):
+            return "Expected [%d] fields, found [%d]" % (len(self.heading), len(fields))
+        if "\ufffd" in "".join(fields):
+            return "Not valid UTF-8"
+        if (fields[0].isascii() and fields[0].isdigit()) == False:
+            return "Company ID [%s] is not digits only" % fields[0]
+        if fields[6].lower() not in ("yes", "no"):
+            return "Restricted [%s] must be [Yes or No]" % fields[6]
+        return ""
+
+
+    @staticmethod
+    def WatchParent(parentPid):
+        # Run in each worker process as it starts, to exit the worker if this process is killed,
+        # which would otherwise leave the worker waiting for work that will never come.
+        def Watch():
+            while os.getppid() == parentPid:
+                time.sleep(1.0)
+            os._exit(1)
+
+        threading.Thread(target=Watch, daemon=True).start()
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# CompanyMetrics.py
+
+# Python class collecting per-endpoint request metrics for the company Web API.
+
+# Each endpoint is recorded under a layer:
+#     api     the CompanyAPI functions, recorded by the Instrumented decorator,
+#     http    the companyWebAPI routes, recorded by the hug middleware.
+
+# Per endpoint the metrics hold:
+# - the request and error counts,
+# - a latency histogram with fixed bucket boundaries (seconds),
+# - the most recent latencies, from which the p50 / p95 / p99 are taken.
+
+# The metrics are rendered in the Prometheus text exposition format for the
+# /metrics route.
+
+# The Instrumented decorator also provides the optional request logging for
+# CompanyAPI, which replaces printing every response:
+# - a sampled fraction of requests (logSampleRate) is logged at INFO level to the
+#   "CompanyAPI" logger, giving the endpoint, arguments, result and latency,
+# - the response itself is only formatted if logPayload is set, and then at DEBUG level.
+
+#------------------------------------------------------
+
+import functools
+import logging
+import random
+import reprlib
+import threading
+import time
+
+from collections import deque
+
+
+logger = logging.getLogger("CompanyAPI")
+
+
+def Instrumented(endpoint):
+    # Decorator for CompanyAPI functions to record their metrics and log sampled requests.
+    # A response is counted as an error if it is a dictionary with an "error" result, or the
+    # function raises an exception.
+    def Decorate(function):
+        @functools.wraps(function)
+        def Wrapper(api, *args, **kwargs):
+            if api.metrics is None and api.logSampleRate <= 0:
+                return function(api, *args, **kwargs)
+
+            startTime = time.perf_counter()
+            respDict = None
+            error = True
+            try:
+                respDict = function(api, *args, **kwargs)
+                error = isinstance(respDict, dict) and respDict.get("result") == "error"
+                return respDict
+            finally:
+                elapsed = time.perf_counter() - startTime
+                if api.metrics is not None:
+                    api.metrics.Record("api", endpoint, elapsed, error)
+                if api.logSampleRate > 0 and random.random() < api.logSampleRate:
+                    LogRequest(api, endpoint, args, respDict, error, elapsed)
+        return Wrapper
+    return Decorate
+
+
+def LogRequest(api, endpoint, args, respDict, error, elapsed):
+    # Log a sampled request, only formatting the response if asked to.
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s%s result [%s] in [%.3f] ms", endpoint, reprlib.repr(args), "error" if error else "ok", elapsed * 1000)
+    if api.logPayload and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s response [%s]", endpoint, respDict)
+
+
+class EndpointMetrics:
+
+    def __init__(self, buckets, window):
+        # Initialise the counts for an endpoint.
+        self.requests = 0
+        self.errors = 0
+        self.latencySum = 0.0
+        self.bucketCounts = [0] * len(buckets)
+        self.recent = deque(maxlen=window)
+
+
+class CompanyMetrics:
+
+    # Latency histogram bucket boundaries in seconds.
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    # Quantiles reported from the most recent latencies.
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, prefix = "company", window = 1024):
+        # Initialise the metrics with no endpoints recorded.
+        # prefix    is the start of every metric name.
+        # window    is the number of most recent latencies kept per endpoint for the quantiles.
+        self.prefix = prefix
+        self.window = window
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.startTime = time.time()
+
+
+    def Prometheus(self, cacheStats = None):
+        # Render the metrics in the Prometheus text exposition format.
+        # cacheStats    is the optional CompanyAPI.CacheStats dictionary to include.
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            snapshot = [(layer, endpoint, stats.requests, stats.errors, stats.latencySum,
+                         list(stats.bucketCounts), sorted(stats.recent))
+                        for (layer, endpoint), stats in endpoints]
+
+        lines = []
+        for layer in sorted(set(layer for layer, endpoint, *rest in snapshot)):
+            name = "%s_%s" % (self.prefix, layer)
+            rows = [row for row in snapshot if row[0] == layer]
+
+            lines.append("# HELP %s_requests_total Requests handled per endpoint." % name)
+            lines.append("# TYPE %s_requests_total counter" % name)
+            for layer, endpoint, requests, errors, latencySum, bucketCounts, recent in rows:
+                lines.append('%s_requests_total{endpoint="%s"} %d' % (name, endpoint, requests))
+
+            lines.append("# HELP %s_errors_total Requests per endpoint resulting in an error." % name)
+            lines.append("# TYPE %s_errors_total counter" % name)
+            for layer, endpoint, requests, errors, latencySum, bucketCounts, recent in rows:
+                lines.append('%s_errors_total{endpoint="%s"} %d' % (name, endpoint, errors))
+
+            lines.append("# HELP %s_latency_seconds Request latency per endpoint." % name)
+            lines.append("# TYPE %s_latency_seconds histogram" % name)
+            for layer, endpoint, requests, errors, latencySum, bucketCounts, recent in rows:
+                cumulative = 0
+                for bound, count in zip(self.buckets, bucketCounts):
+                    cumulative += count
+                    lines.append('%s_latency_seconds_bucket{endpoint="%s",le="%g"} %d' % (name, endpoint, bound, cumulative))
+                lines.append('%s_latency_seconds_bucket{endpoint="%s",le="+Inf"} %d' % (name, endpoint, requests))
+                lines.append('%s_latency_seconds_sum{endpoint="%s"} %.6f' % (name, endpoint, latencySum))
+                lines.append('%s_latency_seconds_count{endpoint="%s"} %d' % (name, endpoint, requests))
+
+            lines.append("# HELP %s_latency_quantile_seconds Request latency quantiles per endpoint over the most recent requests." % name)
+            lines.append("# TYPE %s_latency_quantile_seconds gauge" % name)
+            for layer, endpoint, requests, errors, latencySum, bucketCounts, recent in rows:
+                for quantile in self.quantiles:
+                    lines.append('%s_latency_quantile_seconds{endpoint="%s",quantile="%g"} %.6f' % (name, endpoint, quantile, self.Quantile(recent, quantile)))
+
+        if cacheStats:
+            name = "%s_cache" % self.prefix
+            for key in ("hits", "misses", "evictions", "expirations", "invalidations"):
+                lines.append("# TYPE %s_%s_total counter" % (name, key))
+                lines.append("%s_%s_total %d" % (name, key, cacheStats[key]))
+            for key in ("entries", "bytes"):
+                lines.append("# TYPE %s_%s gauge" % (name, key))
+                lines.append("%s_%s %d" % (name, key, cacheStats[key]))
+
+        lines.append("# TYPE %s_uptime_seconds gauge" % self.prefix)
+        lines.append("%s_uptime_seconds %.3f" % (self.prefix, time.time() - self.startTime))
+
+        return "\n".join(lines) + "\n"
+
+
+    @staticmethod
+    def Quantile(ordered, quantile):
+        # The quantile of a sorted list of latencies, or zero if there are none.
+        if len(ordered) == 0:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+    def Quantiles(self, layer, endpoint):
+        # The latency quantiles of an endpoint as a dictionary, e.g. { "p50" : 0.0012, ... }.
+        with self.lock:
+            stats = self.endpoints.get((layer, endpoint))
+            recent = sorted(stats.recent) if stats is not None else []
+        return dict(("p%g" % (quantile * 100), self.Quantile(recent, quantile)) for quantile in self.quantiles)
+
+
+    def Record(self, layer, endpoint, seconds, error = False):
+        # Record a request to an endpoint, taking seconds, and whether it resulted in an error.
+        with self.lock:
+            stats = self.endpoints.get((layer, endpoint))
+            if stats is None:
+                stats = EndpointMetrics(self.buckets, self.window)
+                self.endpoints[(layer, endpoint)] = stats
+
+            stats.requests += 1
+            if error:
+                stats.errors += 1
+            stats.latencySum += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats.bucketCounts[i] += 1
+                    break
+            stats.recent.append(seconds)
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# CompanyProfiler.py
+
+# Python class profiling the SQL statements run by CompanyDB, for finding where the
+# time goes inside the database.
+
+# Profiling is opt-in: a CompanyProfiler instance passed to CompanyDB is attached to
+# each connection it opens, using apsw's statement tracing (Connection.trace_v2):
+# - SQLITE_TRACE_STMT     as a statement starts, noting its text and the changes made so far,
+# - SQLITE_TRACE_ROW      for each row it returns,
+# - SQLITE_TRACE_PROFILE  as it finishes.
+# A statement is timed from its first step to its end, including any triggers it fires.
+# SQLite's own profile time is only to the millisecond, too coarse for most queries, so
+# the time is taken with the performance counter instead. For a query whose rows are
+# read one at a time (e.g. IterCompanies) this includes the caller's time between rows.
+
+# The statements are aggregated by shape - their text with the white space collapsed
+# and any literal numbers or strings replaced by ?, so the same query with different
+# values is counted together. With the values bound as parameters the shape is the
+# statement text itself, which apsw's statement cache reuses.
+# Per shape the profile holds:
+#     count         the number of times run,
+#     totalTime     the seconds taken in total,
+#     maxTime       the longest run in seconds,
+#     rows          the rows returned,
+#     changes       the rows inserted, updated or deleted (including by triggers),
+#     plan          the EXPLAIN QUERY PLAN of the statement, added by Explain.
+
+# A statement taking slowThreshold seconds or more is written to the slow query log:
+# appended as a tab separated line (time, milliseconds, rows, statement) to the
+# slowLog file, or if there is none, logged as a warning to the "CompanyDB" logger.
+
+# The profile can be saved as JSON by Save, to be printed later by Dump (see
+# create_db.py --profile / --dump-profile).
+
+#------------------------------------------------------
+
+import json
+import logging
+import re
+import threading
+import time
+
+import apsw
+
+
+logger = logging.getLogger("CompanyDB")
+
+
+class StatementStats:
+
+    def __init__(self, sql):
+        # Initialise the counts for a statement shape, keeping the first statement seen to explain.
+        self.sql = sql
+        self.count = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+        self.rows = 0
+        self.changes = 0
+        self.plan = None
+
+
+class CompanyProfiler:
+
+    # The trace events profiled.
+    traceMask = apsw.SQLITE_TRACE_STMT | apsw.SQLITE_TRACE_ROW | apsw.SQLITE_TRACE_PROFILE
+
+    # Literal strings and numbers (not part of a name) replaced in a statement's shape.
+    literals = re.compile(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?\b")
+
+    # The statements with a query plan to explain.
+    explained = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+    # The parameters of a statement, outside any literal strings.
+    parameters = re.compile(r"'(?:[^']|'')*'|(\?)")
+
+    def __init__(self, slowThreshold = 0.1, slowLog = None):
+        # Initialise the profiler with no statements recorded.
+        # slowThreshold     is the seconds at or above which a statement is written to the slow query log.
+        # slowLog           is the name of the file the slow query log is appended to, or None to log
+        #                   slow statements to the "CompanyDB" logger.
+        self.slowThreshold = slowThreshold
+        self.slowLog = slowLog
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.running = {}
+        self.startTime = time.time()
+
+
+    def Attach(self, connection):
+        # Profile the statements run on an apsw connection.
+        connection.trace_v2(self.traceMask, self.Trace, id=self)
+
+
+    def Dump(self, output, report = None, top = 20):
+        # Write the profile (by default Report) to the output stream as a table of the top statement
+        # shapes by total time, each followed by its query plan.
+        if report is None:
+            report = self.Report()
+
+        output.write("%8s %10s %10s %10s %10s %10s  %s\n" % ("count", "total ms", "mean ms", "max ms", "rows", "changes", "statement"))
+        for stats in report[:top]:
+            output.write("%8d %10.1f %10.3f %10.3f %10d %10d  %s\n" % (stats["count"], stats["totalTime"] * 1000,
+                         stats["totalTime"] * 1000 / max(1, stats["count"]), stats["maxTime"] * 1000,
+                         stats["rows"], stats["changes"], stats["shape"]))
+            for line in stats["plan"] or []:
+                output.write("%65s  %s\n" % ("", line))
+        if len(report) > top:
+            output.write("... and [%d] more statement shapes\n" % (len(report) - top))
+
+
+    def Explain(self, connection):
+        # Add the EXPLAIN QUERY PLAN of each statement shape not yet explained, run on the connection.
+        # Parameters are bound as NULL, which does not change the plan.
+        with self.lock:
+            pending = [stats for stats in self.statements.values() if stats.plan is None]
+
+        for stats in pending:
+            if stats.sql.lstrip().upper().startswith(self.explained) == False:
+                stats.plan = []
+                continue
+            try:
+                bindings = [None] * sum(1 for match in self.parameters.finditer(stats.sql) if match.group(1))
+                plan = list(connection.execute("EXPLAIN QUERY PLAN %s" % stats.sql, bindings))
+                # Indent each step of the plan under its parent.
+                depth = { 0 : 0 }
+                lines = []
+                for id, parent, notUsed, detail in plan:
+                    depth[id] = depth.get(parent, 0) + 1
+                    lines.append("%s%s" % ("  " * (depth[id] - 1), detail))
+                stats.plan = lines
+            except apsw.Error as e:
+                # e.g. the table of a rebuild has since been dropped.
+                stats.plan = ["not explained: %s" % e]
+
+
+    @staticmethod
+    def Load(fileName):
+        # Load a profile saved by Save, returning its report.
+        with open(fileName) as profileFile:
+            return json.load(profileFile)["statements"]
+
+
+    def LogSlow(self, sql, elapsed, rows):
+        # Write a slow statement to the slow query log.
+        if self.slowLog is None:
+            logger.warning("Slow statement [%.3f] ms rows [%d]: %s", elapsed * 1000, rows, sql)
+            return
+
+        line = "%s\t%.3f\t%d\t%s\n" % (time.strftime("%Y-%m-%dT%H:%M:%S"), elapsed * 1000, rows, " ".join(sql.split()))
+        with self.lock:
+            with open(self.slowLog, "a") as logFile:
+                logFile.write(line)
+
+
+    def Report(self):
+        # The profile as a list of dictionaries, one per statement shape, by total time, longest first.
+        with self.lock:
+            report = [{ "shape" : shape, "count" : stats.count, "totalTime" : stats.totalTime, "maxTime" : stats.maxTime,
+                        "rows" : stats.rows, "changes" : stats.changes, "plan" : stats.plan }
+                      for shape, stats in self.statements.items()]
+        report.sort(key=lambda stats: stats["totalTime"], reverse=True)
+        return report
+
+
+    def Reset(self):
+        # Forget the statements recorded so far.
+        with self.lock:
+            self.statements = {}
+            self.startTime = time.time()
+
+
+    def Save(self, fileName):
+        # Save the profile as JSON.
+        profile = { "started" : self.startTime, "saved" : time.time(), "statements" : self.Report() }
+        with open(fileName, "w") as profileFile:
+            json.dump(profile, profileFile, indent=2)
+
+
+    @classmethod
+    def Shape(cls, sql):
+        # The shape of a statement: its text with the white space collapsed and literals replaced by ?.
+        return cls.literals.sub("?", " ".join(sql.split()))
+
+
+    def Trace(self, event):
+        # The trace_v2 callback, called on the thread running the statement.
+        # Statements run by triggers are part of the statement firing them, so are not counted apart.
+        code = event["code"]
+        if code == apsw.SQLITE_TRACE_ROW:
+            running = self.running.get(event["id"])
+            if running is not None:
+                running[2] += 1
+
+        elif code == apsw.SQLITE_TRACE_STMT:
+            if event["trigger"] == False and event["sql"].startswith("EXPLAIN") == False:
+                self.running[event["id"]] = [event["sql"], event["total_changes"], 0, time.perf_counter()]
+
+        elif code == apsw.SQLITE_TRACE_PROFILE:
+            running = self.running.pop(event["id"], None)
+            if running is None:
+                return
+            sql, changes, rows, startTime = running
+            elapsed = time.perf_counter() - startTime
+            shape = self.Shape(sql)
+            with self.lock:
+                stats = self.statements.get(shape)
+                if stats is None:
+                    stats = self.statements[shape] = StatementStats(sql)
+                stats.count += 1
+                stats.totalTime += elapsed
+                stats.maxTime = max(stats.maxTime, elapsed)
+                stats.rows += rows
+                stats.changes += event["total_changes"] - changes
+
+            if elapsed >= self.slowThreshold:
+                self.LogSlow(sql, elapsed, rows)
@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# CompanySnapshot.py
+
+# Python class holding a read only, in-memory snapshot of the companies table,
+# which CompanyAPI can use in place of CompanyDB.
+
+# The companies are read once from a CompanyDB instance and held in compact,
+# array backed columns, so looking up a company costs no SQL parsing, cursor
+# step or connection, just a few array reads:
+# - ids             a sorted array of the company ids (8 bytes each). When the ids
+#                   run without gaps a company's position is worked out from its id,
+#                   otherwise a dictionary (the hash index) maps id to position,
+# - strings         each text column is held as a list of references to its distinct
+#                   values, so a value repeated across companies (an interned string) is
+#                   held once, and read with a single index (8 bytes a company, rather
+#                   than 4 byte codes into the distinct values, read with two),
+# - restricted      a packed bitset of one bit per company, and the positions of the
+#                   restricted and unrestricted companies in id order, standing in for
+#                   the (restricted, id) index, so a filtered page is found by position.
+
+# The snapshot provides the read functions of CompanyDB that CompanyAPI uses, with the
+# same arguments and results:
+#     GetCompanyById, GetCompaniesByIds, GetCompanyList, IterCompanies,
+#     GetCompanyByBusinessNumber, GetCompaniesByBusinessNumbers, CountRows, Statistics,
+#     DataVersion, Generation.
+# SearchCompanies and TypeaheadCompanies are passed on to the CompanyDB instance, as the
+# full text index is not held in memory. The snapshot cannot be written to.
+
+# Reload reads the table again and swaps the new columns in with a single assignment,
+# so a lookup in progress finishes on the columns it started with, and the server need
+# not be restarted after a load. Refresh reloads only if the database generation has
+# changed. Each reload changes the DataVersion, invalidating any cached responses.
+
+# MemoryUsage estimates the bytes held, for sizing a server per million companies.
+
+#------------------------------------------------------
+
+import sys
+import threading
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+from CompanyDB import CompanyDB
+
+
+class CompanyColumns:
+
+    # The text columns of a company, in row order after the id.
+    stringColumns = ("companyName", "description", "tagline", "companyEmail", "businessNumber")
+
+    def __init__(self, rows, generation = None):
+        # Build the columns from an iterable of company rows in id order, as from CompanyDB.IterCompanies.
+        # generation    is the CompanyDB.Generation the rows were read at.
+        self.generation = generation
+        self.ids = array("q")
+        self.bits = bytearray()
+        self.positions = { 0 : array("I"), 1 : array("I") }
+
+        values = dict((column, []) for column in self.stringColumns)
+        interned = dict((column, {}) for column in self.stringColumns)
+
+        for position, row in enumerate(rows):
+            if len(self.ids) > 0 and row[0] <= self.ids[-1]:
+                raise ValueError("Company ids are not in ascending order at id [%s]" % row[0])
+            self.ids.append(row[0])
+
+            for column, value in zip(self.stringColumns, row[1:6]):
+                values[column].append(interned[column].setdefault(value, value))
+
+            restricted = 1 if row[6] == 1 else 0
+            if position % 8 == 0:
+                self.bits.append(0)
+            self.bits[-1] |= restricted << (position % 8)
+            self.positions[restricted].append(position)
+
+        # The columns are held as attributes for the quickest access in Row.
+        self.names, self.descriptions, self.taglines, self.emails, self.businessNumbers = [values[column] for column in self.stringColumns]
+
+        self.count = len(self.ids)
+        self.minId = self.ids[0] if self.count > 0 else None
+        self.maxId = self.ids[-1] if self.count > 0 else None
+
+        # Ids without gaps need no index, as the position is the id less the lowest id.
+        self.index = None
+        if self.count > 0 and self.maxId - self.minId + 1 != self.count:
+            self.index = dict((id, position) for position, id in enumerate(self.ids))
+
+        # The business number index is built on first use - see BusinessNumberIndex.
+        self.businessNumberIndex = None
+        self.indexLock = threading.Lock()
+
+
+    def BusinessNumberIndex(self):
+        # The positions of the companies keyed by normalised business number, built on first use
+        # so a snapshot only serving lookups by id does not hold it.
+        with self.indexLock:
+            if self.businessNumberIndex is None:
+                # Each distinct business number is normalised once.
+                normalised = {}
+                index = {}
+                for position, value in enumerate(self.businessNumbers):
+                    if value not in normalised:
+                        normalised[value] = CompanyDB.NormaliseBusinessNumber(value)
+                    if normalised[value] is not None:
+                        index.setdefault(normalised[value], position)
+                self.businessNumberIndex = index
+            return self.businessNumberIndex
+
+
+    def MemoryUsage(self):
+        # An estimate of the bytes held by the columns, including the distinct strings and any indexes.
+        size = sys.getsizeof(self.ids) + sys.getsizeof(self.bits)
+        size += sum(sys.getsizeof(positions) for positions in self.positions.values())
+        for values in (self.names, self.descriptions, self.taglines, self.emails, self.businessNumbers):
+            # Each distinct value once, however many companies refer to it.
+            distinct = dict((id(value), value) for value in values)
+            size += sys.getsizeof(values) + sum(sys.getsizeof(value) for value in distinct.values())
+        for index in (self.index, self.businessNumberIndex):
+            if index is not None:
+                size += sys.getsizeof(index) + sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in index.items())
+        return size
+
+
+    def Position(self, id):
+        # The position of the company with the integer id, or None if there is no such company.
+        if self.index is not None:
+            return self.index.get(id)
+        if self.count > 0 and self.minId <= id <= self.maxId:
+            return id - self.minId
+        return None
+
+
+    def Row(self, position):
+        # The company at position as a tuple in CompanyDB row order:
+        #     id, companyName, description, tagline, companyEmail, businessNumber, restricted
+        return (self.ids[position], self.names[position], self.descriptions[position], self.taglines[position],
+                self.emails[position], self.businessNumbers[position], (self.bits[position >> 3] >> (position & 7)) & 1)
+
+
+class CompanySnapshot:
+
+    def __init__(self, companyDB):
+        # Initialise the snapshot with an instance of the CompanyDB class, loading its companies.
+        # The instance is kept to reload from, and to answer searches.
+        self.companyDB = companyDB
+        self.database = companyDB.database
+        self.table = companyDB.table
+        self.totalcount = 0
+        self.minkey = 0
+        self.maxkey = 0
+
+        self.reloadLock = threading.Lock()
+        self.version = 0
+        self.columns = None
+        self.Reload()
+
+
+    def Close(self):
+        # Close the database the snapshot was loaded from.
+        self.companyDB.Close()
+
+
+    def CountRows(self, table = None):
+        # Some basic statistics about the companies in the snapshot, as CompanyDB.CountRows.
+        # Returns the total count.
+        stats = self.Statistics()
+        self.totalcount = stats["total"]
+        self.minkey = stats["minId"] if self.totalcount else 0
+        self.maxkey = stats["maxId"] if self.totalcount else 0
+        return self.totalcount
+
+
+    def DataVersion(self):
+        # A value that changes whenever a new snapshot is loaded.
+        return self.version
+
+
+    def Generation(self):
+        # The CompanyDB.Generation of the companies in the snapshot.
+        return self.columns.generation
+
+
+    def GetCompaniesByBusinessNumbers(self, businessNumbers):
+        # Get the companies matching a list of normalised business numbers.
+        # Returns a dictionary of rows keyed by the normalised business number, each row
+        # ending with the normalised business number as CompanyDB's do.
+        columns = self.columns
+        index = columns.BusinessNumberIndex()
+        rows = {}
+        for businessNumber in businessNumbers:
+            position = index.get(businessNumber)
+            if position is not None:
+                rows[businessNumber] = columns.Row(position) + (businessNumber, )
+        return rows
+
+
+    def GetCompaniesByIds(self, ids):
+        # Get the companies matching a list of ids.
+        # Returns a dictionary of rows keyed by the integer id.
+        columns = self.columns
+        rows = {}
+        for id in ids:
+            position = columns.Position(int(id))
+            if position is not None:
+                rows[int(id)] = columns.Row(position)
+        return rows
+
+
+    def GetCompanyByBusinessNumber(self, businessNumber):
+        # Get a specific company by its normalised business number and return its details.
+        columns = self.columns
+        position = columns.BusinessNumberIndex().get(businessNumber)
+        return [] if position is None else columns.Row(position)
+
+
+    def GetCompanyById(self, id):
+        # Get a specific company by id and return its details.
+        # print("CompanySnapshot.GetCompanyById: id [%s]" % id)
+        row = []
+        if (id.isascii() and id.isdigit()) != True:
+            return row
+
+        # Position and Row are written out here, saving the calls on the most frequent lookup.
+        columns = self.columns
+        id = int(id)
+        if columns.index is not None:
+            position = columns.index.get(id)
+        elif columns.count > 0 and columns.minId <= id <= columns.maxId:
+            position = id - columns.minId
+        else:
+            position = None
+        if position is not None:
+            row = (id, columns.names[position], columns.descriptions[position], columns.taglines[position],
+                   columns.emails[position], columns.businessNumbers[position], (columns.bits[position >> 3] >> (position & 7)) & 1)
+        return row
+
+
+    def GetCompanyList(self, offset, count = 100, restricted = None, after = None):
+        # Get a list of companies, as CompanyDB.GetCompanyList:
+        #     matching the restricted flag if supplied,
+        #     starting at offset in the list,
+        #     or if after is supplied, starting at the first company with an id greater than after,
+        #     to a maximum of count companies.
+        # A page is found by position whatever its depth in the list.
+        # print("CompanySnapshot.GetCompanyList: offset [%s] count [%s] restricted [%s] after [%s]" % (offset, count, restricted, after) )
+        rows = {}
+        okay = offset.isascii() and offset.isdigit() and count.isascii() and count.isdigit()
+        okay = okay and ( restricted is None or ( restricted.isascii() and restricted.isdigit() ) )
+        okay = okay and ( after is None or ( after.isascii() and after.isdigit() ) )
+        if okay == False:
+            return rows
+
+        columns = self.columns
+        if restricted is None:
+            positions = range(columns.count)
+        else:
+            positions = columns.positions.get(int(restricted), ())
+
+        if after is None:
+            start = int(offset)
+        else:
+            start = bisect_left(positions, bisect_right(columns.ids, int(after)))
+
+        for position in positions[start:start + int(count)]:
+            row = columns.Row(position)
+            rows[row[0]] = row
+        return rows
+
+
+    def IterCompanies(self, restricted = None):
+        # Generate every company, in id order, matching the restricted flag if supplied.
+        columns = self.columns
+        positions = range(columns.count) if restricted is None else columns.positions.get(int(restricted), ())
+        for position in positions:
+            yield columns.Row(position)
+
+
+    def MemoryUsage(self):
+        # An estimate of the bytes held by the snapshot - see CompanyColumns.MemoryUsage.
+        return self.columns.MemoryUsage()
+
+
+    @staticmethod
+    def MatchExpression(text, prefix = False):
+        # As CompanyDB.MatchExpression.
+        return CompanyDB.MatchExpression(text, prefix)
+
+
+    @staticmethod
+    def NormaliseBusinessNumber(businessNumber):
+        # As CompanyDB.NormaliseBusinessNumber.
+        return CompanyDB.NormaliseBusinessNumber(businessNumber)
+
+
+    def Refresh(self):
+        # Reload the snapshot if the companies in the database have changed since it was loaded.
+        # Returns True if it was reloaded.
+        if self.companyDB.Generation() == self.columns.generation:
+            return False
+        self.Reload()
+        return True
+
+
+    def Reload(self):
+        # Load the companies from the database and swap them in, once complete, for the current snapshot.
+        # The generation is read before the companies, so a change made during the load leaves the
+        # snapshot older than the database, and the next Refresh loads it again.
+        # Returns the number of companies loaded.
+        with self.reloadLock:
+            generation = self.companyDB.Generation()
+            rows = self.companyDB.IterCompanies()
+            try:
+                columns = CompanyColumns(rows, generation)
+            finally:
+                rows.close()
+
+            self.columns = columns
+            self.version += 1
+            self.CountRows()
+            return columns.count
+
+
+    def SearchCompanies(self, query, offset, count = 20, restricted = None):
+        # Search the companies in the database - see CompanyDB.SearchCompanies.
+        return self.companyDB.SearchCompanies(query, offset, count, restricted)
+
+
+    def Statistics(self, table = None):
+        # The statistics of the companies in the snapshot, as CompanyDB.Statistics.
+        columns = self.columns
+        return { "total" : columns.count, "restricted" : len(columns.positions[1]), "unrestricted" : len(columns.positions[0]),
+                 "minId" : columns.minId, "maxId" : columns.maxId }
+
+
+    def TypeaheadCompanies(self, prefix, count = 10, restricted = None):
+        # Suggest companies from the database - see CompanyDB.TypeaheadCompanies.
+        return self.companyDB.TypeaheadCompanies(prefix, count, restricted)
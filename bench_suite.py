@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# bench_suite.py
+
+# Python script to benchmark the company database and Web API at increasing data
+# sizes, writing the results as JSON so that runs can be compared over time.
+# It supersedes the Perl script testRest.pl, which tested only one page size by hand.
+
+# For each data size (--sizes, e.g. 10k,1M,10M) the script:
+# - generates a synthetic CSV file of that many companies with generate_companies.py,
+#   kept in --data-dir and reused by later runs,
+# - loads it into a scratch database with create_db.py, measuring the load
+#   throughput in rows per second,
+# - calls the CompanyAPI functions directly, without the response cache, measuring
+#   the p50 / p99 latency of:
+#       GetCompanyById          for random ids,
+#       GetCompanyList          at a shallow offset (the first 1%) and a deep offset
+#                               (the last 1%) of the table, for all companies and
+#                               with restricted=0 and restricted=1,
+#   from the database and from an in-memory CompanySnapshot of it, with the time to
+#   load the snapshot and its memory use,
+# - drives the Web API over HTTP with --clients concurrent clients, measuring the
+#   requests per second and p50 / p99 latency. The Web API is that given by --url,
+#   or else companyWebAPI.py served on the scratch database by serve_prefork.py.
+
+# Example:
+#     python3 bench_suite.py --sizes 10k,1M --output bench.json
+#     python3 bench_suite.py --sizes 10k --baseline bench.json
+
+# With --baseline the results are compared with an earlier run, reporting any
+# latency or throughput more than --tolerance worse.
+
+#------------------------------------------------------
+
+
+import http.client
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+
+from optparse import OptionParser
+from urllib.parse import urlsplit
+
+import apsw
+
+import bench_web
+import generate_companies
+
+from CompanyAPI import CompanyAPI
+from CompanyDB import CompanyDB
+from CompanySnapshot import CompanySnapshot
+
+
+def CompareResults(baseline, results, tolerance):
+    # Compare the results with a baseline run, returning a list of the measures more than tolerance worse.
+    # Rates are worse when lower, and latencies when higher.
+    regressions = []
+    for size, measures in results["sizes"].items():
+        for name, value in Flatten(measures).items():
+            previous = Flatten(baseline.get("sizes", {}).get(size, {})).get(name)
+            if previous is None or previous == 0:
+                continue
+            change = (value - previous) / previous
+            worse = -change if name.endswith("rate") else change
+            if worse > tolerance:
+                regressions.append("%s %s: [%.4g] was [%.4g] (%+.0f%%)" % (size, name, value, previous, change * 100))
+    return regressions
+
+
+def Flatten(measures, prefix = ""):
+    # Flatten the nested measures to a dict of "name.name" : value.
+    flat = {}
+    for name, value in measures.items():
+        if isinstance(value, dict):
+            flat.update(Flatten(value, prefix + name + "."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + name] = value
+    return flat
+
+
+def GitCommit():
+    # The current git commit, or None outside a git repository.
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def Latencies(function, calls):
+    # Call the function calls times, returning the p50 / p99 latency in milliseconds.
+    latencies = []
+    for i in range(calls):
+        startTime = time.perf_counter()
+        respDict = function()
+        latencies.append(time.perf_counter() - startTime)
+        if respDict["result"] != "ok":
+            raise RuntimeError("Benchmark call failed: %s" % respDict["error"])
+    latencies.sort()
+    return { "p50_ms" : bench_web.Quantile(latencies, 0.5) * 1000, "p99_ms" : bench_web.Quantile(latencies, 0.99) * 1000 }
+
+
+def MeasureAPI(database, calls, count, snapshot = False):
+    # Measure the CompanyAPI latencies on the database, without the response cache.
+    # With snapshot the companies are read from a CompanySnapshot of the database instead.
+    companyDB = CompanyDB(database)
+    if snapshot:
+        companyDB = CompanySnapshot(companyDB)
+    companyAPI = CompanyAPI(companyDB)
+    try:
+        ids = [row[0] for row in companyDB.IterCompanies()]
+        stats = companyDB.Statistics()
+        measures = { "GetCompanyById" : Latencies(lambda: companyAPI.GetCompanyById(str(random.choice(ids))), calls) }
+
+        # The offsets are within the rows of each filter, the deep ones near the end of the table.
+        for restricted, total in ((None, stats["total"]), ("0", stats["unrestricted"]), ("1", stats["restricted"])):
+            name = "GetCompanyList" if restricted is None else "GetCompanyList_restricted_%s" % restricted
+            limit = max(1, total - count)
+            shallow = lambda: companyAPI.GetCompanyList(str(random.randrange(0, max(1, limit // 100))), str(count), restricted)
+            deep = lambda: companyAPI.GetCompanyList(str(random.randrange(limit - max(1, limit // 100), limit)), str(count), restricted)
+            measures[name] = { "shallow" : Latencies(shallow, calls), "deep" : Latencies(deep, calls) }
+        return measures, ids
+    finally:
+        companyDB.Close()
+
+
+def MeasureHTTP(port, ids, options):
+    # Measure the Web API throughput and latency with each number of concurrent clients.
+    measures = {}
+    for clients in [int(clients) for clients in options.clients.split(",")]:
+        rate, p50, p99, busy, failures = bench_web.RunLoad(port, clients, ids, options.count, options.seconds)
+        measures["clients_%d" % clients] = { "rate" : rate, "p50_ms" : p50 * 1000, "p99_ms" : p99 * 1000,
+                                             "busy" : busy, "failures" : failures }
+    return measures
+
+
+def MeasureLoad(csvFile, database, rows):
+    # Load the CSV file into a new database with create_db.py, returning the load throughput.
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+
+    startTime = time.time()
+    process = subprocess.run([sys.executable, "create_db.py", "--csv", csvFile, "--db", database[:-len(".db3")]],
+                             capture_output=True, text=True)
+    elapsed = time.time() - startTime
+    if process.returncode != 0:
+        raise RuntimeError("create_db.py failed: %s" % process.stderr)
+
+    # create_db.py reports the rate of the load itself, excluding starting up and creating the indexes.
+    match = re.search(r"LoadCSVFile loaded \[\d+\] rows in \[([\d.]+)\] seconds", process.stdout)
+    return { "seconds" : elapsed, "rate" : rows / elapsed,
+             "load_seconds" : float(match.group(1)) if match else None,
+             "load_rate" : rows / float(match.group(1)) if match and float(match.group(1)) > 0 else None }
+
+
+def StartServer(database, port):
+    # Serve companyWebAPI.py on the database with serve_prefork.py, waiting until it answers.
+    process = subprocess.Popen([sys.executable, "serve_prefork.py", "--db", database, "--port", str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for i in range(100):
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            connection.close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError("serve_prefork.py did not start on port [%d]" % port)
+
+
+def main():
+    # Parse the command line options.
+    parser = OptionParser(
+        description="Benchmark the company database load, API latency and Web API throughput at several data sizes.")
+
+    parser.add_option("--sizes", dest="sizes", default="10k",
+                      help="comma separated numbers of companies, e.g. 10k,1M,10M. Default: [10k]")
+    parser.add_option("--data-dir", dest="dataDir", default="bench_data",
+                      help="directory for the generated CSV files and scratch databases. Default: [bench_data]")
+    parser.add_option("--calls", dest="calls", type="int", default=1000,
+                      help="number of calls for each API latency. Default: [1000]")
+    parser.add_option("--count", dest="count", type="int", default=100,
+                      help="number of companies in each list page. Default: [100]")
+    parser.add_option("--clients", dest="clients", default="1,10",
+                      help="comma separated numbers of concurrent HTTP clients. Default: [1,10]")
+    parser.add_option("--seconds", dest="seconds", type="float", default=10,
+                      help="how long to run each HTTP load for. Default: [10]")
+    parser.add_option("--url", dest="url", default=None,
+                      help="local Web API already running to drive, e.g. http://127.0.0.1:8000, instead of serving the scratch database.")
+    parser.add_option("--port", dest="port", type="int", default=8200,
+                      help="port to serve the scratch database on. Default: [8200]")
+    parser.add_option("--nohttp", dest="http", action="store_false", default=True,
+                      help="skips the HTTP throughput measures.")
+    parser.add_option("--output", dest="output", metavar="FILE", default="bench_results.json",
+                      help="JSON file to write the results to. Default: [bench_results.json]")
+    parser.add_option("--baseline", dest="baseline", metavar="FILE", default=None,
+                      help="JSON results of an earlier run to compare with.")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.2,
+                      help="fraction worse than the baseline reported as a regression. Default: [0.2]")
+
+    (options, args) = parser.parse_args()
+
+    os.makedirs(options.dataDir, exist_ok=True)
+    results = { "meta" : { "time" : time.strftime("%Y-%m-%dT%H:%M:%S%z"), "commit" : GitCommit(),
+                           "python" : platform.python_version(), "sqlite" : apsw.sqlitelibversion(),
+                           "apsw" : apsw.apswversion(), "platform" : platform.platform(), "cpus" : os.cpu_count(),
+                           "calls" : options.calls, "count" : options.count, "url" : options.url },
+                "sizes" : {} }
+
+    for size in options.sizes.split(","):
+        rows = generate_companies.ParseRows(size)
+        csvFile = os.path.join(options.dataDir, "companies_%s.csv" % size)
+        database = os.path.join(options.dataDir, "bench_%s.db3" % size)
+        if os.path.isfile(csvFile) == False:
+            print("bench_suite: generating [%d] companies in [%s]" % (rows, csvFile) )
+            generate_companies.WriteCSV(csvFile, rows)
+
+        print("bench_suite: [%s] loading" % size)
+        measures = { "rows" : rows, "load" : MeasureLoad(csvFile, database, rows) }
+        print("bench_suite: [%s] load [%.0f] rows/sec" % (size, measures["load"]["rate"]) )
+
+        print("bench_suite: [%s] API latency" % size)
+        measures["api"], ids = MeasureAPI(database, options.calls, options.count)
+        for name, value in sorted(Flatten(measures["api"]).items()):
+            print("    %-50s %10.3f" % (name, value) )
+
+        print("bench_suite: [%s] API latency from a snapshot" % size)
+        startTime = time.time()
+        snapshot = CompanySnapshot(CompanyDB(database))
+        measures["snapshot"] = { "load_seconds" : time.time() - startTime, "memory_bytes" : snapshot.MemoryUsage() }
+        snapshot.Close()
+        measures["snapshot"]["api"] = MeasureAPI(database, options.calls, options.count, snapshot = True)[0]
+        for name, value in sorted(Flatten(measures["snapshot"]).items()):
+            print("    %-50s %10.3f" % (name, value) )
+
+        if options.http:
+            print("bench_suite: [%s] HTTP throughput" % size)
+            process = None
+            if options.url is None:
+                port = options.port
+                process = StartServer(database, port)
+            else:
+                port = urlsplit(options.url).port or 80
+            try:
+                measures["http"] = MeasureHTTP(port, ids, options)
+            finally:
+                if process is not None:
+                    process.terminate()
+                    process.wait()
+            for name, value in sorted(Flatten(measures["http"]).items()):
+                print("    %-50s %10.3f" % (name, value) )
+
+        results["sizes"][size] = measures
+
+    with open(options.output, "w") as outputFile:
+        json.dump(results, outputFile, indent=2)
+    print("bench_suite: results written to [%s]" % options.output)
+
+    if options.baseline is not None:
+        with open(options.baseline) as baselineFile:
+            regressions = CompareResults(json.load(baselineFile), results, options.tolerance)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# bench_web.py
+
+# Python script to compare the hug, asyncio and pre-fork Web API servers under load.
+
+# Each server is started in turn on the existing company database (company.db3, as
+# hug -f companyWebAPI.py has no database option):
+#     hug           hug -f companyWebAPI.py
+#     async         companyAsyncWebAPI.py
+#     prefork:N     serve_prefork.py with N worker processes (by default one per CPU)
+# and driven by 1, 10 and 100 (see --clients) concurrent clients for a fixed time.
+# Each client keeps a connection open where the server allows, and sends requests
+# back to back: GetCompanyById for a random company (80%), or a GetCompanyList page
+# of --count companies at a random offset (20%).
+
+# For each server and number of clients the script reports the requests per second,
+# the p50 / p99 latency, and the number of 503 (busy) and other failed responses.
+
+#------------------------------------------------------
+
+
+import http.client
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from optparse import OptionParser
+
+from CompanyDB import CompanyDB
+
+
+def Client(port, ids, count, endTime, results):
+    # Send requests to the server until the time is up, recording each latency.
+    latencies = []
+    busy = 0
+    failures = 0
+    connection = None
+
+    while time.time() < endTime:
+        if random.random() < 0.8:
+            path = "/GetCompanyById?id=%d" % random.choice(ids)
+        else:
+            path = "/GetCompanyList?offset=%d&count=%d" % (random.randrange(0, max(1, len(ids) - count)), count)
+
+        startTime = time.perf_counter()
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            if response.will_close:
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            failures += 1
+            connection = None
+            continue
+        latencies.append(time.perf_counter() - startTime)
+
+        if response.status == 503:
+            busy += 1
+        elif response.status != 200:
+            failures += 1
+
+    if connection is not None:
+        connection.close()
+    results.append((latencies, busy, failures))
+
+
+def Quantile(ordered, quantile):
+    # The quantile of a sorted list of latencies, or zero if there are none.
+    if len(ordered) == 0:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+def RunLoad(port, clients, ids, count, seconds):
+    # Drive the server with a number of concurrent clients, returning the combined results.
+    results = []
+    endTime = time.time() + seconds
+    threads = [threading.Thread(target=Client, args=(port, ids, count, endTime, results)) for i in range(clients)]
+    startTime = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - startTime
+
+    latencies = sorted(latency for threadLatencies, busy, failures in results for latency in threadLatencies)
+    busy = sum(busy for threadLatencies, busy, failures in results)
+    failures = sum(failures for threadLatencies, busy, failures in results)
+    return (len(latencies) / elapsed, Quantile(latencies, 0.5), Quantile(latencies, 0.99), busy, failures)
+
+
+def StartServer(name, port, options):
+    # Start a server, waiting until it answers.
+    if name == "hug":
+        command = ["hug", "-f", "companyWebAPI.py", "-p", str(port)]
+    elif name.startswith("prefork"):
+        workers = name.partition(":")[2] or str(os.cpu_count())
+        command = [sys.executable, "serve_prefork.py", "--port", str(port), "--workers", workers]
+    else:
+        command = [sys.executable, "companyAsyncWebAPI.py", "--port", str(port),
+                   "--workers", str(options.workers), "--max-queue", str(options.maxQueue)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for i in range(100):
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            connection.close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError("Server [%s] did not start on port [%d]" % (name, port))
+
+
+def main():
+    # Parse the command line options.
+    parser = OptionParser(
+        description="Compare the hug and asyncio Web API servers at increasing numbers of concurrent clients.")
+
+    parser.add_option("--servers", dest="servers", default="hug,async",
+                      help="comma separated servers to compare [hug|async|prefork:N]. Default: [hug,async]")
+    parser.add_option("--clients", dest="clients", default="1,10,100",
+                      help="comma separated numbers of concurrent clients. Default: [1,10,100]")
+    parser.add_option("--seconds", dest="seconds", type="float", default=10,
+                      help="how long to run each load for. Default: [10]")
+    parser.add_option("--count", dest="count", type="int", default=100,
+                      help="number of companies in each list page. Default: [100]")
+    parser.add_option("--workers", dest="workers", type="int", default=8,
+                      help="async server worker threads. Default: [8]")
+    parser.add_option("--max-queue", dest="maxQueue", type="int", default=64,
+                      help="async server queue before 503 is returned. Default: [64]")
+    parser.add_option("--port", dest="port", type="int", default=8100,
+                      help="port to run the servers on. Default: [8100]")
+
+    (options, args) = parser.parse_args()
+
+    # The company ids to request.
+    companyDB = CompanyDB()
+    ids = [row[0] for row in companyDB.IterCompanies()]
+    companyDB.Close()
+    if len(ids) == 0:
+        print("No companies in [%s] - run create_db.py first" % companyDB.database, file=sys.stderr)
+        sys.exit(1)
+
+    print("%-10s %8s %10s %10s %10s %6s %6s" % ("server", "clients", "req/sec", "p50 ms", "p99 ms", "503", "failed") )
+    for name in options.servers.split(","):
+        process = StartServer(name, options.port, options)
+        try:
+            for clients in [int(clients) for clients in options.clients.split(",")]:
+                rate, p50, p99, busy, failures = RunLoad(options.port, clients, ids, options.count, options.seconds)
+                print("%-10s %8d %10.0f %10.2f %10.2f %6d %6d" % (name, clients, rate, p50 * 1000, p99 * 1000, busy, failures) )
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# companyAsyncWebAPI.py
+
+# Python script to provide the Web API functions from an asyncio server.
+
+# An alternative to companyWebAPI.py, serving its home, GetCompanyById and
+# GetCompanyList routes through the CompanyAsyncAPI ASGI application, which runs
+# the CompanyAPI calls on a bounded pool of worker threads - see CompanyAsyncAPI.py.
+
+# Run directly to serve with the built in HTTP/1.1 server:
+#     python3 companyAsyncWebAPI.py --port 8001 --workers 8
+# or with any ASGI server using the module's 'app', e.g.:
+#     uvicorn companyAsyncWebAPI:app --port 8001
+
+# With --snapshot the companies are served from an in-memory CompanySnapshot, which
+# SIGHUP reloads from the database without stopping the server.
+
+#------------------------------------------------------
+
+
+import asyncio
+import signal
+import threading
+
+from CompanyAPI import CompanyAPI
+from CompanyAsyncAPI import CompanyAsyncAPI
+from CompanyCache import CompanyCache
+from CompanyDB import CompanyDB
+from CompanyMetrics import CompanyMetrics
+from CompanySnapshot import CompanySnapshot
+
+from optparse import OptionParser
+
+
+def main():
+    # Parse the command line options.
+    parser = OptionParser(
+        description="Serves the company Web API from an asyncio server with a bounded pool of database workers.")
+
+    parser.add_option("--host", dest="host", default="127.0.0.1",
+                      help="address to listen on. Default: [127.0.0.1]")
+    parser.add_option("--port", dest="port", type="int", default=8001,
+                      help="port to listen on. Default: [8001]")
+    parser.add_option("--db", dest="database", default="company",
+                      help="name of the database. Default: [company]")
+    parser.add_option("--table", dest="dbTable", metavar="TABLE", default="Company",
+                      help="name of the table. Default: [Company]")
+    parser.add_option("--workers", dest="workers", type="int", default=8,
+                      help="number of threads running database calls, and read connections. Default: [8]")
+    parser.add_option("--max-queue", dest="maxQueue", type="int", default=64,
+                      help="number of requests that may wait for a worker before 503 is returned. Default: [64]")
+    parser.add_option("--timeout", dest="timeout", type="float", default=10.0,
+                      help="seconds a request may take before 504 is returned. Default: [10]")
+    parser.add_option("--nocache", dest="cache", action="store_false", default=True,
+                      help="stops responses being cached. Default is to cache them.")
+    parser.add_option("--snapshot", dest="snapshot", action="store_true", default=False,
+                      help="serves the companies from an in-memory snapshot, reloaded on SIGHUP. Default: [False]")
+
+    (options, args) = parser.parse_args()
+
+    # Instantiate the database interface with a read connection for each worker.
+    companyDB = CompanyDB(options.database + ".db3", options.dbTable, options.workers)
+    if options.snapshot:
+        companyDB = CompanySnapshot(companyDB)
+        print("Loaded snapshot of [%d] companies, about [%d] bytes" % (companyDB.totalcount, companyDB.MemoryUsage()) )
+        # The new snapshot is loaded on its own thread, the current one serving until it is swapped in.
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=companyDB.Reload).start())
+    companyMetrics = CompanyMetrics()
+    companyAPI = CompanyAPI(companyDB, cache=CompanyCache() if options.cache else None, metrics=companyMetrics)
+    companyAsyncAPI = CompanyAsyncAPI(companyAPI, options.workers, options.maxQueue, options.timeout, companyMetrics)
+
+    try:
+        asyncio.run(companyAsyncAPI.Serve(options.host, options.port))
+    finally:
+        companyDB.Close()
+
+
+if __name__ == '__main__':
+    main()
+else:
+    # The application for an ASGI server, with the default settings.
+    companyDB = CompanyDB()
+    companyMetrics = CompanyMetrics()
+    companyAPI = CompanyAPI(companyDB, cache=CompanyCache(), metrics=companyMetrics)
+    app = CompanyAsyncAPI(companyAPI, metrics=companyMetrics)
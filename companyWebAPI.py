@@ -17,17 +17,114 @@
 
 # This script does not use the CompanyDB interface directly for anything - it
 # merely instantiates the object and passes it to the CompanyAPI class so it
-# can access the company database.
+# can access the company database, and warms it up on startup.
+
+# Run by hug (hug -f companyWebAPI.py) or imported (serve_prefork.py), the routes
+# use the default database, whose connections are only opened by the first request.
+# Run as a script (./companyWebAPI.py) the database and table are options, and a
+# startup sequence is run in the background while the server starts listening:
+#     open        open a read connection and read the statistics, checking the table,
+#     optimize    with --optimize / --analyze, refresh the query planner statistics,
+#     pretouch    with --pretouch, read every page of the table and its indexes,
+#     warm        with --warm, fill the response cache with the first list pages.
+# /healthz answers as soon as the server is listening, and /readyz only once the
+# startup sequence is complete (with 503 Service Unavailable until then), so a
+# load balancer can hold back requests until the process is warm. Both report the
+# time each startup phase took.
 
 #------------------------------------------------------
 
 
 import hug
+import threading
+import time
+
+from email.utils import formatdate, parsedate_to_datetime
 
 from CompanyAPI import CompanyAPI
+from CompanyCache import CompanyCache
 from CompanyDB import CompanyDB
+from CompanyMetrics import CompanyMetrics
+
+from optparse import OptionParser
+
+
+@hug.request_middleware()
+def StartRequestTimer(request, response):
+    # Note the start of each request for its latency.
+    request.context["startTime"] = time.perf_counter()
+
+
+# The read routes whose responses depend only on the company data, and so can be
+# validated by its generation.
+conditionalRoutes = { "ExportCompanies", "GetCompaniesByBusinessNumbers", "GetCompaniesByIds",
+                      "GetCompanyByBusinessNumber", "GetCompanyById", "GetCompanyList",
+                      "SearchCompanies", "TypeaheadCompanies" }
+
+
+@hug.request_middleware()
+def ConditionalGet(request, response):
+    # Answer a GET of a read route with 304 Not Modified, without calling the route, when the
+    # client's If-None-Match / If-Modified-Since shows it already has the current response.
+    # The validators are noted for SetValidators to send with the response.
+    route = request.path.strip("/")
+    if request.method != "GET" or route not in conditionalRoutes:
+        return
+
+    generation = companyAPI.Generation()
+    if generation is None:
+        return
 
-# from optparse import OptionParser
+    epoch, number, modifiedAt = generation
+    etag = 'W/"%s-%d"' % (epoch, number)
+    request.context["validators"] = (etag, formatdate(modifiedAt, usegmt=True))
+
+    if NotModified(request, etag, modifiedAt):
+        request.context["route"] = route
+        response.status = hug.HTTP_304
+        response.complete = True
+
+
+def NotModified(request, etag, modifiedAt):
+    # Check the request's conditional headers against the current validators.
+    # If-None-Match takes precedence, and is compared weakly (ignoring any W/ prefix).
+    ifNoneMatch = request.get_header("If-None-Match")
+    if ifNoneMatch is not None:
+        tags = [tag.strip() for tag in ifNoneMatch.split(",")]
+        return "*" in tags or etag[2:] in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+    ifModifiedSince = request.get_header("If-Modified-Since")
+    if ifModifiedSince is not None:
+        try:
+            return int(modifiedAt) <= parsedate_to_datetime(ifModifiedSince).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+@hug.response_middleware()
+def SetValidators(request, response, resource):
+    # Send the validators noted by ConditionalGet with a successful or not modified response.
+    # no-cache has clients revalidate every time, which costs a 304 while the data is unchanged.
+    validators = request.context.get("validators")
+    if validators is not None and response.status in (hug.HTTP_200, hug.HTTP_304):
+        response.set_header("ETag", validators[0])
+        response.set_header("Last-Modified", validators[1])
+        response.set_header("Cache-Control", "no-cache")
+
+
+@hug.response_middleware()
+def RecordRequestMetrics(request, response, resource):
+    # Record the latency and status of each request against its route.
+    # Requests not matching a route are recorded together, so unknown paths cannot
+    # create unlimited endpoints.
+    startTime = request.context.get("startTime")
+    if startTime is None:
+        return
+    endpoint = request.path if resource is not None else request.context.get("route", "unmatched")
+    error = int(response.status.split(" ", 1)[0]) >= 400
+    companyMetrics.Record("http", endpoint, time.perf_counter() - startTime, error)
 
 
 @hug.get('/')
@@ -36,6 +133,77 @@ def home():
     return "Home page"
 
 
+class ChunkStream:
+    # File like wrapper around a generator of byte chunks, so hug / falcon stream the
+    # response as it is generated rather than building it in memory.
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b""
+
+    def read(self, size = -1):
+        while (size < 0 or len(self.buffer) < size) and self.chunks is not None:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                self.close()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        # Stop the generator, so its database connection is returned even if the client goes away.
+        if self.chunks is not None:
+            self.chunks.close()
+            self.chunks = None
+
+
+@hug.format.content_type("application/json; charset=utf-8")
+def StreamOutput(data):
+    # Output format passing a ChunkStream through to be streamed, and anything else as JSON.
+    if isinstance(data, ChunkStream):
+        return data
+    return hug.output_format.json(data)
+
+
+@hug.get(output=StreamOutput)
+def ExportCompanies(response, format: hug.types.text = "ndjson", restricted: hug.types.text = None):
+    # Streams every company as NDJSON or CSV, using chunked transfer.
+    # format        is the export format [ndjson|csv].
+    # restricted    is an optional boolean integer [0|1] indicating the subset of companies to export.
+    respDict = companyAPI.ExportCompanies(format, restricted)
+    if respDict["result"] != "ok":
+        return respDict
+
+    response.content_type = respDict["contentType"]
+    response.set_header("Content-Disposition", 'attachment; filename="companies.%s"' % format)
+    return ChunkStream(respDict["data"])
+
+
+@hug.http(accept=("GET", "POST"))
+def GetCompaniesByBusinessNumbers(businessNumbers: hug.types.delimited_list(",")):
+    # Returns the companies matching a list of business numbers.
+    # businessNumbers   is a comma separated list (GET), or a JSON array in the request body (POST)
+    #                   as {"businessNumbers" : [...]} for lists too long for a query string.
+    return companyAPI.GetCompaniesByBusinessNumbers(businessNumbers)
+
+
+@hug.http(accept=("GET", "POST"))
+def GetCompaniesByIds(ids: hug.types.delimited_list(",")):
+    # Returns the companies matching a list of ids.
+    # ids   is a comma separated list (GET), or a JSON array in the request body (POST)
+    #       as {"ids" : [...]} for lists too long for a query string.
+    return companyAPI.GetCompaniesByIds(ids)
+
+
+@hug.get()
+def GetCompanyByBusinessNumber(businessNumber: hug.types.text):
+    # Returns the company data.
+    # businessNumber    is the business number to match exactly.
+    return companyAPI.GetCompanyByBusinessNumber(businessNumber)
+
+
 @hug.get()
 def GetCompanyById(id: hug.types.text):
     # Returns the company data.
@@ -45,43 +213,211 @@ def GetCompanyById(id: hug.types.text):
 
 
 @hug.get()
-def GetCompanyList(offset: hug.types.text, count: hug.types.text, restricted: hug.types.text = None):
+def GetCompanyList(offset: hug.types.text = "0", count: hug.types.text = "100", restricted: hug.types.text = None, cursor: hug.types.text = None):
     # Returns a list of companies.
     # offset        is the offset into the result to start returning rows.
     # count         is the maximum number of companies to return in the list.
     # restricted    is an optional boolean integer [0|1] indicating the subset of companies to return.
+    # cursor        is the optional 'next' value from the previous page, used in place of offset.
     # restrict = "All" if restricted is None else str(restricted)
-    # print("companyWebAPI.GetCompanyList: offset [%s] count [%s] restrict [%s]" % (offset, count, restrict) )
-    return companyAPI.GetCompanyList(offset, count, restricted)
+    # print("companyWebAPI.GetCompanyList: offset [%s] count [%s] restrict [%s] cursor [%s]" % (offset, count, restrict, cursor) )
+    return companyAPI.GetCompanyList(offset, count, restricted, cursor)
+
+
+@hug.get()
+def SearchCompanies(query: hug.types.text, offset: hug.types.text = "0", count: hug.types.text = "20", restricted: hug.types.text = None):
+    # Returns the companies whose name, description or tagline hold every word of the query, best match first.
+    # query         is the words to search for.
+    # offset        is the offset into the ranked result to start returning companies, e.g. the 'next' value from the previous page.
+    # count         is the maximum number of companies to return.
+    # restricted    is an optional boolean integer [0|1] indicating the subset of companies to search.
+    return companyAPI.SearchCompanies(query, offset, count, restricted)
+
+
+@hug.get()
+def TypeaheadCompanies(prefix: hug.types.text, count: hug.types.text = "10", restricted: hug.types.text = None):
+    # Returns the id and name of the companies whose name matches the text typed so far.
+    # prefix        is the text typed, the last word of which may be incomplete.
+    # count         is the maximum number of companies to return.
+    # restricted    is an optional boolean integer [0|1] indicating the subset of companies to suggest.
+    return companyAPI.TypeaheadCompanies(prefix, count, restricted)
+
+
+@hug.post(parse_body=False)
+def UpsertCompanies(request, response):
+    # Inserts or updates a batch of companies in one transaction, returning the result of each.
+    # The request body is a JSON array of companies, or NDJSON (one company per line) when sent
+    # with the Content-Type application/x-ndjson, each company as from ExportCompanies.
+    # The body is read here rather than by hug, so an NDJSON body can be accepted.
+    # A body larger than the API accepts is refused with 413 Payload Too Large - up front if its
+    # Content-Length says so, otherwise once one byte more than the limit has been read.
+    limit = companyAPI.maxUpsertBytes
+    body = b""
+    if (request.content_length or 0) <= limit:
+        body = request.bounded_stream.read(limit + 1)
+    if (request.content_length or 0) > limit or len(body) > limit:
+        response.status = hug.HTTP_413
+        error = "Upsert Companies is limited to [%d] bytes" % limit
+        respDict = { "result" : "error", "error" : error}
+        return respDict
+
+    format = "ndjson" if "ndjson" in (request.content_type or "") else "json"
+    companies, error = companyAPI.DecodeCompanies(body, format)
+    if error != "":
+        respDict = { "result" : "error", "error" : error}
+        return respDict
+    return companyAPI.UpsertCompanies(companies)
+
+
+@hug.get('/healthz')
+def healthz():
+    # Returns ok while the process is serving requests, whether or not it has finished starting up.
+    respDict = { "result" : "ok", "uptime" : time.time() - startup["startedAt"], "startup" : StartupReport()}
+    return respDict
+
+
+@hug.get('/readyz')
+def readyz(response):
+    # Returns ok once the startup sequence is complete, and 503 Service Unavailable until then,
+    # or if it failed.
+    report = StartupReport()
+    if report["ready"]:
+        respDict = { "result" : "ok", "startup" : report}
+        return respDict
+
+    response.status = hug.HTTP_503
+    error = "Startup failed: %s" % report["error"] if report["error"] is not None else "Starting up: phase [%s]" % report["phase"]
+    respDict = { "result" : "error", "error" : error, "startup" : report}
+    return respDict
+
+
+@hug.get('/metrics', output=hug.output_format.text)
+def metrics(response):
+    # Returns the request metrics in the Prometheus text format.
+    response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+    return companyMetrics.Prometheus(companyAPI.CacheStats())
 
 
 # Main code to initialise the classes etc.
 
-# global companyDB
-# global companyAPI
-#
-# # Parse the command line options.
-# parser = OptionParser(
-#     description="Accepts HTML requests and generated HTML responses for the company Web API.",
-#     epilog="The default values prevent the need to carry any overrides to downstream process equivalent options.")
-#
-# parser.add_option("--css", dest="cssFile", metavar="FILE", default="company.css",
-#                   help="name of the CSS file to format the HTML output. Default: [company.css]")
-# parser.add_option("--db", dest="database", default="company",
-#                   help="name of the database. Default: [companyDB]")
-# parser.add_option("--table", dest="dbTable", metavar="TABLE", default="Company",
-#                   help="name of the table. Default: [Restricted]")
-#
-# (options, args) = parser.parse_args()
-#
-# # Instantiate the database interface.
-# companyDB = CompanyDB(options.database + ".db3", options.dbTable)
-#
-# # Instantiate the Company Web API interface.
-# companyAPI = CompanyAPI(company, options.cssFile)
-
-# Instantiate the database interface.
-companyDB = CompanyDB()
-
-# Instantiate the Company Web API interface.
-companyAPI = CompanyAPI(companyDB)
+def Startup(analyze = False, optimize = False, pretouch = False, warmPages = 0, warmCount = "100"):
+    # Run the startup sequence on the database in use, timing each phase, then mark the process ready.
+    # analyze       runs a full ANALYZE, and optimize a PRAGMA optimize, before serving.
+    # pretouch      reads every page of the table and its indexes.
+    # warmPages     is the number of list pages of warmCount companies, for all, restricted and
+    #               unrestricted companies, to fill the response cache with.
+    phases = [("open", companyDB.CountRows)]
+    if analyze or optimize:
+        phases.append(("optimize", lambda: companyDB.Optimize(analyze)))
+    if pretouch:
+        phases.append(("pretouch", companyDB.Pretouch))
+    if warmPages > 0:
+        phases.append(("warm", lambda: WarmCache(warmPages, warmCount)))
+
+    startup["ready"] = False
+    startup["phases"] = []
+    for phase, function in phases:
+        startup["phase"] = phase
+        startTime = time.time()
+        try:
+            function()
+        except Exception as e:
+            startup["error"] = "phase [%s]: %s" % (phase, e)
+            print("companyWebAPI: startup %s" % startup["error"])
+            return
+        startup["phases"].append({ "phase" : phase, "seconds" : time.time() - startTime})
+        # print("companyWebAPI.Startup: phase [%s] in [%.3f] seconds" % (phase, startup["phases"][-1]["seconds"]) )
+
+    startup["phase"] = None
+    startup["readyAt"] = time.time()
+    startup["ready"] = True
+    print("companyWebAPI: ready in [%.2f] seconds" % (startup["readyAt"] - startup["startedAt"]) )
+
+
+def StartupReport():
+    # The state of the startup sequence: whether ready, the phase running, any error, and the
+    # seconds each completed phase took.
+    report = dict(startup)
+    report["phases"] = list(startup["phases"])
+    report["seconds"] = None if startup["readyAt"] is None else startup["readyAt"] - startup["startedAt"]
+    return report
+
+
+def WarmCache(pages, count):
+    # Request the first list pages, so they are in the response cache (if any), and the statements
+    # they use are prepared, before the first client asks for them.
+    for restricted in (None, "0", "1"):
+        for page in range(pages):
+            respDict = companyAPI.GetCompanyList(str(page * int(count)), count, restricted)
+            if respDict["result"] != "ok":
+                break
+
+
+def UseDatabase(database):
+    # Instantiate the interfaces the routes use on a CompanyDB instance, replacing any already in use.
+    # Used by serve_prefork.py to give each worker process its own read only database.
+    global companyDB
+    global companyMetrics
+    global companyAPI
+
+    # Instantiate the database interface.
+    companyDB = database
+
+    # Instantiate the request metrics, shared by the Web API routes and the CompanyAPI functions.
+    companyMetrics = CompanyMetrics()
+
+    # Instantiate the Company Web API interface, caching the GetCompanyById / GetCompanyList responses.
+    companyAPI = CompanyAPI(companyDB, cache=CompanyCache(), metrics=companyMetrics)
+
+    # Without a startup sequence there is nothing to wait for, the connections being opened on first use.
+    startup.update({ "ready" : True, "phase" : None, "error" : None, "phases" : [], "startedAt" : time.time(), "readyAt" : time.time()})
+
+
+def main():
+    # Parse the command line options.
+    parser = OptionParser(
+        description="Accepts HTTP requests and generates JSON responses for the company Web API.",
+        epilog="The default values prevent the need to carry any overrides to downstream process equivalent options.")
+
+    parser.add_option("--db", dest="database", default="company",
+                      help="name of the database. Default: [company]")
+    parser.add_option("--table", dest="dbTable", metavar="TABLE", default="Company",
+                      help="name of the table. Default: [Company]")
+    parser.add_option("--host", dest="host", default="",
+                      help="address to listen on. Default: [all addresses]")
+    parser.add_option("--port", dest="port", type="int", default=8000,
+                      help="port to listen on. Default: [8000]")
+    parser.add_option("--analyze", dest="analyze", action="store_true", default=False,
+                      help="runs ANALYZE on startup, refreshing every query planner statistic. Default: [False]")
+    parser.add_option("--optimize", dest="optimize", action="store_true", default=False,
+                      help="runs PRAGMA optimize on startup, refreshing any query planner statistics out of date. Default: [False]")
+    parser.add_option("--pretouch", dest="pretouch", action="store_true", default=False,
+                      help="reads every page of the table and its indexes on startup. Default: [False]")
+    parser.add_option("--warm", dest="warmPages", type="int", default=0,
+                      help="number of list pages, of all, restricted and unrestricted companies, to cache on startup. Default: [0]")
+
+    (options, args) = parser.parse_args()
+
+    # Instantiate the interfaces, which open the database connections on first use.
+    UseDatabase(CompanyDB(options.database + ".db3", options.dbTable))
+
+    # Run the startup sequence while the server starts listening, so /healthz answers throughout.
+    startup["ready"] = False
+    startup["readyAt"] = None
+    startup["phase"] = "starting"
+    thread = threading.Thread(target=Startup, args=(options.analyze, options.optimize, options.pretouch, options.warmPages),
+                              name="Startup", daemon=True)
+    thread.start()
+
+    hug.API(__name__).http.serve(host=options.host, port=options.port, display_intro=False)
+
+
+# The state of the startup sequence, reported by /healthz and /readyz.
+startup = {}
+
+# The database connections are only opened on first use, so this default costs nothing if replaced.
+UseDatabase(CompanyDB())
+
+
+if __name__ == '__main__':
+    main()
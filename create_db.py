@@ -36,13 +36,18 @@
 #------------------------------------------------------
 
 
+import apsw
 import csv
 import json
 import os
+import sys
+import time
 import webbrowser
 
 from CompanyAPI import CompanyAPI
 from CompanyDB import CompanyDB
+from CompanyIngest import CompanyIngest
+from CompanyProfiler import CompanyProfiler
 
 from optparse import OptionParser
 from time import sleep
@@ -57,7 +62,46 @@ def CreateDBTable(csvFile):
     print("Recreate DB statistics: total [%d] keys: min [%s] max [%s]" % (companyDB.totalcount, companyDB.minkey, companyDB.maxkey) )
 
 
-def LoadCSVFile(csvFile):
+def DumpProfile(fileName, report = None):
+    # Print a statement profile saved by CompanyProfiler.Save (e.g. by --profile), or the report given.
+    if report is None:
+        report = CompanyProfiler.Load(fileName)
+    print("Statement profile [%s]: [%d] statement shapes, by total time" % (fileName, len(report)) )
+    CompanyProfiler().Dump(sys.stdout, report)
+
+
+def IngestCSVFile(csvFile, batchSize = 10000, rejectsFile = None, resume = True, recreate = True, progressInterval = 5.0, workers = 1):
+    # Load the CSV file, which may be compressed, as a checkpointed stream, resuming an interrupted
+    # load of the same file, with the rows parsed by workers processes - see CompanyIngest.
+    startTime = time.time()
+
+    companyIngest = CompanyIngest(companyDB, companyAPI, batchSize, progressInterval, workers=workers)
+    if companyIngest.workers < workers:
+        print("IngestCSVFile: [%d] workers limited to the [%d] cores available" % (workers, companyIngest.workers) )
+    try:
+        counts = companyIngest.Ingest(csvFile, rejectsFile, resume, recreate)
+    except (ValueError, OSError, EOFError) as e:
+        print("ERROR: Ingest of [%s] stopped, a rerun resumes from the last checkpoint: %s" % (csvFile, e), file=sys.stderr)
+        return
+
+    elapsed = time.time() - startTime
+    read = counts["rowsRead"] - counts["resumedRows"]
+    rate = read / elapsed if elapsed > 0 else 0
+    resumed = " resuming after row [%d]" % counts["resumedRows"] if counts["resumedRows"] > 0 else ""
+    print("IngestCSVFile read [%d] rows%s in [%.3f] seconds: [%.0f] rows/sec" % (read, resumed, elapsed, rate) )
+    print("IngestCSVFile loaded [%d] rejected [%d] - rejects in [%s]" % (counts["loaded"], counts["rejected"], counts["rejectsFile"]) )
+
+    companyDB.CountRows()
+    print("IngestCSVFile statistics: total [%d] keys: min [%s] max [%s]" % (companyDB.totalcount, companyDB.minkey, companyDB.maxkey) )
+
+
+def LoadCSVFile(csvFile, batchSize = 10000, fresh = False):
+    # Load the CSV file into the database.
+    # fresh is True if the table has just been recreated, and so is loaded with the load PRAGMAs.
+    # A batch size of zero uses the original path of one transaction per row,
+    # otherwise rows are written by the bulk load in transactions of batchSize rows.
+    startTime = time.time()
+
     # Open the CSV file and sniff out the dialect / format used.
     with open(csvFile, newline='') as csvFile:
         dialect = csv.Sniffer().sniff(csvFile.read(1024))
@@ -65,26 +109,79 @@ def LoadCSVFile(csvFile):
         # Assume the CSV file has the heading to be the dictionary keys.
         # reader = csv.DictReader(csvFile, dialect, restkey="REST")
         reader = csv.DictReader(csvFile, restkey="REST")
-        for row in reader:
-            # for key in row.keys():
-            #     print("CSV file row: key [%s] value [%s]" % (key, row[key]) )
-            SaveRow(row)
+        if batchSize > 0:
+            loaded = companyAPI.AddNewCompanies((TranslateRow(row) for row in reader), batchSize, fresh, RejectRow)
+        else:
+            loaded = 0
+            for row in reader:
+                # for key in row.keys():
+                #     print("CSV file row: key [%s] value [%s]" % (key, row[key]) )
+                if SaveRow(row):
+                    loaded += 1
+
+    elapsed = time.time() - startTime
+    rate = loaded / elapsed if elapsed > 0 else 0
+    mode = "batch size [%d]" % batchSize if batchSize > 0 else "per row"
+    print("LoadCSVFile loaded [%d] rows in [%.3f] seconds (%s): [%.0f] rows/sec" % (loaded, elapsed, mode, rate) )
 
     companyDB.CountRows()
     print("LoadCSVFile statistics: total [%d] keys: min [%s] max [%s]" % (companyDB.totalcount, companyDB.minkey, companyDB.maxkey) )
 
 
+def RebuildCSVFile(csvFile, batchSize = 10000, minFraction = 0.0):
+    # Load the CSV file into a shadow table and swap it in once complete, leaving the current
+    # table in service until then.
+    startTime = time.time()
+
+    with open(csvFile, newline='') as csvFile:
+        reader = csv.DictReader(csvFile, restkey="REST")
+        try:
+            loaded = companyAPI.RebuildCompanies((TranslateRow(row) for row in reader), batchSize, minFraction, RejectRow)
+        except (ValueError, apsw.Error) as e:
+            print("ERROR: Rebuild abandoned, the current table is unchanged: %s" % e, file=sys.stderr)
+            return
+
+    elapsed = time.time() - startTime
+    rate = loaded / elapsed if elapsed > 0 else 0
+    print("RebuildCSVFile loaded and swapped in [%d] rows in [%.3f] seconds: [%.0f] rows/sec" % (loaded, elapsed, rate) )
+
+    companyDB.CountRows()
+    print("RebuildCSVFile statistics: total [%d] keys: min [%s] max [%s]" % (companyDB.totalcount, companyDB.minkey, companyDB.maxkey) )
+
+
+def RejectRow(row, error):
+    # Report a company not loaded as it conflicts with one already loaded (the same id or business number).
+    print("WARNING: Company id [%s] business number [%s] not loaded: %s" % (row["id"], row["businessNumber"], error), file=sys.stderr)
+
+
 def SaveRow(row):
     # Save the read row to the database.
-    # Need to translate the row key names to the equivalent database column names.
-    newRow = dict({"id"             : row["id"],
-                   "companyName"    : row["fake-company-name"],
-                   "description"    : row["description"],
-                   "tagline"        : row["tagline"],
-                   "companyEmail"   : row["company-email"],
-                   "businessNumber" : row["business number"],
-                   "restricted"     : row["Restricted"] })
-    companyAPI.AddNewCompany(newRow)
+    # Returns False if the company was not saved, as it conflicts with one already saved.
+    row = TranslateRow(row)
+    error = companyAPI.AddNewCompany(row)
+    if error != "":
+        RejectRow(row, error)
+        return False
+    return True
+
+
+def SyncCSVFile(csvFile, deleteMissing = False, batchSize = 10000):
+    # Bring the database up to date with the CSV file, only writing the companies that have changed.
+    startTime = time.time()
+
+    with open(csvFile, newline='') as csvFile:
+        reader = csv.DictReader(csvFile, restkey="REST")
+        counts = companyAPI.SyncCompanies((TranslateRow(row) for row in reader), deleteMissing, batchSize, RejectRow)
+
+    elapsed = time.time() - startTime
+    total = counts["inserted"] + counts["updated"] + counts["unchanged"] + counts["rejected"]
+    rate = total / elapsed if elapsed > 0 else 0
+    print("SyncCSVFile synced [%d] rows in [%.3f] seconds: [%.0f] rows/sec" % (total, elapsed, rate) )
+    print("SyncCSVFile changes: inserted [%d] updated [%d] unchanged [%d] deleted [%d] rejected [%d]" %
+          (counts["inserted"], counts["updated"], counts["unchanged"], counts["deleted"], counts["rejected"]) )
+
+    companyDB.CountRows()
+    print("SyncCSVFile statistics: total [%d] keys: min [%s] max [%s]" % (companyDB.totalcount, companyDB.minkey, companyDB.maxkey) )
 
 
 def TestAPI():
@@ -134,6 +231,18 @@ def TestAPI_GetCompanyList(id, count = 5, restricted = None):
     webbrowser.open('company_list.json')
 
 
+def TranslateRow(row):
+    # Need to translate the row key names to the equivalent database column names.
+    newRow = dict({"id"             : row["id"],
+                   "companyName"    : row["fake-company-name"],
+                   "description"    : row["description"],
+                   "tagline"        : row["tagline"],
+                   "companyEmail"   : row["company-email"],
+                   "businessNumber" : row["business number"],
+                   "restricted"     : row["Restricted"] })
+    return newRow
+
+
 def main():
     global companyDB
     global companyAPI
@@ -153,35 +262,107 @@ def main():
                       help="stops the create / recreate of the database table. Default is to create the table.")
     parser.add_option("--noload", dest="loadDB", action="store_false", default=True,
                       help="stops the loading of data into the database table. Default is to load the data.")
+    parser.add_option("--batch-size", dest="batchSize", type="int", default=10000,
+                      help="number of rows written per transaction when loading, 0 to write one row per transaction. Default: [10000]")
+    parser.add_option("--sync", dest="syncDB", action="store_true", default=False,
+                      help="updates the existing table from the CSV file, only writing new or changed companies, instead of recreating and loading it. Default: [False]")
+    parser.add_option("--delete-missing", dest="deleteMissing", action="store_true", default=False,
+                      help="with --sync, deletes companies that are no longer in the CSV file. Default: [False]")
+    parser.add_option("--rebuild", dest="rebuildDB", action="store_true", default=False,
+                      help="loads the CSV file into a shadow table and swaps it in when complete, keeping the current table in service meanwhile. Default: [False]")
+    parser.add_option("--min-fraction", dest="minFraction", type="float", default=0.0,
+                      help="with --rebuild, abandons the rebuild if it has fewer rows than this fraction of the current table. Default: [0.0]")
+    parser.add_option("--rollback", dest="rollbackDB", action="store_true", default=False,
+                      help="swaps back the table replaced by the last --rebuild, instead of loading. Default: [False]")
+    parser.add_option("--publish", dest="snapshotFile", metavar="FILE", default=None,
+                      help="publishes a compacted snapshot of the database to FILE once loaded, for serve_prefork.py --immutable. Default: [None]")
+    parser.add_option("--ingest", dest="ingestDB", action="store_true", default=False,
+                      help="loads the CSV file, plain or gzip / bzip2 / xz compressed, as a checkpointed stream, rejecting invalid rows and resuming an interrupted load. Default: [False]")
+    parser.add_option("--rejects", dest="rejectsFile", metavar="FILE", default=None,
+                      help="with --ingest, the CSV file rejected rows are written to. Default: [<csv file>.rejects.csv]")
+    parser.add_option("--restart", dest="resume", action="store_false", default=True,
+                      help="with --ingest, starts the load afresh rather than resuming it. Default is to resume an interrupted load.")
+    parser.add_option("--progress", dest="progressInterval", type="float", default=5.0,
+                      help="with --ingest, seconds between progress reports, 0 for none. Default: [5]")
+    parser.add_option("--workers", dest="workers", type="int", default=1,
+                      help="with --ingest, number of processes parsing the CSV file while this one writes the database, 1 to parse it in this process, limited to the cores available. Default: [1]")
+    parser.add_option("--profile", dest="profileFile", metavar="FILE", default=None,
+                      help="profiles the SQL statements of this run, saving the profile to FILE and printing the statements taking the most time. Default: [None]")
+    parser.add_option("--slow-ms", dest="slowMs", type="float", default=100.0,
+                      help="with --profile, milliseconds at or above which a statement is written to the slow query log. Default: [100]")
+    parser.add_option("--slow-log", dest="slowLog", metavar="FILE", default=None,
+                      help="with --profile, the file the slow query log is appended to. Default is to log slow statements as warnings.")
+    parser.add_option("--dump-profile", dest="dumpProfile", metavar="FILE", default=None,
+                      help="prints a statement profile saved by --profile, instead of creating or loading. Default: [None]")
     parser.add_option("--test", dest="testAPI", action="store_true", default=False,
                       help="determines if a quick test of the API occurs. Default: [False]")
 
     (options, args) = parser.parse_args()
 
-    # Instantiate the database interface.
-    companyDB = CompanyDB(options.database + ".db3", options.dbTable)
+    if options.dumpProfile is not None:
+        DumpProfile(options.dumpProfile)
+        return
+
+    # Instantiate the database interface, profiling its statements if asked to.
+    profiler = None
+    if options.profileFile is not None:
+        profiler = CompanyProfiler(options.slowMs / 1000, options.slowLog)
+    companyDB = CompanyDB(options.database + ".db3", options.dbTable, profiler = profiler)
 
     # Instantiate the Company Web API interface.
     companyAPI = CompanyAPI(companyDB)
 
-    if options.createDBTable:
+    if options.rollbackDB:
+        if companyAPI.RollbackCompanies():
+            companyDB.CountRows()
+            print("Rollback statistics: total [%d] keys: min [%s] max [%s]" % (companyDB.totalcount, companyDB.minkey, companyDB.maxkey) )
+        else:
+            print("ERROR: There is no previous table to roll back to", file=sys.stderr)
+        options.createDBTable = False
+        options.loadDB = False
+
+    # An ingest recreates the table itself, only when not resuming.
+    if options.createDBTable and not (options.syncDB or options.rebuildDB or options.ingestDB):
         CreateDBTable(options.csvFile)
 
     if options.loadDB:
-        if os.path.isfile(options.csvFile):
-            LoadCSVFile(options.csvFile)
+        if os.path.isfile(options.csvFile) and options.rebuildDB:
+            RebuildCSVFile(options.csvFile, options.batchSize, options.minFraction)
+        elif os.path.isfile(options.csvFile) and options.ingestDB:
+            IngestCSVFile(options.csvFile, options.batchSize, options.rejectsFile, options.resume, options.createDBTable, options.progressInterval, options.workers)
+        elif os.path.isfile(options.csvFile) and options.syncDB:
+            SyncCSVFile(options.csvFile, options.deleteMissing, options.batchSize)
+        elif os.path.isfile(options.csvFile):
+            LoadCSVFile(options.csvFile, options.batchSize, options.createDBTable)
         else:
             print("ERROR: File [%s] does not exist\n" % options.csvFile, file=sys.stderr)
             # parser.parse_args(args=["-h"])
             parser.print_help()
             return
 
+    # A recreated table is left without its indexes until loaded (see CompanyDB.RecreateTable), so
+    # build them if the load did not, e.g. with --noload or one row per transaction.
+    if options.createDBTable and not (options.syncDB or options.rebuildDB):
+        companyDB.CreateIndexes()
+
+    # Publish a snapshot for read only servers, replacing any previous snapshot in one rename.
+    if options.snapshotFile is not None:
+        startTime = time.time()
+        size = companyDB.PublishSnapshot(options.snapshotFile)
+        print("Published snapshot [%s] bytes [%d] in [%.2f] seconds" % (options.snapshotFile, size, time.time() - startTime) )
+
     # Check if we want to test the API access.
     if options.testAPI:
         TestAPI()
 
+    # Save the statement profile, with the query plans, and print the statements taking the most time.
+    if profiler is not None:
+        report = companyDB.Profile()
+        profiler.Save(options.profileFile)
+        DumpProfile(options.profileFile, report)
+
     # Cleanly close.
-    companyDB.Close
+    companyDB.Close()
 
 
 if __name__ == '__main__':
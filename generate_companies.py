@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# generate_companies.py
+
+# Python script to generate a synthetic company CSV file of any size, in the
+# format of faux_id_fake_companies.csv, for load and benchmark testing.
+
+# The file has the same heading row and CRLF line endings:
+#   id, fake-company-name, description, tagline, company-email, business number, Restricted
+# and rows like those in the supplied file:
+# - company names such as "Bins, Kohler and Kuhlman", quoted as they hold commas,
+#   as well as "Braun-Satterfield" and "Bergstrom PLC",
+# - business numbers of 9 digits, some written with a dash as 88-3175292,
+# - about one company in ten restricted.
+
+# Ids run from 1 to the number of rows, and each business number is unique, so the
+# file loads without conflicts. The same seed always generates the same file.
+
+#------------------------------------------------------
+
+
+import csv
+import random
+import time
+
+from optparse import OptionParser
+
+
+surnames = ("Abbott", "Bergstrom", "Bins", "Braun", "Collier", "Dare", "Feeney", "Frami", "Gibson", "Green",
+            "Hermann", "Jones", "Kilback", "Kohler", "Kreiger", "Kuhlman", "Leuschke", "Mann", "Mraz", "Nikolaus",
+            "O'Conner", "Orn", "Ortiz", "Reilly", "Runolfsdottir", "Satterfield", "Schultz", "Stamm", "Torp", "Von",
+            "Walter", "West", "Zemlak", "Krajcik", "Blanda", "Davis", "Becker", "Stokes", "Hettinger", "Lueilwitz")
+suffixes = ("Inc", "LLC", "PLC", "Group", "Ltd", "and Sons")
+adjectives = ("Reactive", "Up-Sized", "Enterprise-Wide", "User-Friendly", "Optional", "Synergistic", "Total",
+              "Robust", "Streamlined", "Multi-Layered", "Persistent", "Digitized", "Balanced", "Universal")
+qualities = ("Content-Based", "Radical", "Optimal", "Global", "Client-Driven", "Fault-Tolerant", "Dynamic",
+             "Zero-Defect", "Heuristic", "Bi-Directional", "Mission-Critical", "Asynchronous", "Holistic")
+nouns = ("Complexity", "Opensystem", "Matrices", "Encryption", "Architecture", "Frameworks", "Portals",
+         "Paradigms", "Synergies", "Interfaces", "Solutions", "Models", "Infrastructures", "Methodologies")
+verbs = ("Drive", "Maximize", "Synergize", "Leverage", "Incubate", "Envisioneer", "Streamline", "Deploy",
+         "Orchestrate", "Reinvent", "Monetize", "Disintermediate", "Harness", "Engage")
+domains = ("nikolaus.com", "gibson.com", "west.com", "krajcik.com", "example.org", "mail.net", "corp.biz")
+
+heading = ("id", "fake-company-name", "description", "tagline", "company-email", "business number", "Restricted")
+
+
+def BusinessNumber(id, random):
+    # A unique 9 digit business number for the id, some written with a dash after two digits.
+    # Multiplying by a number prime to 10**9 permutes the ids, so no two ids share a number.
+    digits = "%09d" % ((id * 387420489 + 123456789) % 1000000000)
+    if random.random() < 0.3:
+        return digits[:2] + "-" + digits[2:]
+    return digits
+
+
+def CompanyName(random):
+    # A company name in one of the forms of the supplied file.
+    form = random.random()
+    if form < 0.35:
+        return "%s, %s and %s" % (random.choice(surnames), random.choice(surnames), random.choice(surnames))
+    if form < 0.7:
+        return "%s-%s" % (random.choice(surnames), random.choice(surnames))
+    return "%s %s" % (random.choice(surnames), random.choice(suffixes))
+
+
+def GenerateRows(rows, seed = 0, restrictedFraction = 0.1):
+    # Generate the CSV rows, as lists of values in heading order.
+    generator = random.Random(seed)
+    for id in range(1, rows + 1):
+        yield [id,
+               CompanyName(generator),
+               "%s %s %s" % (generator.choice(adjectives), generator.choice(qualities), generator.choice(nouns)),
+               "%s %s %s" % (generator.choice(verbs), generator.choice(qualities), generator.choice(nouns)),
+               "%s%d@%s" % (generator.choice(surnames).lower().replace("'", ""), generator.randrange(100), generator.choice(domains)),
+               BusinessNumber(id, generator),
+               "Yes" if generator.random() < restrictedFraction else "No"]
+
+
+def ParseRows(text):
+    # Convert a row count such as 10000, 10k, 1M or 10M to an integer.
+    multipliers = { "k" : 1000, "m" : 1000000 }
+    text = text.strip().lower()
+    if text[-1:] in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1]])
+    return int(text)
+
+
+def WriteCSV(fileName, rows, seed = 0, restrictedFraction = 0.1):
+    # Write a synthetic company CSV file of rows companies.
+    with open(fileName, "w", newline='') as csvFile:
+        writer = csv.writer(csvFile, lineterminator="\r\n")
+        writer.writerow(heading)
+        writer.writerows(GenerateRows(rows, seed, restrictedFraction))
+
+
+def main():
+    # Parse the command line options.
+    parser = OptionParser(
+        description="Generate a synthetic company CSV file in the format of faux_id_fake_companies.csv.")
+
+    parser.add_option("--rows", dest="rows", default="10k",
+                      help="number of companies, e.g. 10000, 10k, 1M, 10M. Default: [10k]")
+    parser.add_option("--output", dest="output", metavar="FILE", default=None,
+                      help="name of the CSV file to write. Default: [companies_<rows>.csv]")
+    parser.add_option("--seed", dest="seed", type="int", default=0,
+                      help="random seed, the same seed generating the same file. Default: [0]")
+    parser.add_option("--restricted", dest="restrictedFraction", type="float", default=0.1,
+                      help="fraction of companies restricted. Default: [0.1]")
+
+    (options, args) = parser.parse_args()
+
+    rows = ParseRows(options.rows)
+    output = options.output or "companies_%s.csv" % options.rows
+    startTime = time.time()
+    WriteCSV(output, rows, options.seed, options.restrictedFraction)
+    print("Generated [%d] companies in [%s] in [%.1f] seconds" % (rows, output, time.time() - startTime) )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# serve_prefork.py
+
+# Python script to serve the companyWebAPI.py routes from several pre-forked
+# worker processes, so the JSON formatting and response building of the read
+# requests is spread over the CPU cores rather than held to one by the GIL.
+
+# The supervisor opens the listening socket and imports the Web API, then forks
+# --workers worker processes which all accept connections from the one socket.
+# Each worker serves one request at a time with its own CompanyDB instance, which
+# opens the database:
+# - read only, so a worker can never write to it,
+# - with a memory map of --mmap-size bytes, so the database pages are read through
+#   the OS page cache shared by every worker, rather than copied into a page cache
+#   per connection,
+# - with --immutable, as a published snapshot (create_db.py --publish) that is
+#   replaced rather than changed, so SQLite takes no locks and keeps no WAL index.
+
+# The supervisor restarts any worker that exits unexpectedly, and restarts every
+# worker when a new database generation is published:
+# - with --immutable, when the database file is replaced by a new snapshot,
+# - on SIGHUP, e.g. from the process that published it.
+# New workers are started before the old ones are told to finish, so connections
+# are accepted throughout. An old worker finishes its current request, and keeps
+# the snapshot it opened until it exits.
+
+# Without --immutable the workers read the live WAL database, and see each commit
+# as it is made, so no restart is needed for new data.
+
+# SIGINT / SIGTERM stop the supervisor, which stops the workers in the same way.
+
+#------------------------------------------------------
+
+
+import hug
+import os
+import signal
+import socket
+import sys
+import time
+
+from optparse import OptionParser
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+import companyWebAPI
+
+from CompanyDB import CompanyDB
+
+
+class StopWorker(Exception):
+    # Raised by the SIGTERM / SIGINT handler to stop a worker waiting for a connection.
+    pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    # Request handler that does not log each request to stderr.
+
+    def log_message(self, format, *args):
+        pass
+
+
+def DatabaseIdentity(database):
+    # Identify the database file, so a new snapshot renamed over it can be recognised.
+    # Returns None if there is no file.
+    try:
+        stat = os.stat(database)
+    except FileNotFoundError:
+        return None
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def RunWorker(listener, app, options):
+    # Serve requests from the listening socket until told to stop by SIGTERM / SIGINT.
+    # A worker waiting for a connection stops at once, and one serving a request stops once it is answered.
+    state = { "idle" : False, "stopping" : False }
+
+    def Stop(signum, frame):
+        state["stopping"] = True
+        if state["idle"]:
+            raise StopWorker()
+
+    signal.signal(signal.SIGTERM, Stop)
+    signal.signal(signal.SIGINT, Stop)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+    # Each worker has its own connections, opened after the fork.
+    companyDB = CompanyDB(options.database, options.dbTable, 1,
+                          readOnly=True, mmapSize=options.mmapSize, immutable=options.immutable)
+    companyWebAPI.UseDatabase(companyDB)
+
+    # The server takes the supervisor's listening socket rather than binding its own.
+    server = WSGIServer(listener.getsockname(), QuietRequestHandler, bind_and_activate=False)
+    server.socket = listener
+    server.server_name = options.host
+    server.server_port = listener.getsockname()[1]
+    server.setup_environ()
+    server.set_app(app)
+
+    # Every worker waits in a blocking accept, from which the kernel wakes just one worker per
+    # connection, rather than waking them all to race for it as waiting in select would.
+    while state["stopping"] == False:
+        state["idle"] = True
+        try:
+            request, clientAddress = listener.accept()
+        except StopWorker:
+            break
+        finally:
+            state["idle"] = False
+
+        try:
+            server.finish_request(request, clientAddress)
+        except Exception:
+            server.handle_error(request, clientAddress)
+        finally:
+            server.shutdown_request(request)
+
+    companyDB.Close()
+
+
+def Spawn(listener, app, options):
+    # Fork a worker process, returning its process id.
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            RunWorker(listener, app, options)
+            status = 0
+        finally:
+            os._exit(status)
+    return pid
+
+
+def StopWorkers(pids, timeout):
+    # Ask the workers to finish their current request and exit, killing any still running after timeout seconds.
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    endTime = time.time() + timeout
+    remaining = set(pids)
+    while len(remaining) > 0 and time.time() < endTime:
+        for pid in list(remaining):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                    remaining.discard(pid)
+            except ChildProcessError:
+                remaining.discard(pid)
+        time.sleep(0.05)
+
+    for pid in remaining:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+def main():
+    # Parse the command line options.
+    parser = OptionParser(
+        description="Serves the company Web API from pre-forked worker processes sharing one listening socket and a read only database.")
+
+    parser.add_option("--host", dest="host", default="127.0.0.1",
+                      help="address to listen on. Default: [127.0.0.1]")
+    parser.add_option("--port", dest="port", type="int", default=8000,
+                      help="port to listen on. Default: [8000]")
+    parser.add_option("--db", dest="database", default="company.db3",
+                      help="database file to serve, e.g. a snapshot from create_db.py --publish. Default: [company.db3]")
+    parser.add_option("--table", dest="dbTable", metavar="TABLE", default="Company",
+                      help="name of the table. Default: [Company]")
+    parser.add_option("--workers", dest="workers", type="int", default=os.cpu_count(),
+                      help="number of worker processes. Default: [the number of CPUs, %d]" % os.cpu_count())
+    parser.add_option("--mmap-size", dest="mmapSize", type="int", default=1024 * 1024 * 1024,
+                      help="bytes of the database each worker reads through a memory map, 0 for none. Default: [1073741824]")
+    parser.add_option("--immutable", dest="immutable", action="store_true", default=False,
+                      help="serves the database as an immutable published snapshot, restarting the workers when it is replaced. Default: [False]")
+    parser.add_option("--poll", dest="poll", type="float", default=1.0,
+                      help="seconds between checks for a new snapshot with --immutable. Default: [1]")
+    parser.add_option("--grace", dest="grace", type="float", default=10.0,
+                      help="seconds a stopping worker has to finish its request before it is killed. Default: [10]")
+
+    (options, args) = parser.parse_args()
+
+    if os.path.isfile(options.database) == False:
+        print("ERROR: Database [%s] does not exist" % options.database, file=sys.stderr)
+        sys.exit(1)
+
+    # The listening socket and the WSGI application are created once, and inherited by every worker.
+    listener = socket.create_server((options.host, options.port), backlog=1024)
+    app = hug.API(companyWebAPI).http.server()
+
+    signals = []
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+    identity = DatabaseIdentity(options.database)
+    workers = dict((Spawn(listener, app, options), time.time()) for i in range(options.workers))
+    print("serve_prefork: serving [%s] on [%s:%d] workers [%d] mmap size [%d] immutable [%s]"
+          % (options.database, options.host, options.port, options.workers, options.mmapSize, options.immutable) )
+
+    nextPoll = time.time() + options.poll
+    while True:
+        time.sleep(0.1)
+
+        # Replace any worker that has exited, waiting a second if it exited straight after starting,
+        # so a worker failing to start does not spin. None is replaced once a stop signal arrives,
+        # as a Ctrl-C is also delivered to the workers, which exit with it.
+        while signal.SIGTERM not in signals and signal.SIGINT not in signals:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in workers:
+                print("serve_prefork: worker [%d] exited with status [%d], restarting" % (pid, status), file=sys.stderr)
+                if time.time() - workers.pop(pid) < 1.0:
+                    time.sleep(1.0)
+                if signal.SIGTERM in signals or signal.SIGINT in signals:
+                    break
+                workers[Spawn(listener, app, options)] = time.time()
+
+        if signal.SIGTERM in signals or signal.SIGINT in signals:
+            break
+
+        # Restart the workers on a new database generation.
+        restart = signal.SIGHUP in signals
+        if options.immutable and time.time() >= nextPoll:
+            nextPoll = time.time() + options.poll
+            current = DatabaseIdentity(options.database)
+            if current is not None and current != identity:
+                identity = current
+                restart = True
+        signals.clear()
+
+        if restart:
+            print("serve_prefork: new database generation, restarting [%d] workers" % len(workers))
+            previous = list(workers)
+            workers = dict((Spawn(listener, app, options), time.time()) for i in range(options.workers))
+            StopWorkers(previous, options.grace)
+
+    print("serve_prefork: stopping [%d] workers" % len(workers))
+    StopWorkers(list(workers), options.grace)
+    listener.close()
+
+
+if __name__ == '__main__':
+    main()
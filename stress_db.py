@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+
+#------------------------------------------------------
+
+# stress_db.py
+
+# Python script to stress the CompanyDB connection pool from many threads.
+
+# A scratch database is created and loaded from the supplied CSV file, then
+# reader threads call CompanyAPI.GetCompanyById / GetCompanyList at random while
+# a writer thread adds new companies through CompanyAPI.AddNewCompany.
+
+# Every response is checked against the loaded data:
+# - a company fetched by id must be the company with that id,
+# - a company list must be in id order and match the restricted filter.
+
+# Beforehand each way of loading companies is checked to leave out, and report, a
+# company with the same business number (once normalised) as one already loaded.
+
+# The script reports the operations per second and exits non-zero if any
+# check fails or any thread raises an exception.
+
+#------------------------------------------------------
+
+
+import csv
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from CompanyAPI import CompanyAPI
+from CompanyDB import CompanyDB
+
+from optparse import OptionParser
+
+from create_db import TranslateRow
+
+
+def AddEachCompany(companyAPI, companies, Reject):
+    # Add the companies one at a time, passing each not added to Reject with the error.
+    for company in companies:
+        error = companyAPI.AddNewCompany(company)
+        if error != "":
+            Reject(company, error)
+
+
+def CheckDuplicateBusinessNumbers(directory, rows):
+    # Load the first two companies and a third with the business number of the first, written
+    # differently, by each way of loading companies, checking the third is the one left out.
+    # Returns a list of the failed checks.
+    failures = []
+    duplicate = dict(rows[0], id=str(max(int(row["id"]) for row in rows) + 1))
+    duplicate["businessNumber"] = " %s " % duplicate["businessNumber"].replace("-", " ")
+
+    loads = { "AddNewCompanies" : lambda companyAPI, companies, Reject: companyAPI.AddNewCompanies(companies, Reject = Reject),
+              "AddNewCompany"   : AddEachCompany,
+              "SyncCompanies"   : lambda companyAPI, companies, Reject: companyAPI.SyncCompanies(companies, Reject = Reject),
+              "RebuildCompanies": lambda companyAPI, companies, Reject: companyAPI.RebuildCompanies(companies, Reject = Reject) }
+    for name, Load in loads.items():
+        companyDB = CompanyDB(os.path.join(directory, "duplicate%s.db3" % name), "Company")
+        companyAPI = CompanyAPI(companyDB)
+        companyDB.RecreateTable()
+        companyDB.CreateIndexes()
+
+        rejected = []
+        try:
+            Load(companyAPI, [dict(row) for row in rows[:2] + [duplicate]], lambda row, error: rejected.append(row["id"]))
+        except Exception as e:
+            failures.append("%s with a duplicate business number raised %s: %s" % (name, type(e).__name__, e))
+            continue
+        finally:
+            companyDB.Close()
+
+        companyDB = CompanyDB(os.path.join(directory, "duplicate%s.db3" % name), "Company")
+        companyDB.CountRows()
+        if rejected != [duplicate["id"]] or companyDB.totalcount != 2:
+            failures.append("%s with a duplicate business number rejected %s and loaded [%d] companies" % (name, rejected, companyDB.totalcount))
+        companyDB.Close()
+
+    return failures
+
+
+def CheckList(respDict, restricted):
+    # Check a company list response is in id order and matches the restricted filter.
+    if respDict["result"] != "ok":
+        return "GetCompanyList failed [%s]" % respDict["error"]
+
+    ids = [company["id"] for company in respDict["data"]]
+    if ids != sorted(ids):
+        return "GetCompanyList ids out of order %s" % ids
+
+    if restricted is not None:
+        expected = "Yes" if restricted == "1" else "No"
+        for company in respDict["data"]:
+            if company["restricted"] != expected:
+                return "GetCompanyList id [%s] restricted [%s] expected [%s]" % (company["id"], company["restricted"], expected)
+
+    return ""
+
+
+def Reader(companyAPI, companies, listSizes, seconds, results):
+    # Call the read functions of the API at random until the time is up.
+    operations = 0
+    failures = []
+    ids = list(companies.keys())
+    endTime = time.time() + seconds
+
+    while time.time() < endTime:
+        if random.random() < 0.8:
+            id = random.choice(ids)
+            respDict = companyAPI.GetCompanyById(str(id))
+            if respDict["result"] != "ok":
+                failures.append("GetCompanyById [%s] failed [%s]" % (id, respDict["error"]))
+            elif respDict["data"]["companyName"] != companies[id]:
+                failures.append("GetCompanyById [%s] returned company [%s]" % (id, respDict["data"]["companyName"]))
+        else:
+            restricted = random.choice([None, "0", "1"])
+            offset = str(random.randrange(0, listSizes[restricted]))
+            error = CheckList(companyAPI.GetCompanyList(offset, "10", restricted), restricted)
+            if error != "":
+                failures.append(error)
+        operations += 1
+
+    results.append((operations, failures))
+
+
+def Writer(companyAPI, firstId, seconds, results):
+    # Add new companies to the database until the time is up.
+    operations = 0
+    failures = []
+    endTime = time.time() + seconds
+
+    while time.time() < endTime:
+        id = firstId + operations
+        companyAPI.AddNewCompany({"id"             : str(id),
+                                  "companyName"    : "Stress Company %d" % id,
+                                  "description"    : "Added by stress_db.py",
+                                  "tagline"        : "",
+                                  "companyEmail"   : "",
+                                  "businessNumber" : "9%08d" % id,
+                                  "restricted"     : random.choice(["Yes", "No"]) })
+        operations += 1
+
+    results.append((operations, failures))
+
+
+def RunThread(function, args, errors):
+    # Run a thread function, recording any exception it raises.
+    try:
+        function(*args)
+    except Exception as e:
+        errors.append("%s raised %s: %s" % (function.__name__, type(e).__name__, e))
+
+
+def main():
+    # Parse the command line options.
+    parser = OptionParser(
+        description="Stress the company database connection pool with concurrent readers and a writer.")
+
+    parser.add_option("--csv", dest="csvFile", metavar="FILE", default="faux_id_fake_companies.csv",
+                      help="name of the existing CSV file holding the company list. Default: [faux_id_fake_companies.csv]")
+    parser.add_option("--threads", dest="threads", type="int", default=32,
+                      help="number of reader threads. Default: [32]")
+    parser.add_option("--pool-size", dest="poolSize", type="int", default=8,
+                      help="maximum number of read connections in the pool. Default: [8]")
+    parser.add_option("--seconds", dest="seconds", type="float", default=10,
+                      help="how long to run the stress for. Default: [10]")
+    parser.add_option("--nowriter", dest="writer", action="store_false", default=True,
+                      help="stops the writer thread adding companies during the stress. Default is to run the writer.")
+
+    (options, args) = parser.parse_args()
+
+    # Load the companies into a scratch database, keeping each name to check the responses.
+    companies = {}
+    with open(options.csvFile, newline='') as csvFile:
+        rows = [TranslateRow(row) for row in csv.DictReader(csvFile, restkey="REST")]
+    for row in rows:
+        companies[int(row["id"])] = row["companyName"]
+
+    # The number of companies in each list, so the offsets requested are in range.
+    # The writer only adds companies, so the lists never get shorter.
+    listSizes = {None : len(rows), "0" : 0, "1" : 0}
+    for row in rows:
+        listSizes["0" if row["restricted"].lower() == "no" else "1"] += 1
+
+    directory = tempfile.mkdtemp(prefix="stress_db_")
+    duplicateFailures = CheckDuplicateBusinessNumbers(directory, rows)
+
+    companyDB = CompanyDB(os.path.join(directory, "stress.db3"), "Company", options.poolSize)
+    companyAPI = CompanyAPI(companyDB)
+    companyDB.RecreateTable()
+    companyAPI.AddNewCompanies(rows, fresh = True)
+
+    # Run the readers and the writer together.
+    readResults = []
+    writeResults = []
+    errors = []
+    threads = []
+    for i in range(options.threads):
+        threads.append(threading.Thread(target=RunThread, args=(Reader, (companyAPI, companies, listSizes, options.seconds, readResults), errors)))
+    if options.writer:
+        threads.append(threading.Thread(target=RunThread, args=(Writer, (companyAPI, max(companies) + 1, options.seconds, writeResults), errors)))
+
+    startTime = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - startTime
+
+    companyDB.Close()
+
+    # Report the results.
+    reads = sum(operations for operations, failures in readResults)
+    writes = sum(operations for operations, failures in writeResults)
+    failures = duplicateFailures + [failure for operations, threadFailures in readResults + writeResults for failure in threadFailures]
+
+    print("Stress: threads [%d] pool size [%d] seconds [%.1f]" % (options.threads, options.poolSize, elapsed) )
+    print("Stress: reads [%d] [%.0f]/sec writes [%d] [%.0f]/sec" % (reads, reads / elapsed, writes, writes / elapsed) )
+    for error in errors + failures[:20]:
+        print("ERROR: %s" % error, file=sys.stderr)
+
+    if len(errors) + len(failures) > 0:
+        print("Stress: FAILED with [%d] exceptions and [%d] failed checks" % (len(errors), len(failures)) )
+        sys.exit(1)
+    print("Stress: passed")
+
+
+if __name__ == '__main__':
+    main()